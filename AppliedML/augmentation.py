@@ -0,0 +1,21 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+
+# The RandomRotation/RandomFlip augmentation from create_model() as a stage in the tf.data pipeline.
+# It runs on whole batches on the CPU threads of tf.data, while the model trains on the previous batch,
+# instead of inside the forward pass. Build the model with create_model(augment=False) when using it.
+
+
+def augmentation_layers():
+    # The same augmentation as in the model files
+    return tf.keras.Sequential([
+        layers.RandomRotation(0.33),
+        layers.RandomFlip("horizontal"),
+    ], name='augmentation')
+
+
+def augment_dataset(dataset):
+    # Augment a batched dataset of (images, labels). Every image in a batch gets its own rotation and flip
+    augmentation = augmentation_layers()
+    return dataset.map(lambda images, labels: (augmentation(images, training=True), labels),
+                       num_parallel_calls=tf.data.AUTOTUNE)
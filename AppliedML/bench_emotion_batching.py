@@ -0,0 +1,104 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from emotion_rnn import bucketed_dataset, create_model, predict_bucketed
+
+# Epoch time, accuracy and inference throughput of the emotion LSTM with the notebook's padding (every sequence
+# padded to the longest training sequence) against bucketed batches with masking (emotion_rnn.py).
+# The data is synthetic so it runs offline: token sequences with the length distribution of the cleaned tweets,
+# where the label is given by a few words of the class among common filler words.
+# python bench_emotion_batching.py --train 16000 --epochs 3
+VOCAB_SIZE = 15214
+CLASSES = 6
+
+
+def synthetic_data(count, rng, max_length=66):
+    # (sequences, one-hot labels). Most sequences are short with a long tail, like the emotion tweets
+    lengths = np.clip(rng.lognormal(2.2, 0.5, count).astype(int), 1, max_length)
+    labels = rng.integers(0, CLASSES, count)
+    sequences = []
+    for length, label in zip(lengths, labels):
+        filler = np.minimum(rng.zipf(1.3, length), VOCAB_SIZE - 1 - CLASSES * 20) + CLASSES * 20
+        keywords = 1 + label * 20 + rng.integers(0, 20, max(1, length // 6))
+        filler[rng.choice(length, len(keywords), replace=len(keywords) > length)] = keywords
+        sequences.append(filler.tolist())
+    return sequences, tf.keras.utils.to_categorical(labels, CLASSES)
+
+
+def fixed_dataset(sequences, labels, batch_size, max_sequence_length, shuffle=False):
+    # The dataset of RNN_final.ipynb
+    padded = tf.keras.utils.pad_sequences(sequences, maxlen=max_sequence_length, padding='post', truncating='post')
+    dataset = tf.data.Dataset.from_tensor_slices((padded, labels))
+    if shuffle:
+        dataset = dataset.shuffle(len(padded))
+    return dataset.batch(batch_size)
+
+
+def train(model, dataset_train, dataset_val, epochs):
+    # (seconds per epoch after the first, validation accuracy of the last epoch)
+    times = []
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            times.append(time.perf_counter() - self.start)
+
+    history = model.fit(dataset_train, validation_data=dataset_val, epochs=epochs, callbacks=[EpochTimer()], verbose=0)
+    return float(np.mean(times[1:] if len(times) > 1 else times)), history.history['val_accuracy'][-1]
+
+
+def sequences_per_sec(predict, sequences, runs=3):
+    predict(sequences[:256])  # Warm up
+    start = time.perf_counter()
+    for _ in range(runs):
+        predict(sequences)
+    return runs * len(sequences) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Notebook padding against bucketed batches for the emotion LSTM')
+    parser.add_argument('--train', type=int, default=16000)
+    parser.add_argument('--val', type=int, default=2000)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=16, help='Training batch size, 16 like the notebook')
+    parser.add_argument('--predict-batch-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    train_sequences, y_train = synthetic_data(args.train, rng)
+    val_sequences, y_val = synthetic_data(args.val, rng)
+    max_sequence_length = max(len(sequence) for sequence in train_sequences)
+    lengths = np.array([len(sequence) for sequence in train_sequences])
+    print(f"Sequence length: mean {lengths.mean():.1f}, max {max_sequence_length}")
+
+    results = {}
+    tf.keras.utils.set_random_seed(args.seed)
+    model = create_model(VOCAB_SIZE, max_sequence_length, mask_zero=False)
+    epoch, accuracy = train(model, fixed_dataset(train_sequences, y_train, args.batch_size, max_sequence_length, True),
+                            fixed_dataset(val_sequences, y_val, args.batch_size, max_sequence_length), args.epochs)
+    throughput = sequences_per_sec(lambda sequences: predict_bucketed(model, sequences, args.predict_batch_size,
+                                                                      max_sequence_length), val_sequences)
+    results['padded to the longest'] = (epoch, accuracy, throughput)
+
+    tf.keras.utils.set_random_seed(args.seed)
+    model = create_model(VOCAB_SIZE)
+    epoch, accuracy = train(model, bucketed_dataset(train_sequences, y_train, args.batch_size, shuffle=True,
+                                                    max_length=max_sequence_length),
+                            bucketed_dataset(val_sequences, y_val, args.batch_size, max_length=max_sequence_length),
+                            args.epochs)
+    throughput = sequences_per_sec(lambda sequences: predict_bucketed(model, sequences, args.predict_batch_size,
+                                                                      max_sequence_length), val_sequences)
+    results['bucketed + mask'] = (epoch, accuracy, throughput)
+
+    # With the mask the padding does not change the predictions: predict one at a time against the sorted batches
+    single = np.concatenate([model.predict(np.array([sequence]), verbose=0) for sequence in val_sequences[:50]])
+    difference = np.abs(single - predict_bucketed(model, val_sequences, args.predict_batch_size)[:50]).max()
+
+    print(f"\n{'':<24}{'s/epoch':>9}{'val acc':>9}{'predict seq/s':>15}")
+    for name, (epoch, accuracy, throughput) in results.items():
+        print(f"{name:<24}{epoch:>9.1f}{accuracy:>9.3f}{throughput:>15.0f}")
+    print(f"Max difference of the bucketed predictions to unpadded ones: {difference:.2e}")
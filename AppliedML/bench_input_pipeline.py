@@ -0,0 +1,65 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from input_pipeline import from_files, make_dataset, IMAGE_SIZE
+
+# Throughput (images/sec) of the input pipeline on synthetic JPEGs, so it runs without the dataset.
+# Compares the per-image PIL resize from eksamenOpgave1.ipynb with input_pipeline.make_dataset,
+# both for the first epoch (decode, resize and write the cache) and for the cached epochs.
+# Run it from the AppliedML folder: python bench_input_pipeline.py --images 1024
+
+
+def write_synthetic_jpegs(directory, count, height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        # Smooth noise compresses more like a photo than white noise
+        small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+        path = os.path.join(directory, f'{i:05d}.jpg')
+        image.save(path, quality=90)
+        paths.append(path)
+    labels = rng.integers(0, 14, count)
+    return paths, labels
+
+
+def pil_baseline(paths):
+    # One image at a time in Python, like resize_images + to_tf_dataset in the notebook
+    start = time.perf_counter()
+    for path in paths:
+        image = Image.open(path).resize((IMAGE_SIZE[1], IMAGE_SIZE[0]), Image.BICUBIC)
+        np.asarray(image, dtype=np.float32)
+    return len(paths) / (time.perf_counter() - start)
+
+
+def epoch_throughput(dataset):
+    start = time.perf_counter()
+    count = 0
+    for images, _ in dataset:
+        count += int(images.shape[0])
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of the input pipeline')
+    parser.add_argument('--images', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=450, help='Height of the synthetic JPEGs')
+    parser.add_argument('--width', type=int, default=600, help='Width of the synthetic JPEGs')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--epochs', type=int, default=3, help='Cached epochs to time after the first one')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths, labels = write_synthetic_jpegs(directory, args.images, args.height, args.width)
+        print(f"{args.images} JPEGs of {args.width}x{args.height} resized to {IMAGE_SIZE[1]}x{IMAGE_SIZE[0]}, {os.cpu_count()} CPUs")
+        print(f"{'pipeline':<35}{'images/sec':>12}")
+        print(f"{'PIL, one image at a time':<35}{pil_baseline(paths):>12.1f}")
+
+        dataset = make_dataset(from_files(paths, labels), args.batch_size, training=True,
+                               cache_path=os.path.join(directory, 'cache', 'train'))
+        print(f"{'tf.data, first epoch':<35}{epoch_throughput(dataset):>12.1f}")
+        cached = [epoch_throughput(dataset) for _ in range(args.epochs)]
+        print(f"{'tf.data, cached epochs':<35}{np.median(cached):>12.1f}")
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import platform
+import resource
+
+# Benchmark and regression check for the four CNN models, on synthetic data so it runs offline.
+# For every model: parameters, FLOPs, train step time and images/sec (float32, without the augmentation layers),
+# inference latency at batch 1 and 64, and the peak memory (max RSS) of the process.
+# Every model runs in its own process (bench_training_modes.run_isolated), so the memory of one does not affect the next.
+# The results are compared with a stored baseline, and the script fails if a model got slower or bigger than the
+# tolerance. The timings depend on the machine, so they are only compared with a baseline made on the same machine
+# (platform, CPUs, TensorFlow version) and batch size. On another machine only the params and FLOPs are compared.
+# To check the timings, make the baseline on the machine that runs the check:
+# python bench_models.py --update-baseline        (write benchmark_baseline.json)
+# python bench_models.py --output results.json    (compare with it)
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# Metric -> True if higher is better. params and flops must match the baseline exactly
+TIMED_METRICS = {'step_ms': False, 'images_per_sec': True, 'latency_ms_batch1': False, 'latency_ms_batch64': False,
+                 'peak_rss_mb': False}
+EXACT_METRICS = ['params', 'flops']
+
+
+def benchmark(name, batch_size, steps, warmup, latency_runs):
+    from bench_training_modes import build, step_time
+    from model_stats import model_stats
+    result = step_time(name, 'float32', batch_size, steps, warmup)
+    stats = model_stats(build(name, 'float32', False), batch_sizes=(1, 64), runs=latency_runs)
+    return {'model': name, 'batch_size': batch_size, **stats, 'step_ms': result['step_ms'],
+            'images_per_sec': result['images_per_sec'],
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def machine():
+    import tensorflow as tf
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'tensorflow': tf.__version__}
+
+
+def regressions(results, baseline, tolerance, timed=True):
+    # Messages for the models that are worse than the baseline. timed=False only compares the params and FLOPs
+    baseline_models = {result['model']: result for result in baseline['results']}
+    messages = []
+    for result in results:
+        reference = baseline_models.get(result['model'])
+        if reference is None:
+            continue
+        for metric in EXACT_METRICS:
+            if result[metric] != reference[metric]:
+                messages.append(f"{result['model']}: {metric} changed from {reference[metric]} to {result[metric]}")
+        for metric, higher_is_better in (TIMED_METRICS.items() if timed else []):
+            change = result[metric] / reference[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                messages.append(f"{result['model']}: {metric} {reference[metric]:.1f} -> {result[metric]:.1f} "
+                                f"({change:+.0%})")
+    return messages
+
+
+if __name__ == '__main__':
+    from bench_training_modes import run_isolated
+    from models import MODEL_FILES
+
+    parser = argparse.ArgumentParser(description='Benchmark of the CNN models, compared with a stored baseline')
+    parser.add_argument('--models', nargs='+', default=list(MODEL_FILES), choices=list(MODEL_FILES))
+    parser.add_argument('--batch-size', type=int, default=32, help='Batch size of the train steps')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--latency-runs', type=int, default=20)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown/growth, 0.2 is 20%%')
+    parser.add_argument('--update-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    print(f"{'model':<18}{'params':>11}{'GFLOPs':>8}{'step ms':>9}{'images/s':>10}{'ms b1':>8}{'ms b64':>9}{'peak MB':>9}")
+    results = []
+    for name in args.models:
+        result = run_isolated(benchmark, name, args.batch_size, args.steps, args.warmup, args.latency_runs)
+        results.append(result)
+        print(f"{name:<18}{result['params']:>11,}{result['flops'] / 1e9:>8.2f}{result['step_ms']:>9.1f}"
+              f"{result['images_per_sec']:>10.1f}{result['latency_ms_batch1']:>8.1f}{result['latency_ms_batch64']:>9.1f}"
+              f"{result['peak_rss_mb']:>9.0f}")
+
+    report = {'machine': machine(), 'batch_size': args.batch_size, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the baseline {args.baseline}")
+    elif not os.path.exists(args.baseline):
+        print(f"No baseline {args.baseline}, run with --update-baseline to make one")
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        timed = baseline['machine'] == report['machine'] and baseline['batch_size'] == args.batch_size
+        if not timed:
+            print(f"The baseline was made with {baseline['machine']}, batch size {baseline['batch_size']}. "
+                  f"Only the params and FLOPs are compared, run with --update-baseline to check the timings here")
+        failed = regressions(results, baseline, args.tolerance, timed)
+        for message in failed:
+            print(f"Regression: {message}")
+        if failed:
+            raise SystemExit(f"{len(failed)} regressions against {args.baseline}")
+        print(f"No regressions against {args.baseline}")
@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Step time and peak memory of the training modes in training_modes.py (float32, mixed bfloat16, with and
+# without XLA) for the four CNN models, on synthetic data on the CPU.
+# Every configuration runs in its own process, so the peak memory (max RSS) is for that configuration only.
+# It also checks the validation accuracy under every precision:
+# - with --weights NAME=PATH, the trained weights are evaluated and compared with the accuracy in the file name of the
+#   model (models.baseline)
+# - without, every precision trains the model from the same seed for --epochs on the same --train-images, and is
+#   compared with the float32 run (a short run does not get near the baseline, which is only shown)
+# The check fails if an accuracy is more than --tolerance percentage points below its reference.
+# Run it from the AppliedML folder: python bench_training_modes.py --batch-sizes 16 32 64 128 --weights ResSE=ResSE.keras
+MODES = {
+    'float32': ('float32', False),
+    'float32+xla': ('float32', True),
+    'bfloat16': ('mixed_bfloat16', False),
+    'bfloat16+xla': ('mixed_bfloat16', True),
+}
+
+
+def build(name, precision, jit_compile):
+    from models import load_model_file
+    # Without the augmentation layers, like training with the augmentation in the input pipeline
+    with contextlib.redirect_stdout(io.StringIO()):  # Hide model.summary()
+        return load_model_file(name).create_model(augment=False, precision=precision, jit_compile=jit_compile)
+
+
+def step_time(name, mode, batch_size, steps, warmup):
+    import numpy as np
+    precision, jit_compile = MODES[mode]
+    model = build(name, precision, jit_compile)
+    rng = np.random.default_rng(0)
+    size = model.input_shape[1]
+    images = rng.uniform(0, 255, (batch_size, size, size, 3)).astype('float32')
+    labels = rng.integers(0, 14, batch_size)
+
+    for _ in range(warmup):  # Tracing and XLA compilation
+        model.train_on_batch(images, labels)
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.train_on_batch(images, labels)
+    seconds = (time.perf_counter() - start) / steps
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+    return {'model': name, 'mode': mode, 'batch_size': batch_size, 'step_ms': seconds * 1000,
+            'images_per_sec': batch_size / seconds, 'peak_rss_mb': peak_mb}
+
+
+def synthetic_data(count, resolution, rng, batch_size=32):
+    # Noise images where the class is the cell (of a 4x4 grid) with a white square somewhere in it,
+    # so a short training run can learn it
+    import numpy as np
+    import tensorflow as tf
+    labels = rng.integers(0, 14, count)
+    images = rng.integers(0, 256, (count, resolution, resolution, 3), dtype=np.uint8)
+    cell = resolution // 4
+    square = cell // 2
+    for image, label in zip(images, labels):
+        row, column = divmod(int(label), 4)
+        top, left = row * cell + rng.integers(0, cell - square), column * cell + rng.integers(0, cell - square)
+        image[top:top + square, left:left + square] = 255
+    dataset = tf.data.Dataset.from_tensor_slices((images, labels)).batch(batch_size)
+    return dataset.map(lambda images, labels: (tf.cast(images, tf.float32), labels))
+
+
+def fixed_data(resolution, train_images, seed, cache_dir, synthetic):
+    # (train, validation) data that is the same in every process: a fixed sample of the training images in a fixed
+    # order, and the validation split
+    if synthetic:
+        import numpy as np
+        rng = np.random.default_rng(seed)
+        return synthetic_data(train_images, resolution, rng), synthetic_data(256, resolution, rng)
+    from input_pipeline import load_skin_lesion_splits, load_train_sample
+    _, validation, _ = load_skin_lesion_splits(cache_dir=cache_dir, image_size=(resolution, resolution))
+    return load_train_sample(train_images, seed, image_size=(resolution, resolution)), validation
+
+
+def precision_accuracy(name, precision, weights, epochs, train_images, seed, cache_dir, synthetic):
+    # Validation accuracy (%) and loss of the model under a precision, with the trained weights from the file weights,
+    # or else after training it from seed for a few epochs
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(seed)
+    model = build(name, precision, False)
+    train_data, validation_data = fixed_data(model.input_shape[1], train_images, seed, cache_dir, synthetic)
+    if weights:
+        from export_model import copy_weights, load_trained
+        copy_weights(load_trained(name, weights), model)
+    else:
+        model.fit(train_data, epochs=epochs, shuffle=False, verbose=0)
+    loss, accuracy = model.evaluate(validation_data, verbose=0)
+    return {'model': name, 'precision': precision, 'weights': weights, 'val_accuracy': accuracy * 100,
+            'val_loss': loss}
+
+
+def run_isolated(function, *args):
+    # Run function in a fresh process, so the memory and the Keras state of one configuration do not affect the next
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(function, *args).result()
+
+
+if __name__ == '__main__':
+    from models import MODEL_FILES, baseline
+    from training_modes import cpu_supports_bfloat16
+
+    parser = argparse.ArgumentParser(description='Step time and peak memory of the training modes')
+    parser.add_argument('--models', nargs='+', default=list(MODEL_FILES), choices=list(MODEL_FILES))
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[16, 32, 64, 128])
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--weights', nargs='+', default=[], metavar='NAME=PATH',
+                        help='Trained models (.keras/.h5) or weights (.weights.h5) to evaluate, e.g. ResSE=ResSE.keras')
+    parser.add_argument('--epochs', type=int, default=2, help='Epochs of the training run of the models without --weights')
+    parser.add_argument('--train-images', type=int, default=512, help='Training images of that run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='Allowed drop in validation accuracy, in percentage points')
+    parser.add_argument('--cache-dir', default='tf_cache')
+    parser.add_argument('--synthetic', action='store_true', help='Learnable synthetic images instead of the dataset')
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    weights = dict(weight.split('=', 1) for weight in args.weights)
+
+    print(f"Native bfloat16 on this CPU: {cpu_supports_bfloat16()}")
+    print(f"{'model':<18}{'mode':<14}{'batch':>6}{'step ms':>10}{'images/s':>10}{'peak MB':>10}")
+    results = []
+    for name in args.models:
+        for batch_size in args.batch_sizes:
+            for mode in args.modes:
+                result = run_isolated(step_time, name, mode, batch_size, args.steps, args.warmup)
+                results.append(result)
+                print(f"{name:<18}{mode:<14}{batch_size:>6}{result['step_ms']:>10.1f}"
+                      f"{result['images_per_sec']:>10.1f}{result['peak_rss_mb']:>10.0f}")
+
+    # float32 first, it is the reference of the training runs
+    precisions = ['float32'] + sorted({MODES[mode][0] for mode in args.modes} - {'float32'})
+    print(f"\n{'model':<18}{'precision':<16}{'weights':<9}{'val acc %':>10}{'val loss':>10}"
+          f"{'baseline':>10}{'reference':>11}")
+    accuracies = []
+    failed = []
+    for name in args.models:
+        baseline_accuracy = baseline(name)[0]
+        reference = baseline_accuracy if name in weights else None
+        for precision in precisions:
+            result = run_isolated(precision_accuracy, name, precision, weights.get(name), args.epochs,
+                                  args.train_images, args.seed, args.cache_dir, args.synthetic)
+            if reference is None:
+                reference = result['val_accuracy']  # The float32 training run
+            result['reference_accuracy'] = reference
+            accuracies.append(result)
+            if result['val_accuracy'] < reference - args.tolerance:
+                failed.append(f"{name} {precision}")
+            print(f"{name:<18}{precision:<16}{'trained' if name in weights else 'run':<9}{result['val_accuracy']:>10.2f}"
+                  f"{result['val_loss']:>10.4f}{baseline_accuracy:>10.2f}{reference:>11.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'step_times': results, 'accuracy': accuracies}, f, indent=2)
+    if failed:
+        raise SystemExit(f"More than {args.tolerance} percentage points below the reference accuracy: {', '.join(failed)}")
@@ -0,0 +1,191 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Compound-scaling search for the EffNet model (model81.08_0.5469-EffNet.py).
+# create_model(phi, coefficients=(a, b, g)) scales the width by a^phi, the depth by b^phi and the resolution by g^phi.
+# The model file limits the input size to 224 (the size it was trained at), which makes every g > 1 a no-op, so the
+# search lifts the limit (--max-resolution). Combinations that give the same model after the rounding and the limits
+# are only kept once.
+# The search:
+# 1. measures the parameters, FLOPs and CPU latency (batch 1) of every candidate, which only needs the untrained model,
+# 2. drops the candidates over the FLOPs or latency budget,
+# 3. trains the rest for a few epochs in a process pool and ranks them by validation accuracy per ms of latency.
+# Run it from the AppliedML folder:
+# python effnet_search.py --phis 0 0.5 1 --max-latency-ms 40 --epochs 3 --workers 2
+DEFAULT_ALPHAS = [1.1, 1.2, 1.3]
+DEFAULT_BETAS = [1.0, 1.1, 1.2]
+DEFAULT_GAMMAS = [1.0, 1.15]
+
+
+def build(phi, coefficients, augment=True, max_resolution=None):
+    from models import load_model_file
+    with contextlib.redirect_stdout(io.StringIO()):  # Hide model.summary()
+        return load_model_file('EffNet').create_model(phi=phi, augment=augment, coefficients=coefficients,
+                                                      max_resolution=max_resolution)
+
+
+def relative_flops(scaling, base):
+    # FLOPs of the residual stages of a (widths, depths, resolution) relative to base. Every block is two 3x3
+    # convolutions (width^2 multiplications per pixel each) and every stage halves the feature map
+    def flops(widths, depths, resolution):
+        return sum(depth * width ** 2 * resolution ** 2 / 4 ** stage
+                   for stage, (width, depth) in enumerate(zip(widths, depths)))
+    return flops(*scaling) / flops(*base)
+
+
+def candidates(phis, alphas, betas, gammas, flops_ratio=None, tolerance=0.25, max_resolution=None):
+    # The combinations that give different models. With flops_ratio, only the ones where phi + 1 multiplies the FLOPs
+    # by about flops_ratio are kept (the EfficientNet constraint), computed from the widths, depths and resolution the
+    # model really gets
+    from models import load_model_file
+    effnet = load_model_file('EffNet')
+    base = effnet.scaling(0, (1, 1, 1))
+    seen = set()
+    warned = set()
+    for phi, alpha, beta, gamma in itertools.product(phis, alphas, betas, gammas):
+        scaling = effnet.scaling(phi, (alpha, beta, gamma), max_resolution)
+        if phi != 0 and gamma != 1 and (phi, gamma) not in warned \
+                and scaling[2] == effnet.scaling(phi, (alpha, beta, 1), max_resolution)[2]:
+            warned.add((phi, gamma))
+            print(f"Warning: gamma={gamma} has no effect at phi={phi}, the input size is limited to {scaling[2]}px "
+                  f"(--max-resolution)")
+        if scaling in seen:
+            continue
+        seen.add(scaling)
+        if flops_ratio is not None and phi != 0 \
+                and abs(relative_flops(scaling, base) ** (1 / phi) - flops_ratio) > tolerance:
+            continue
+        yield {'phi': phi, 'coefficients': (alpha, beta, gamma), 'max_resolution': max_resolution}
+
+
+def measure(candidate, latency_runs):
+    # Parameters, FLOPs and latency of the untrained model. Runs in a separate process
+    from model_stats import model_stats
+    model = build(candidate['phi'], candidate['coefficients'], augment=False,
+                  max_resolution=candidate['max_resolution'])
+    stats = model_stats(model, batch_sizes=(1,), runs=latency_runs)
+    return {**candidate, 'resolution': model.input_shape[1], **stats}
+
+
+def train(candidate, epochs, steps_per_epoch, validation_steps, cache_dir, threads, synthetic):
+    # Short training of one candidate. Returns the candidate with its validation accuracy
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+    resolution = candidate['resolution']
+    train_data, validation_data = datasets(resolution, cache_dir, synthetic)
+    model = build(candidate['phi'], candidate['coefficients'], augment=False,
+                  max_resolution=candidate['max_resolution'])
+    # Without a step count an epoch is one pass over the data. With one, the data is repeated so every epoch
+    # gets its steps
+    if steps_per_epoch is not None:
+        train_data = train_data.repeat()
+    if validation_steps is not None:
+        validation_data = validation_data.repeat()
+    history = model.fit(train_data, validation_data=validation_data, epochs=epochs,
+                        steps_per_epoch=steps_per_epoch, validation_steps=validation_steps, verbose=0)
+    accuracy = max(history.history['val_accuracy'])
+    return {**candidate, 'val_accuracy': accuracy, 'accuracy_per_ms': accuracy / candidate['latency_ms_batch1']}
+
+
+def datasets(resolution, cache_dir, synthetic):
+    # Train (augmented in the pipeline) and validation data at the resolution of a candidate
+    if synthetic:
+        import numpy as np
+        import tensorflow as tf
+        rng = np.random.default_rng(0)
+        images = rng.uniform(0, 255, (64, resolution, resolution, 3)).astype('float32')
+        labels = rng.integers(0, 14, 64)
+        data = tf.data.Dataset.from_tensor_slices((images, labels)).batch(16)
+        return data, data
+    from input_pipeline import load_skin_lesion_splits
+    train_data, validation_data, _ = load_skin_lesion_splits(cache_dir=cache_dir, image_size=(resolution, resolution), augment=True)
+    return train_data, validation_data
+
+
+def warm_cache(resolution, cache_dir):
+    # Fill the on-disk cache of a resolution once, before the workers read it at the same time
+    train_data, validation_data = datasets(resolution, cache_dir, synthetic=False)
+    for _ in train_data:
+        pass
+    for _ in validation_data:
+        pass
+
+
+def run_isolated(pool_size, function, jobs):
+    # Run function(*job) for every job in spawned processes, and yield the results as they are done
+    with ProcessPoolExecutor(max_workers=pool_size, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(function, *job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compound-scaling search for the EffNet model')
+    parser.add_argument('--phis', nargs='+', type=float, default=[0.0, 0.5, 1.0])
+    parser.add_argument('--alphas', nargs='+', type=float, default=DEFAULT_ALPHAS, help='Width coefficients')
+    parser.add_argument('--betas', nargs='+', type=float, default=DEFAULT_BETAS, help='Depth coefficients')
+    parser.add_argument('--gammas', nargs='+', type=float, default=DEFAULT_GAMMAS, help='Resolution coefficients')
+    parser.add_argument('--flops-ratio', type=float, default=None,
+                        help='Keep only the models where phi + 1 multiplies the FLOPs by about this (e.g. 2)')
+    parser.add_argument('--max-resolution', type=int, default=None,
+                        help='Largest input size (default: no limit; the model file itself stops at 224)')
+    parser.add_argument('--max-gflops', type=float, default=None, help='FLOPs budget per image')
+    parser.add_argument('--max-latency-ms', type=float, default=None, help='Latency budget at batch 1')
+    parser.add_argument('--latency-runs', type=int, default=20)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--steps-per-epoch', type=int, default=None, help='Default: one pass over the training data')
+    parser.add_argument('--validation-steps', type=int, default=None, help='Default: the whole validation data')
+    parser.add_argument('--workers', type=int, default=2, help='Trainings that run at the same time')
+    parser.add_argument('--cache-dir', default='tf_cache')
+    parser.add_argument('--synthetic', action='store_true', help='Train on random data, to test the search itself')
+    parser.add_argument('--output', default='effnet_search.json')
+    args = parser.parse_args()
+
+    grid = list(candidates(args.phis, args.alphas, args.betas, args.gammas, args.flops_ratio,
+                           max_resolution=args.max_resolution))
+    print(f"{len(grid)} different candidates")
+
+    # 1. Measure. One process at a time, so the latencies are not disturbed by each other
+    measured = list(run_isolated(1, measure, [(candidate, args.latency_runs) for candidate in grid]))
+
+    # 2. Prune
+    survivors = []
+    for candidate in sorted(measured, key=lambda candidate: candidate['latency_ms_batch1']):
+        over_flops = args.max_gflops is not None and candidate['flops'] / 1e9 > args.max_gflops
+        over_latency = args.max_latency_ms is not None and candidate['latency_ms_batch1'] > args.max_latency_ms
+        candidate['pruned'] = over_flops or over_latency
+        if not candidate['pruned']:
+            survivors.append(candidate)
+        print(f"phi={candidate['phi']:<5} a,b,g={candidate['coefficients']} {candidate['resolution']}px "
+              f"{candidate['params'] / 1e6:.2f}M params {candidate['flops'] / 1e9:.2f} GFLOPs "
+              f"{candidate['latency_ms_batch1']:.1f} ms{' (pruned)' if candidate['pruned'] else ''}")
+    print(f"{len(survivors)} candidates within the budget")
+
+    # 3. Train the survivors
+    if not args.synthetic:
+        for resolution in sorted({candidate['resolution'] for candidate in survivors}):
+            warm_cache(resolution, args.cache_dir)
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    jobs = [(candidate, args.epochs, args.steps_per_epoch, args.validation_steps, args.cache_dir, threads, args.synthetic)
+            for candidate in survivors]
+    trained = []
+    for result in run_isolated(args.workers, train, jobs):
+        trained.append(result)
+        print(f"phi={result['phi']} a,b,g={result['coefficients']}: val_accuracy {result['val_accuracy']:.4f}, "
+              f"{result['accuracy_per_ms']:.4f} accuracy per ms")
+
+    trained.sort(key=lambda result: result['accuracy_per_ms'], reverse=True)
+    with open(args.output, 'w') as f:
+        json.dump({'trained': trained, 'measured': measured}, f, indent=2)
+    if trained:
+        best = trained[0]
+        print(f"Best: phi={best['phi']} coefficients={best['coefficients']} "
+              f"({best['val_accuracy']:.4f} accuracy, {best['latency_ms_batch1']:.1f} ms). Saved {args.output}")
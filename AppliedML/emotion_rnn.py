@@ -0,0 +1,89 @@
+import numpy as np
+import tensorflow as tf
+
+# Length-bucketed batches for the bidirectional LSTM emotion model (RNN_final.ipynb).
+# The notebook pads every sequence to the longest training sequence, so the four LSTMs mostly run over padding for
+# short tweets. Here the sequences are grouped by length (tf.data bucket_by_sequence_length) and every batch is only
+# padded to its own longest sequence. The model needs Input(shape=(None,)) and Embedding(mask_zero=True), so the
+# padding is masked and the output does not depend on how much padding a batch has.
+# A model trained without the mask (the old RNN_final.h5) still needs the fixed padding: predict_bucketed uses it
+# when the model has a fixed input length.
+# Usage:
+# from emotion_rnn import bucketed_dataset, predict_bucketed
+# dataset_train = bucketed_dataset(train_sequences, y_train_cat, batch_size=16, shuffle=True)
+# predictions = predict_bucketed(model, sequences, max_sequence_length=max_sequence_length)
+
+
+def create_model(vocab_size, sequence_length=None, mask_zero=True):
+    # The model of RNN_final.ipynb. sequence_length=None and mask_zero=True for bucketed batches,
+    # sequence_length=max_sequence_length and mask_zero=False for the model as it was
+    def lstm(name, return_sequences, go_backwards=False):
+        return tf.keras.layers.LSTM(64, recurrent_dropout=0.5, return_sequences=return_sequences, return_state=False,
+                                    recurrent_activation='sigmoid', go_backwards=go_backwards, name=name)
+
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input(shape=(sequence_length,), name="Input"),
+        tf.keras.layers.Embedding(input_dim=vocab_size, output_dim=100, mask_zero=mask_zero, name="Embedding"),
+        tf.keras.layers.Bidirectional(layer=lstm("LSTM1", True), backward_layer=lstm("LSTM2", True, True),
+                                      merge_mode='concat', name='GRU_bi1'),
+        tf.keras.layers.Bidirectional(layer=lstm("LSTM3", False), backward_layer=lstm("LSTM4", False, True),
+                                      merge_mode='concat', name='GRU_bi2'),
+        tf.keras.layers.Dense(32, activation='relu', name="Dense3"),
+        tf.keras.layers.Dense(6, activation='softmax', name="DenseLast")
+    ])
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=0.0005), loss='categorical_crossentropy',
+                  metrics=['accuracy', tf.keras.metrics.Precision(), tf.keras.metrics.Recall()])
+    return model
+
+
+def truncate(sequences, max_length=None):
+    # Like pad_sequences(..., truncating='post') without the padding. An empty sequence becomes one padding token,
+    # so no batch has length 0
+    return [list(sequence[:max_length]) or [0] for sequence in sequences]
+
+
+def bucket_boundaries(lengths, buckets=8):
+    # Boundaries for bucket_by_sequence_length with about the same number of sequences in every bucket
+    quantiles = np.percentile(lengths, np.linspace(0, 100, buckets + 1)[1:-1])
+    return sorted(set(int(quantile) + 1 for quantile in quantiles))
+
+
+def sequence_dataset(sequences, labels=None):
+    # A dataset of the unpadded sequences (and labels). They are stored padded and cut to their length in map
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int32)
+    padded = tf.keras.utils.pad_sequences(sequences, maxlen=int(lengths.max()), padding='post', dtype='int32')
+    if labels is None:
+        return tf.data.Dataset.from_tensor_slices((padded, lengths)).map(lambda sequence, length: sequence[:length])
+    return tf.data.Dataset.from_tensor_slices((padded, lengths, labels)).map(
+        lambda sequence, length, label: (sequence[:length], label))
+
+
+def bucketed_dataset(sequences, labels=None, batch_size=16, boundaries=None, buckets=8, shuffle=False,
+                     drop_remainder=False, max_length=None):
+    # Batches of (padded sequences, labels), padded per batch. The batches come in a different order than the
+    # sequences, so use predict_bucketed to predict
+    sequences = truncate(sequences, max_length)
+    if boundaries is None:
+        boundaries = bucket_boundaries([len(sequence) for sequence in sequences], buckets)
+    dataset = sequence_dataset(sequences, labels)
+    if shuffle:
+        dataset = dataset.shuffle(len(sequences))
+    dataset = dataset.bucket_by_sequence_length(lambda sequence, *_: tf.shape(sequence)[0], boundaries,
+                                                [batch_size] * (len(boundaries) + 1), drop_remainder=drop_remainder)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def predict_bucketed(model, sequences, batch_size=64, max_sequence_length=None, verbose=0):
+    # model.predict of the sequences, in their order. The sequences are sorted by length and every batch is padded to
+    # its longest sequence. A model with a fixed input length gets all the sequences padded to it like in BlueSky3
+    sequences = truncate(sequences, max_sequence_length)
+    if model.input_shape[1] is not None:
+        padded = tf.keras.utils.pad_sequences(sequences, maxlen=model.input_shape[1], padding='post',
+                                              truncating='post')
+        return model.predict(padded, batch_size=batch_size, verbose=verbose)
+    order = np.argsort([len(sequence) for sequence in sequences], kind='stable')
+    dataset = sequence_dataset([sequences[i] for i in order]).padded_batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    predictions = model.predict(dataset, verbose=verbose)
+    result = np.empty_like(predictions)
+    result[order] = predictions
+    return result
@@ -0,0 +1,62 @@
+import argparse
+import os
+import tensorflow as tf
+from tensorflow.keras import layers
+from models import MODEL_FILES, load_model_file
+
+# Export a trained model for inference, without the RandomRotation/RandomFlip layers.
+# The augmentation layers do nothing at inference, but they are still part of the saved graph.
+# Run it from the AppliedML folder:
+# python export_model.py --model ResSE --weights ResSE.keras --output ResSE_inference.keras
+AUGMENTATION_LAYERS = (layers.RandomRotation, layers.RandomFlip)
+
+
+def build_model(name, augment=True, phi=None):
+    module = load_model_file(name)
+    if phi is not None:
+        return module.create_model(phi=phi, augment=augment)
+    return module.create_model(augment=augment)
+
+
+def copy_weights(source, target, skip=AUGMENTATION_LAYERS):
+    # Copy the weights layer by layer. The layers of source that are instances of skip are left out,
+    # the other layers must be the same as in target and in the same order
+    source_layers = [layer for layer in source.layers if not isinstance(layer, (layers.InputLayer, *skip))]
+    target_layers = [layer for layer in target.layers if not isinstance(layer, layers.InputLayer)]
+    if len(source_layers) != len(target_layers):
+        raise ValueError(f"The models have {len(source_layers)} and {len(target_layers)} layers")
+    for source_layer, target_layer in zip(source_layers, target_layers):
+        if type(source_layer) is not type(target_layer):
+            raise ValueError(f"Layer {source_layer.name} ({type(source_layer).__name__}) does not match "
+                             f"{target_layer.name} ({type(target_layer).__name__})")
+        target_layer.set_weights(source_layer.get_weights())
+    return target
+
+
+def inference_model(model, name, phi=None):
+    # A copy of the trained model without the augmentation layers
+    return copy_weights(model, build_model(name, augment=False, phi=phi))
+
+
+def load_trained(name, path, phi=None):
+    # A saved model (.keras/.h5), or weights (.weights.h5) for create_model()
+    if path.endswith('.weights.h5'):
+        model = build_model(name, augment=True, phi=phi)
+        model.load_weights(path)
+        return model
+    return tf.keras.models.load_model(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained model without the augmentation layers')
+    parser.add_argument('--model', choices=list(MODEL_FILES), required=True)
+    parser.add_argument('--weights', required=True, help='Trained model (.keras/.h5) or weights (.weights.h5)')
+    parser.add_argument('--output', required=True, help='Where to save the inference model (.keras)')
+    parser.add_argument('--phi', type=float, default=None, help='phi of the EffNet model')
+    args = parser.parse_args()
+
+    model = load_trained(args.model, args.weights, args.phi)
+    inference = inference_model(model, args.model, args.phi)
+    inference.save(args.output)
+    print(f"Saved {args.output}: {len(model.layers)} -> {len(inference.layers)} layers, "
+          f"{os.path.getsize(args.output) / 1e6:.1f} MB")
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+from input_pipeline import decode_image
+
+# Local inference service for the skin lesion CNNs and the emotion RNN.
+# Every model has a MicroBatcher: the requests are put in a queue, and each worker thread (with its own copy of the
+# model, loaded once at startup) takes up to --max-batch-size of them, waiting at most --max-wait-ms after the first
+# one, and predicts them as one batch. The top-k classes are computed for the whole batch at once.
+# Endpoints:
+# POST /predict/<image model>  body: a JPEG/PNG image      -> {"class": 3, "top_k": [{"class": 3, "probability": 0.81}, ...]}
+# POST /predict/emotion        body: {"texts": ["..."]}    -> {"predictions": [{"class": 1, "label": "joy", "top_k": [...]}]}
+# GET  /stats                  requests, batches and mean batch size per model
+# Run it from the AppliedML folder:
+# python inference_server.py --image-model ResSE=ResSE.keras --emotion-model-dir . --max-wait-ms 5
+# and measure it with load_generator.py
+
+
+def top_k(probabilities, k):
+    # (classes, probabilities) of the k most likely classes of every row, most likely first
+    k = min(k, probabilities.shape[1])
+    classes = np.argpartition(-probabilities, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(probabilities, classes, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(classes, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+class MicroBatcher:
+    # Coalesces single requests to one model into micro-batches
+    def __init__(self, load_model, workers=1, max_batch_size=32, max_wait_ms=5, k=3, labels=None):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.k = k
+        self.labels = labels
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        models = [load_model() for _ in range(workers)]
+        self.input_shape = models[0].input_shape[1:]
+        self.threads = [threading.Thread(target=self._work, args=(model,), daemon=True) for model in models]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, item):
+        # Future with the prediction of one input (one image or one padded sequence)
+        future = Future()
+        self.queue.put((item, future, time.perf_counter()))
+        return future
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'batches': self.batches,
+                    'mean_batch_size': self.requests / self.batches if self.batches else 0.0}
+
+    def _next_batch(self):
+        # Wait for the first request, then take more until the batch is full or max_wait has passed since it arrived
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:  # stop(): let the other workers see it too
+                self.queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _work(self, model):
+        signature = tf.TensorSpec((None, *model.input_shape[1:]), model.inputs[0].dtype)
+        predict = tf.function(lambda inputs: model(inputs, training=False), input_signature=[signature])
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            futures = [future for _, future, _ in batch]
+            try:
+                probabilities = predict(np.stack([item for item, _, _ in batch])).numpy()
+                classes, scores = top_k(probabilities, self.k)
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            with self.lock:
+                self.requests += len(batch)
+                self.batches += 1
+            for future, row_classes, row_scores in zip(futures, classes.tolist(), scores.tolist()):
+                prediction = {'class': row_classes[0],
+                              'top_k': [{'class': c, 'probability': p} for c, p in zip(row_classes, row_scores)]}
+                if self.labels:
+                    prediction['label'] = self.labels[row_classes[0]]
+                future.set_result(prediction)
+
+
+def image_model_loader(name, path, phi=None):
+    # Trained image model for inference: float32, without Dropout/augmentation and with BatchNorm folded (quantize_model.py)
+    def load():
+        from export_model import load_trained
+        from quantize_model import fold_batch_norm
+        return fold_batch_norm(load_trained(name, path, phi))[0]
+    return load
+
+
+def load_emotion_model(directory):
+    # (model loader, tokenizer, max_sequence_length) from the files saved by RNN_final.ipynb
+    with open(os.path.join(directory, 'tokenizer.pkl'), 'rb') as f:
+        tokenizer = pickle.load(f)
+    with open(os.path.join(directory, 'max_sequence_length.pkl'), 'rb') as f:
+        max_sequence_length = pickle.load(f)
+    return (lambda: tf.keras.models.load_model(os.path.join(directory, 'RNN_final.h5'), compile=False),
+            tokenizer, max_sequence_length)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # self.server.image_models: {name: MicroBatcher}, self.server.emotion: (MicroBatcher, tokenizer, max_sequence_length)
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so the clients do not open a connection per request
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.respond(404, {'error': f'Unknown path {self.path}'})
+        batchers = dict(self.server.image_models)
+        if self.server.emotion:
+            batchers['emotion'] = self.server.emotion[0]
+        self.respond(200, {name: batcher.stats() for name, batcher in batchers.items()})
+
+    def do_POST(self):
+        name = self.path.removeprefix('/predict/')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if name == 'emotion' and self.server.emotion:
+                self.respond(200, {'predictions': self.predict_emotion(json.loads(body))})
+            elif name in self.server.image_models:
+                self.respond(200, self.predict_image(self.server.image_models[name], body))
+            else:
+                self.respond(404, {'error': f'Unknown model {name}'})
+        except (ValueError, KeyError, tf.errors.InvalidArgumentError) as error:
+            self.respond(400, {'error': str(error)})
+
+    def predict_image(self, batcher, body):
+        image, _ = decode_image(body, 0, batcher.input_shape[:2])
+        return batcher.submit(tf.cast(image, tf.float32).numpy()).result()
+
+    def predict_emotion(self, request):
+        from text_preprocessing import encode_texts  # nltk is only needed for the emotion model
+        batcher, tokenizer, max_sequence_length = self.server.emotion
+        texts = request['texts'] if 'texts' in request else [request['text']]
+        futures = [batcher.submit(sequence) for sequence in encode_texts(texts, tokenizer, max_sequence_length)]
+        return [future.result() for future in futures]
+
+    def respond(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per request is too much under load
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # The default of 5 resets connections when many clients connect at the same time
+
+
+def create_server(port, image_models, emotion_model_dir=None, workers=1, max_batch_size=32, max_wait_ms=5, k=3):
+    # image_models: {name: model loader}, e.g. {'ResSE': image_model_loader('ResSE', 'ResSE.keras')}
+    server = InferenceServer(('', port), InferenceHandler)
+    server.image_models = {name: MicroBatcher(load, workers, max_batch_size, max_wait_ms, k)
+                           for name, load in image_models.items()}
+    server.emotion = None
+    if emotion_model_dir:
+        from text_preprocessing import EMOTIONS
+        load, tokenizer, max_sequence_length = load_emotion_model(emotion_model_dir)
+        server.emotion = (MicroBatcher(load, workers, max_batch_size, max_wait_ms, k, labels=EMOTIONS),
+                          tokenizer, max_sequence_length)
+    return server
+
+
+if __name__ == '__main__':
+    from models import MODEL_FILES
+
+    parser = argparse.ArgumentParser(description='Inference service with dynamic batching')
+    parser.add_argument('--image-model', action='append', default=[], metavar='NAME=PATH',
+                        help=f"Trained image model to serve, NAME is one of {', '.join(MODEL_FILES)}. Can be repeated")
+    parser.add_argument('--phi', type=float, default=None, help='phi of the EffNet model')
+    parser.add_argument('--emotion-model-dir', default=None,
+                        help='Folder with RNN_final.h5, tokenizer.pkl and max_sequence_length.pkl')
+    parser.add_argument('--workers', type=int, default=1, help='Worker threads (copies of the model) per model')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='Longest time a request waits for a batch to fill')
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8500)
+    args = parser.parse_args()
+
+    image_models = {}
+    for option in args.image_model:
+        name, path = option.split('=', 1)
+        if name not in MODEL_FILES:
+            parser.error(f"Unknown model {name}")
+        image_models[name] = image_model_loader(name, path, args.phi if name == 'EffNet' else None)
+    if not image_models and not args.emotion_model_dir:
+        parser.error('Give at least one --image-model or --emotion-model-dir')
+
+    server = create_server(args.port, image_models, args.emotion_model_dir, args.workers, args.max_batch_size,
+                           args.max_wait_ms, args.top_k)
+    print(f"Serving {', '.join([*image_models, *(['emotion'] if server.emotion else [])])} on port {args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,106 @@
+import os
+import tensorflow as tf
+from augmentation import augment_dataset
+
+# Shared tf.data input pipeline for the CNN models (model*.py).
+# The images are decoded and resized in parallel by tf.data instead of one by one with PIL, the resized
+# images are cached on disk after the first epoch, and the next batches are prepared while the model trains.
+# Usage:
+# from input_pipeline import load_skin_lesion_splits
+# train, validation, test = load_skin_lesion_splits(cache_dir='tf_cache')
+# model.fit(train, validation_data=validation, epochs=100, callbacks=[callbacks()])
+
+IMAGE_SIZE = (224, 224)  # The input size of create_model()
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def decode_image(image_bytes, label, image_size=IMAGE_SIZE):
+    # Decode a JPEG/PNG and resize it like PIL's Image.BICUBIC (antialias when downscaling)
+    image = tf.io.decode_image(image_bytes, channels=3, expand_animations=False)
+    image = tf.image.resize(image, image_size, method='bicubic', antialias=True)
+    # Bicubic overshoots, so clip and round to uint8 like PIL. uint8 also takes 4x less space in the cache
+    image = tf.cast(tf.round(tf.clip_by_value(image, 0, 255)), tf.uint8)
+    return image, label
+
+
+def from_files(paths, labels):
+    # (encoded image, label) pairs from image files. The files are read in parallel
+    dataset = tf.data.Dataset.from_tensor_slices((list(paths), list(labels)))
+    return dataset.map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=AUTOTUNE)
+
+
+def from_hf_split(split):
+    # (encoded image, label) pairs from a HuggingFace image dataset split, e.g. dataset['train'].
+    # The images are not decoded in Python, only the bytes are passed on to tf.data
+    from datasets import Image
+
+    split = split.cast_column('image', Image(decode=False))
+
+    def generate():
+        for row in split:
+            image = row['image']
+            if image['bytes'] is None:
+                with open(image['path'], 'rb') as f:
+                    image = {'bytes': f.read()}
+            yield image['bytes'], row['label']
+
+    return tf.data.Dataset.from_generator(generate, output_signature=(
+        tf.TensorSpec(shape=(), dtype=tf.string),
+        tf.TensorSpec(shape=(), dtype=tf.int64)))
+
+
+def make_dataset(source, batch_size=32, training=False, cache_path=None, image_size=IMAGE_SIZE,
+                 shuffle_buffer=2048, seed=None, augment=False):
+    # Batches of (float32 images in 0-255, labels) for model.fit/evaluate.
+    # source gives (encoded image, label) pairs, see from_files and from_hf_split.
+    # augment=True adds the RandomRotation/RandomFlip stage from augmentation.py, for models built with augment=False.
+    # cache_path is the file prefix of the on-disk cache of the resized images ('' caches in memory, None disables it).
+    # The cache is only complete after a full pass over the data, so do not stop the first epoch early
+    dataset = source.map(lambda image, label: decode_image(image, label, image_size),
+                         num_parallel_calls=AUTOTUNE, deterministic=not training)
+    if cache_path is not None:
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        dataset = dataset.cache(cache_path)
+    if training:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, num_parallel_calls=AUTOTUNE, deterministic=not training)
+    # The models take float inputs without rescaling, the same as the images from to_tf_dataset
+    dataset = dataset.map(lambda images, labels: (tf.cast(images, tf.float32), labels), num_parallel_calls=AUTOTUNE)
+    if augment:
+        dataset = augment_dataset(dataset)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def load_skin_lesion_dataset(data_dir=None):
+    # The HuggingFace dataset used in eksamenOpgave1.ipynb
+    from datasets import load_dataset, DownloadMode
+
+    return load_dataset(
+        "ahmed-ai/skin-lesions-classification-dataset",
+        cache_dir=data_dir,
+        download_mode=DownloadMode.REUSE_DATASET_IF_EXISTS
+    )
+
+
+def load_skin_lesion_splits(cache_dir='tf_cache', batch_size=32, test_batch_size=128, image_size=IMAGE_SIZE, data_dir=None,
+                            augment=False):
+    # Train, validation and test datasets for the skin lesion dataset used in eksamenOpgave1.ipynb.
+    # augment=True augments the training data in the pipeline, see make_dataset
+    dataset = load_skin_lesion_dataset(data_dir)
+    size = f'{image_size[0]}x{image_size[1]}'
+    train = make_dataset(from_hf_split(dataset['train']), batch_size, training=True,
+                         cache_path=os.path.join(cache_dir, f'train_{size}'), image_size=image_size, augment=augment)
+    validation = make_dataset(from_hf_split(dataset['validation']), batch_size,
+                              cache_path=os.path.join(cache_dir, f'validation_{size}'), image_size=image_size)
+    test = make_dataset(from_hf_split(dataset['test']), test_batch_size,
+                        cache_path=os.path.join(cache_dir, f'test_{size}'), image_size=image_size)
+    return train, validation, test
+
+
+def load_train_sample(images, seed=0, batch_size=32, image_size=IMAGE_SIZE, data_dir=None):
+    # A random sample of the training images that is the same for a seed, in the same order in every epoch,
+    # e.g. to train a model the same way in several runs. It is cached in memory
+    train = load_skin_lesion_dataset(data_dir)['train']
+    sample = train.shuffle(seed=seed).select(range(min(images, len(train))))
+    return make_dataset(from_hf_split(sample), batch_size, cache_path='', image_size=image_size)
@@ -0,0 +1,104 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+import numpy as np
+
+# Load test for inference_server.py. For every concurrency level, that many clients send requests one after the
+# other for --duration seconds (each client waits for its answer before the next request).
+# Prints the throughput, the p50/p99 latency and the mean batch size the server made.
+# Run it from the AppliedML folder, with the server running:
+# python load_generator.py --model ResSE --concurrency 1 4 16 64
+SAMPLE_TEXTS = [
+    'i feel so happy and grateful for all the support today',
+    'this is the worst day, everything keeps going wrong and i am furious',
+    'i am a little scared about the results tomorrow',
+    'i miss you so much, the house feels empty without you',
+    'wow i did not expect that at all',
+    'i love spending the evening with my family',
+]
+
+
+def payloads(model, image_size):
+    # (request bodies, content type). The clients send the bodies in turn
+    if model == 'emotion':
+        return [json.dumps({'text': text}).encode() for text in SAMPLE_TEXTS], 'application/json'
+    import tensorflow as tf
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (4, image_size, image_size, 3), dtype=np.uint8)
+    return [tf.io.encode_jpeg(image).numpy() for image in images], 'image/jpeg'
+
+
+def get_stats(host, port):
+    connection = http.client.HTTPConnection(host, port)
+    connection.request('GET', '/stats')
+    return json.loads(connection.getresponse().read())
+
+
+def client(host, port, model, bodies, content_type, stop_at, latencies, errors):
+    # Send requests until stop_at. The latencies in ms are appended to latencies
+    connection = http.client.HTTPConnection(host, port)
+    sent = 0
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        try:
+            connection.request('POST', f'/predict/{model}', bodies[sent % len(bodies)], {'Content-Type': content_type})
+            response = connection.getresponse()
+            response.read()
+        except (ConnectionError, http.client.HTTPException) as error:
+            errors.append(type(error).__name__)
+            connection.close()  # Reconnects on the next request
+            continue
+        finally:
+            sent += 1
+        if response.status != 200:
+            errors.append(response.status)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+def run_level(host, port, model, bodies, content_type, concurrency, duration):
+    # Throughput and latency percentiles with concurrency clients
+    latencies, errors = [], []
+    before = get_stats(host, port)[model]
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(host, port, model, bodies, content_type, start + duration, latencies, errors))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    after = get_stats(host, port)[model]
+    batches = after['batches'] - before['batches']
+    return {'concurrency': concurrency, 'requests': len(latencies), 'errors': len(errors),
+            'requests_per_sec': len(latencies) / seconds,
+            'p50_ms': float(np.percentile(latencies, 50)) if latencies else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if latencies else None,
+            'mean_batch_size': (after['requests'] - before['requests']) / batches if batches else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency versus throughput of inference_server.py')
+    parser.add_argument('--model', required=True, help="Served model, e.g. ResSE or emotion")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16, 64])
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per concurrency level')
+    parser.add_argument('--image-size', type=int, default=224, help='Size of the random test images')
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    bodies, content_type = payloads(args.model, args.image_size)
+    run_level(args.host, args.port, args.model, bodies, content_type, 1, 1)  # Warm up
+    print(f"{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'batch':>8}{'errors':>8}")
+    results = []
+    for concurrency in args.concurrency:
+        result = run_level(args.host, args.port, args.model, bodies, content_type, concurrency, args.duration)
+        results.append(result)
+        print(f"{concurrency:>8}{result['requests_per_sec']:>10.1f}{result['p50_ms'] or 0:>10.1f}"
+              f"{result['p99_ms'] or 0:>10.1f}{result['mean_batch_size']:>8.1f}{result['errors']:>8}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
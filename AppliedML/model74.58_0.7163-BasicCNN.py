@@ -1,6 +1,7 @@
 
 import tensorflow as tf
 from tensorflow.keras import layers, optimizers, regularizers
+from training_modes import precision_policy, scaled_optimizer
 
 def residual_se_block(input_tensor, filters, kernel_size=3, se_reduction_ratio=8):
     """
@@ -26,35 +27,41 @@ def se_block(input_tensor, reduction_ratio=8):
     se = layers.Reshape([1, 1, channels])(se)
     return layers.Multiply()([input_tensor, se]) 
 
-def create_model():
-    inputs = tf.keras.Input(shape=(224, 224, 3))
+def create_model(augment=True, precision='float32', jit_compile=False):
+    # precision and jit_compile (XLA) are the training modes from training_modes.py
+    with precision_policy(precision):
+        inputs = tf.keras.Input(shape=(224, 224, 3))
 
-    x = layers.RandomRotation(0.33)(inputs)
-    x = layers.RandomFlip("horizontal")(x)
+        x = inputs
+        if augment:
+            # Set augment=False when the augmentation runs in the input pipeline (augmentation.py)
+            x = layers.RandomRotation(0.33)(x)
+            x = layers.RandomFlip("horizontal")(x)
 
-    x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu')(x)
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-    x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu')(x)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-    x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x) 
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-    x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-    x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-    x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
-    x = layers.GlobalAveragePooling2D()(x)
+        x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu')(x)
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+        x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu')(x)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+        x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x) 
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+        x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+        x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+        x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
+        x = layers.GlobalAveragePooling2D()(x)
 
-    x = layers.Dense(128, activation='relu')(x)
-    x = layers.Dense(64, activation='relu')(x)
-    outputs = layers.Dense(14, activation='softmax')(x)
+        x = layers.Dense(128, activation='relu')(x)
+        x = layers.Dense(64, activation='relu')(x)
+        outputs = layers.Dense(14, activation='softmax', dtype='float32')(x)  # float32 softmax, also with mixed precision
 
-    model = tf.keras.Model(inputs, outputs)
+        model = tf.keras.Model(inputs, outputs)
 
-    adam_opt = optimizers.Adam(learning_rate=0.001)
-    model.compile(optimizer=adam_opt,
-                  loss='sparse_categorical_crossentropy',
-                  metrics=['accuracy'])
+        adam_opt = scaled_optimizer(optimizers.Adam(learning_rate=0.001), precision)
+        model.compile(optimizer=adam_opt,
+                      loss='sparse_categorical_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=jit_compile)
 
     model.summary()
     return model
@@ -64,4 +71,5 @@ def callbacks():
 
     return callback
 
-create_model()
\ No newline at end of file
+if __name__ == '__main__':
+    create_model()
@@ -1,6 +1,7 @@
 
 import tensorflow as tf
 from tensorflow.keras import layers, optimizers
+from training_modes import precision_policy, scaled_optimizer
 
 def residual_se_block(input_tensor, filters, kernel_size=3, se_reduction_ratio=8):
     """
@@ -26,52 +27,58 @@ def se_block(input_tensor, reduction_ratio=8):
     se = layers.Reshape([1, 1, channels])(se)
     return layers.Multiply()([input_tensor, se]) 
 
-def create_model():
-    inputs = tf.keras.Input(shape=(224, 224, 3))
-
-    x = layers.RandomRotation(0.33)(inputs)
-    x = layers.RandomFlip("horizontal")(x)
-
-    #x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu',padding="same")(x)
-    #x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu')(x)
-    x = residual_se_block(x, filters=32)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-
-    #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu',padding="same")(x)
-    #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x)
-    x = residual_se_block(x, filters=64)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-
-    #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu',padding="same")(x)
-    #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x)
-    x = residual_se_block(x, filters=128)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-
-    #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu',padding="same")(x)
-    #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
-    x = residual_se_block(x, filters=128)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-
-    #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu',padding="same")(x)
-    #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
-    x = residual_se_block(x, filters=256)  
-    x = layers.MaxPooling2D(pool_size=(2, 2))(x)
-    #x = layers.Conv2D(filters=256, kernel_size=(3, 3), activation='relu')(x)
-    x = residual_se_block(x, filters=256)  
-    x = layers.GlobalAveragePooling2D()(x)
-
-    x = layers.Dense(128, activation='relu')(x)
-    x = layers.Dropout(0.1)(x)
-    x = layers.Dense(64, activation='relu')(x)
-    x = layers.Dropout(0.1)(x)
-    outputs = layers.Dense(14, activation='softmax')(x)
-
-    model = tf.keras.Model(inputs, outputs)
-
-    adam_opt = optimizers.Adam(learning_rate=0.0001)
-    model.compile(optimizer=adam_opt,
-                  loss='sparse_categorical_crossentropy',
-                  metrics=['accuracy'])
+def create_model(augment=True, precision='float32', jit_compile=False):
+    # precision and jit_compile (XLA) are the training modes from training_modes.py
+    with precision_policy(precision):
+        inputs = tf.keras.Input(shape=(224, 224, 3))
+
+        x = inputs
+        if augment:
+            # Set augment=False when the augmentation runs in the input pipeline (augmentation.py)
+            x = layers.RandomRotation(0.33)(x)
+            x = layers.RandomFlip("horizontal")(x)
+
+        #x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu',padding="same")(x)
+        #x = layers.Conv2D(filters=32, kernel_size=(3, 3), activation='relu')(x)
+        x = residual_se_block(x, filters=32)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+
+        #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu',padding="same")(x)
+        #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x)
+        x = residual_se_block(x, filters=64)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+
+        #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu',padding="same")(x)
+        #x = layers.Conv2D(filters=64, kernel_size=(3, 3), activation='relu')(x)
+        x = residual_se_block(x, filters=128)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+
+        #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu',padding="same")(x)
+        #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
+        x = residual_se_block(x, filters=128)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+
+        #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu',padding="same")(x)
+        #x = layers.Conv2D(filters=128, kernel_size=(3, 3), activation='relu')(x)
+        x = residual_se_block(x, filters=256)  
+        x = layers.MaxPooling2D(pool_size=(2, 2))(x)
+        #x = layers.Conv2D(filters=256, kernel_size=(3, 3), activation='relu')(x)
+        x = residual_se_block(x, filters=256)  
+        x = layers.GlobalAveragePooling2D()(x)
+
+        x = layers.Dense(128, activation='relu')(x)
+        x = layers.Dropout(0.1)(x)
+        x = layers.Dense(64, activation='relu')(x)
+        x = layers.Dropout(0.1)(x)
+        outputs = layers.Dense(14, activation='softmax', dtype='float32')(x)  # float32 softmax, also with mixed precision
+
+        model = tf.keras.Model(inputs, outputs)
+
+        adam_opt = scaled_optimizer(optimizers.Adam(learning_rate=0.0001), precision)
+        model.compile(optimizer=adam_opt,
+                      loss='sparse_categorical_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=jit_compile)
 
     model.summary()
     return model
@@ -1,6 +1,7 @@
 
 import tensorflow as tf
 from tensorflow.keras import layers, optimizers
+from training_modes import precision_policy, scaled_optimizer
 
 def scale_width(base_filters, alpha):
     return max(8, int(base_filters * alpha))  # Ensure at least 8 filters
@@ -8,8 +9,20 @@ def scale_width(base_filters, alpha):
 def scale_depth(base_layers, beta):
     return max(1, int(base_layers * beta))  # Ensure at least 1 residual block
 
-def scale_resolution(base_size, gamma):
-    return min(224, max(112, int(base_size * gamma)))  # Keep within 112-224
+def scale_resolution(base_size, gamma, max_size=224):
+    size = max(112, int(base_size * gamma))  # At least 112
+    return size if max_size is None else min(max_size, size)  # and at most max_size (None for no limit)
+
+BASE_WIDTHS = (64, 128, 256, 512)  # Filters of the four residual stages
+BASE_DEPTHS = (3, 4, 6, 3)  # Residual blocks of the four stages
+
+def scaling(phi, coefficients, max_resolution=224):
+    # (widths, depths, input size) of the model for phi and the width, depth and resolution coefficients.
+    # Different coefficients can give the same model, because of the rounding and the resolution limits
+    alpha, beta, gamma = coefficients[0] ** phi, coefficients[1] ** phi, coefficients[2] ** phi
+    widths = tuple(scale_width(filters, alpha) for filters in BASE_WIDTHS)
+    depths = tuple(scale_depth(blocks, beta) for blocks in BASE_DEPTHS)
+    return widths, depths, scale_resolution(224, gamma, max_resolution)
 
 def residual(input_tensor, filters, kernel_size=3, strides=1):
     shortcut = input_tensor
@@ -27,32 +40,36 @@ def residual(input_tensor, filters, kernel_size=3, strides=1):
     x = layers.Activation('relu')(x)
     return x
 
-def create_model(phi=1.0):
-    alpha, beta, gamma = 1.2 ** phi, 1.1 ** phi, 1.15 ** phi
-    input_size = scale_resolution(224, gamma)
-    inputs = tf.keras.Input(shape=(input_size, input_size, 3))
-    
-    x = layers.RandomRotation(0.33)(inputs)
-    x = layers.RandomFlip("horizontal")(x)
-    x = layers.Conv2D(scale_width(64, alpha), 7, strides=2, padding='same', activation='relu')(x)
-    
-    for _ in range(scale_depth(3, beta)):
-        x = residual(x, scale_width(64, alpha), strides=2 if _ == 0 else 1)
-    for _ in range(scale_depth(4, beta)):
-        x = residual(x, scale_width(128, alpha), strides=2 if _ == 0 else 1)
-    for _ in range(scale_depth(6, beta)):
-        x = residual(x, scale_width(256, alpha), strides=2 if _ == 0 else 1)
-    for _ in range(scale_depth(3, beta)):
-        x = residual(x, scale_width(512, alpha), strides=2 if _ == 0 else 1)
-    
-    x = layers.GlobalAveragePooling2D()(x)
-    outputs = layers.Dense(14, activation='softmax')(x)
-    
-    model = tf.keras.Model(inputs, outputs)
-    adam_opt = optimizers.Adam(learning_rate=0.0005)
-    model.compile(optimizer=adam_opt,
-                  loss='sparse_categorical_crossentropy',
-                  metrics=['accuracy'])
+def create_model(phi=1.0, augment=True, precision='float32', jit_compile=False, coefficients=(1.2, 1.1, 1.15),
+                 max_resolution=224):
+    # coefficients are the base width, depth and resolution multipliers, scaled by phi (see effnet_search.py).
+    # The input size is at most max_resolution, 224 like the images the model was trained on
+    widths, depths, input_size = scaling(phi, coefficients, max_resolution)
+    # precision and jit_compile (XLA) are the training modes from training_modes.py
+    with precision_policy(precision):
+        inputs = tf.keras.Input(shape=(input_size, input_size, 3))
+
+        x = inputs
+        if augment:
+            # Set augment=False when the augmentation runs in the input pipeline (augmentation.py)
+            x = layers.RandomRotation(0.33)(x)
+            x = layers.RandomFlip("horizontal")(x)
+        x = layers.Conv2D(widths[0], 7, strides=2, padding='same', activation='relu')(x)
+
+        for filters, blocks in zip(widths, depths):
+            for _ in range(blocks):
+                x = residual(x, filters, strides=2 if _ == 0 else 1)
+
+        x = layers.GlobalAveragePooling2D()(x)
+        outputs = layers.Dense(14, activation='softmax', dtype='float32')(x)  # float32 softmax, also with mixed precision
+
+        model = tf.keras.Model(inputs, outputs)
+        adam_opt = scaled_optimizer(optimizers.Adam(learning_rate=0.0005), precision)
+        model.compile(optimizer=adam_opt,
+                      loss='sparse_categorical_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=jit_compile)
+
     model.summary()
     return model
 
@@ -1,6 +1,7 @@
 
 import tensorflow as tf
 from tensorflow.keras import layers, optimizers, regularizers
+from training_modes import precision_policy, scaled_optimizer
 
 def residual(input_tensor, filters, kernel_size=3, strides=1):
     shortcut = input_tensor
@@ -20,39 +21,45 @@ def residual(input_tensor, filters, kernel_size=3, strides=1):
 
 
 
-def create_model():
-    inputs = tf.keras.Input(shape=(224, 224, 3))
-    x = layers.RandomRotation(0.33)(inputs)
-    x = layers.RandomFlip("horizontal")(x)
-    x = layers.Conv2D(64, 7, strides=2, padding='same', activation='relu')(x)
-    x = residual(x, 64, strides=2)  # Strided downsampling
-    x = residual(x, 64)  # No unintended downsampling
-    x = residual(x, 64)
-
-    x = residual(x, 128, strides=2)  # Strided downsampling
-    x = residual(x, 128)
-    x = residual(x, 128)
-    x = residual(x, 128)
-
-    #x = residual(x, 256, strides=2)  # Strided downsampling
-    #x = residual(x, 256)
-    #x = residual(x, 256)
-    #x = residual(x, 256)
-    #x = residual(x, 256)
-    #x = residual(x, 256)
-
-    #x = residual(x, 512, strides=2)  # Strided downsampling
-    #x = residual(x, 512)
-    #x = residual(x, 512)
-
-    x = layers.GlobalAveragePooling2D()(x)
-    outputs = layers.Dense(14, activation='softmax')(x)
-
-    model = tf.keras.Model(inputs, outputs)
-    adam_opt = optimizers.Adam(learning_rate=0.0005)
-    model.compile(optimizer=adam_opt,
-                  loss='sparse_categorical_crossentropy',
-                  metrics=['accuracy'])
+def create_model(augment=True, precision='float32', jit_compile=False):
+    # precision and jit_compile (XLA) are the training modes from training_modes.py
+    with precision_policy(precision):
+        inputs = tf.keras.Input(shape=(224, 224, 3))
+        x = inputs
+        if augment:
+            # Set augment=False when the augmentation runs in the input pipeline (augmentation.py)
+            x = layers.RandomRotation(0.33)(x)
+            x = layers.RandomFlip("horizontal")(x)
+        x = layers.Conv2D(64, 7, strides=2, padding='same', activation='relu')(x)
+        x = residual(x, 64, strides=2)  # Strided downsampling
+        x = residual(x, 64)  # No unintended downsampling
+        x = residual(x, 64)
+
+        x = residual(x, 128, strides=2)  # Strided downsampling
+        x = residual(x, 128)
+        x = residual(x, 128)
+        x = residual(x, 128)
+
+        #x = residual(x, 256, strides=2)  # Strided downsampling
+        #x = residual(x, 256)
+        #x = residual(x, 256)
+        #x = residual(x, 256)
+        #x = residual(x, 256)
+        #x = residual(x, 256)
+
+        #x = residual(x, 512, strides=2)  # Strided downsampling
+        #x = residual(x, 512)
+        #x = residual(x, 512)
+
+        x = layers.GlobalAveragePooling2D()(x)
+        outputs = layers.Dense(14, activation='softmax', dtype='float32')(x)  # float32 softmax, also with mixed precision
+
+        model = tf.keras.Model(inputs, outputs)
+        adam_opt = scaled_optimizer(optimizers.Adam(learning_rate=0.0005), precision)
+        model.compile(optimizer=adam_opt,
+                      loss='sparse_categorical_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=jit_compile)
 
     model.summary()
     return model
@@ -0,0 +1,43 @@
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+# Size and speed of a Keras model: parameters, FLOPs and CPU inference latency.
+
+
+def count_flops(model):
+    # FLOPs of one forward pass for one image (a multiply-add counts as 2).
+    # Only the Conv2D and Dense layers are counted, the rest (BatchNorm, pooling, Add) is small next to them
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, layers.Conv2D):
+            _, height, width, filters = layer.output.shape
+            kernel_height, kernel_width = layer.kernel_size
+            channels = layer.input.shape[-1] // layer.groups
+            flops += 2 * height * width * kernel_height * kernel_width * channels * filters
+        elif isinstance(layer, layers.Dense):
+            flops += 2 * layer.input.shape[-1] * layer.units
+    return int(flops)
+
+
+def inference_latency(model, batch_size=1, runs=20, warmup=3):
+    # Median time in ms of model(images, training=False) on a batch of random images
+    size = model.input_shape[1:]
+    images = tf.constant(np.random.default_rng(0).uniform(0, 255, (batch_size, *size)).astype('float32'))
+    predict = tf.function(lambda images: model(images, training=False))
+    for _ in range(warmup):
+        predict(images)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(images).numpy()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def model_stats(model, batch_sizes=(1,), runs=20):
+    stats = {'params': int(model.count_params()), 'flops': count_flops(model)}
+    for batch_size in batch_sizes:
+        stats[f'latency_ms_batch{batch_size}'] = inference_latency(model, batch_size, runs)
+    return stats
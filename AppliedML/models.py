@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import re
+
+# The model files have the validation accuracy and loss in their names (model<accuracy>_<loss>-<name>.py),
+# so they cannot be imported with a normal import. load_model_file loads one by its short name.
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILES = {
+    'BasicCNN': 'model74.58_0.7163-BasicCNN.py',
+    'ResSE': 'model80.10_0.6190-ResSE.py',
+    'EffNet': 'model81.08_0.5469-EffNet.py',
+    'ResNet17Insipred': 'model82.50_0.5528-ResNet17Insipred.py',
+}
+
+
+def load_model_file(name):
+    # The module of a model file, e.g. load_model_file('ResSE').create_model()
+    path = os.path.join(MODEL_DIR, MODEL_FILES[name])
+    spec = importlib.util.spec_from_file_location(f'model_{name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def baseline(name):
+    # (validation accuracy in %, validation loss) recorded in the file name
+    match = re.match(r'model(\d+\.\d+)_(\d+\.\d+)-', MODEL_FILES[name])
+    return float(match.group(1)), float(match.group(2))
@@ -0,0 +1,193 @@
+import argparse
+import contextlib
+import io
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from export_model import AUGMENTATION_LAYERS, load_trained
+from model_stats import inference_latency
+from models import MODEL_FILES
+
+# CPU inference export: int8 post-training quantized TFLite model of a trained model, with a benchmark
+# (size, latency at batch 1, accuracy) against the float Keras model.
+# Before the conversion the Keras graph is rewritten (fold_batch_norm):
+# - Dropout and the RandomRotation/RandomFlip layers are removed, they do nothing at inference
+# - a BatchNormalization directly after a Conv2D without activation is folded into the kernel and bias of the conv
+#   (the second conv and the shortcut conv of the residual blocks). The BatchNormalization after the first conv
+#   of the residual blocks comes after the ReLU, so it cannot be folded into that conv and is kept
+# The quantization ranges are calibrated on the first --calibration-images validation images.
+# The TFLite model takes and returns float32 like the Keras model, everything in between runs in int8.
+# Run it from the AppliedML folder:
+# python quantize_model.py --model ResNet17Insipred --weights ResNet17Insipred.keras --output ResNet17Insipred_int8.tflite
+INFERENCE_ONLY_LAYERS = (layers.Dropout, *AUGMENTATION_LAYERS)
+
+
+def foldable_batch_norms(model):
+    # {conv layer name: BatchNormalization layer} for the BatchNormalizations that can be folded into the conv before them
+    folds = {}
+    for layer in model.layers:
+        if not isinstance(layer, layers.BatchNormalization) or layer.axis not in (-1, len(layer.input.shape) - 1):
+            continue
+        conv = layer.input._keras_history.operation
+        linear = isinstance(conv, layers.Conv2D) and conv.get_config()['activation'] == 'linear'
+        if linear and len(conv._outbound_nodes) == 1:
+            folds[conv.name] = layer
+    return folds
+
+
+def folded_weights(conv, batch_norm):
+    # Kernel and bias of conv followed by batch_norm: y = (conv(x) - mean) * gamma / sqrt(var + eps) + beta
+    kernel = conv.kernel.numpy()
+    bias = conv.bias.numpy() if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    gamma = batch_norm.gamma.numpy() if batch_norm.scale else 1.0
+    beta = batch_norm.beta.numpy() if batch_norm.center else 0.0
+    scale = gamma / np.sqrt(batch_norm.moving_variance.numpy() + batch_norm.epsilon)
+    return [kernel * scale, (bias - batch_norm.moving_mean.numpy()) * scale + beta]
+
+
+def fold_batch_norm(model):
+    # A float32 copy of the model for inference, without the training-only layers and with the
+    # BatchNormalizations folded into the convs where possible. Returns (model, number of folded BatchNormalizations)
+    folds = foldable_batch_norms(model)
+    folded = {batch_norm.name for batch_norm in folds.values()}
+    inputs = tf.keras.Input(shape=model.input_shape[1:])
+    tensors = {id(model.inputs[0]): inputs}  # Tensor of the original model -> tensor of the new model
+
+    for layer in model.layers[1:]:
+        if len(layer._inbound_nodes) != 1:
+            raise ValueError(f"Layer {layer.name} is used more than once, which is not supported")
+        node = layer._inbound_nodes[0]
+        if isinstance(layer, INFERENCE_ONLY_LAYERS) or layer.name in folded:
+            tensors[id(node.output_tensors[0])] = tensors[id(node.input_tensors[0])]
+            continue
+        config = {**layer.get_config(), 'dtype': 'float32'}  # Also float32 when it was trained with mixed precision
+        weights = layer.get_weights()
+        if layer.name in folds:
+            config['use_bias'] = True
+            weights = folded_weights(layer, folds[layer.name])
+        new_layer = type(layer).from_config(config)
+        args, kwargs = tf.nest.map_structure(lambda value: tensors.get(id(value), value),
+                                             (node.arguments.args, node.arguments.kwargs))
+        outputs = new_layer(*args, **kwargs)
+        new_layer.set_weights(weights)
+        for tensor, output in zip(node.output_tensors, tf.nest.flatten(outputs)):
+            tensors[id(tensor)] = output
+
+    return tf.keras.Model(inputs, tensors[id(model.outputs[0])]), len(folds)
+
+
+def quantize(model, calibration_images, int8=True):
+    # TFLite flatbuffer of model. With int8, all the ops are quantized with ranges from the calibration images
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if int8:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([image[None]] for image in calibration_images)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with contextlib.redirect_stdout(io.StringIO()):  # Hide the list of the exported variables
+        return converter.convert()
+
+
+def first_images(dataset, count):
+    # The first count (images, labels) of a batched dataset as numpy arrays
+    images, labels = [], []
+    for batch_images, batch_labels in dataset:
+        images.append(batch_images.numpy())
+        labels.append(batch_labels.numpy())
+        if sum(len(batch) for batch in labels) >= count:
+            break
+    return np.concatenate(images)[:count], np.concatenate(labels)[:count]
+
+
+def tflite_predict(interpreter, images, batch_size=64):
+    # Class probabilities of a TFLite model for a numpy array of images
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+    predictions = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        if interpreter.get_input_details()[0]['shape'][0] != len(batch):
+            interpreter.resize_tensor_input(input_index, batch.shape)
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_index, batch)
+        interpreter.invoke()
+        predictions.append(interpreter.get_tensor(output_index).copy())
+    return np.concatenate(predictions)
+
+
+def tflite_latency(interpreter, image, runs=20, warmup=3):
+    # Median time in ms of one image, like model_stats.inference_latency for the Keras models
+    input_index = interpreter.get_input_details()[0]['index']
+    interpreter.resize_tensor_input(input_index, image[None].shape)
+    interpreter.allocate_tensors()
+    times = []
+    for run in range(warmup + runs):
+        start = time.perf_counter()
+        interpreter.set_tensor(input_index, image[None])
+        interpreter.invoke()
+        interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+        if run >= warmup:
+            times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def keras_size(model):
+    # Size in bytes of the weights of the model (without the optimizer state that a saved .keras file also has)
+    return sum(weight.nbytes for weight in model.get_weights())
+
+
+def data(resolution, calibration_images, test_images, cache_dir, synthetic):
+    # Calibration images from the validation split and (images, labels) from the test split
+    if synthetic:
+        rng = np.random.default_rng(0)
+        calibration = rng.uniform(0, 255, (calibration_images, resolution, resolution, 3)).astype('float32')
+        test = rng.uniform(0, 255, (test_images or 64, resolution, resolution, 3)).astype('float32')
+        return calibration, (test, rng.integers(0, 14, len(test)))
+    from input_pipeline import load_skin_lesion_splits
+    _, validation, test = load_skin_lesion_splits(cache_dir=cache_dir, image_size=(resolution, resolution))
+    calibration, _ = first_images(validation, calibration_images)
+    return calibration, first_images(test, test_images or float('inf'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='int8 TFLite export of a trained model, with a benchmark against Keras')
+    parser.add_argument('--model', choices=list(MODEL_FILES), required=True)
+    parser.add_argument('--weights', required=True, help='Trained model (.keras/.h5) or weights (.weights.h5)')
+    parser.add_argument('--output', required=True, help='Where to save the int8 model (.tflite)')
+    parser.add_argument('--phi', type=float, default=None, help='phi of the EffNet model')
+    parser.add_argument('--calibration-images', type=int, default=256)
+    parser.add_argument('--test-images', type=int, default=None, help='Only evaluate on the first test images')
+    parser.add_argument('--runs', type=int, default=50, help='Runs for the latency')
+    parser.add_argument('--threads', type=int, default=None, help='TFLite interpreter threads (default: all)')
+    parser.add_argument('--cache-dir', default='tf_cache')
+    parser.add_argument('--synthetic', action='store_true', help='Random images instead of the dataset, to test the export')
+    args = parser.parse_args()
+
+    model = load_trained(args.model, args.weights, args.phi)
+    inference, folded = fold_batch_norm(model)
+    print(f"{len(model.layers)} -> {len(inference.layers)} layers, {folded} BatchNormalizations folded into the convs")
+
+    calibration, (images, labels) = data(model.input_shape[1], args.calibration_images, args.test_images,
+                                         args.cache_dir, args.synthetic)
+    expected = model.predict(images, verbose=0)
+    difference = np.abs(inference.predict(images, verbose=0) - expected).max()
+    print(f"Largest difference in the probabilities after the folding: {difference:.2e}")
+
+    int8_model = quantize(inference, calibration)
+    with open(args.output, 'wb') as f:
+        f.write(int8_model)
+
+    rows = []
+    for name, keras_model in [('keras float32', model), ('keras float32 folded', inference)]:
+        rows.append((name, keras_size(keras_model), inference_latency(keras_model, 1, args.runs), expected if keras_model is model
+                     else keras_model.predict(images, verbose=0)))
+    for name, flatbuffer in [('tflite float32 folded', quantize(inference, calibration, int8=False)), ('tflite int8', int8_model)]:
+        interpreter = tf.lite.Interpreter(model_content=flatbuffer, num_threads=args.threads)
+        rows.append((name, len(flatbuffer), tflite_latency(interpreter, images[0], args.runs), tflite_predict(interpreter, images)))
+
+    print(f"\n{'':<24}{'size MB':>9}{'ms/image':>10}{'accuracy':>10}{'agreement':>11}")
+    for name, size, latency, predictions in rows:
+        accuracy = np.mean(predictions.argmax(axis=1) == labels)
+        agreement = np.mean(predictions.argmax(axis=1) == expected.argmax(axis=1))
+        print(f"{name:<24}{size / 1e6:>9.2f}{latency:>10.2f}{accuracy:>10.4f}{agreement:>11.4f}")
+    print(f"\nSaved {args.output}. agreement is the share of the test images with the same class as the float Keras model")
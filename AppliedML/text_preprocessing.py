@@ -0,0 +1,126 @@
+import argparse
+import functools
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import PorterStemmer
+
+# The text preprocessing of the emotion RNN (RNN_final.ipynb and BlueSky3.ipynb), for use outside the notebooks.
+# The model needs RNN_final.h5 plus tokenizer.pkl and max_sequence_length.pkl saved from RNN_final.ipynb.
+# clean_text gives exactly the same text as clean_text in the notebooks (so tokenizer.pkl stays valid), but with the
+# regexes compiled once, one stopword check per word and a cache on the stemmer, because the same words come back
+# in almost every text. clean_texts/clean_column clean many texts, optionally in several processes.
+# python text_preprocessing.py --csv data.csv --column text    (check and time it against the notebook version)
+EMOTIONS = {0: 'sadness', 1: 'joy', 2: 'love', 3: 'anger', 4: 'fear', 5: 'surprise'}
+
+try:
+    stop_words = set(stopwords.words('english'))
+except LookupError:
+    nltk.download('stopwords')
+    stop_words = set(stopwords.words('english'))
+stemmer = PorterStemmer()
+
+STOP_WORDS = frozenset(stop_words)
+# Removing the numbers and then the punctuation removes the same characters as removing both at once
+NUMBERS_AND_PUNCTUATION = re.compile(r'\d|[^\w\s]')
+STEM_CACHE_SIZE = 2 ** 18
+
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    return stemmer.stem(word)
+
+
+def notebook_clean_text(text):
+    # clean_text as it is in BlueSky3.ipynb, to check clean_text against
+    text = str(text)
+    text = text.lower()                                         # Convert to lowercase
+    text = re.sub(r'\d+', '', text)                             # Remove numbers
+    text = re.sub(r'[^\w\s]', '', text)                         # Remove punctuation
+    text = re.sub(r'\s+', ' ', text).strip()                    # Remove extra whitespace
+    words = text.split()
+    words = [word for word in words if word not in stop_words]  # Remove stopwords
+    tokens = [stemmer.stem(word) for word in words if word not in stop_words]
+    return " ".join(tokens)
+
+
+def clean_text(text):
+    # The same as notebook_clean_text. split() splits on the same whitespace as \s, so the whitespace does not
+    # have to be replaced first
+    text = NUMBERS_AND_PUNCTUATION.sub('', str(text).lower())
+    return " ".join([stem(word) for word in text.split() if word not in STOP_WORDS])
+
+
+def clean_chunk(texts):
+    return [clean_text(text) for text in texts]
+
+
+def clean_texts(texts, workers=1, chunk_size=20000):
+    # clean_text of every text, in order. With workers > 1 the chunks are cleaned in that many processes,
+    # each with its own stem cache
+    texts = list(texts)
+    if workers <= 1 or len(texts) <= chunk_size:
+        return clean_chunk(texts)
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return [text for chunk in pool.map(clean_chunk, chunks) for text in chunk]
+
+
+def clean_column(df, column='text', output_column='clean_text', workers=1, chunk_size=20000):
+    # df[output_column] = df[column].apply(clean_text), optionally in several processes
+    df[output_column] = clean_texts(df[column], workers, chunk_size)
+    return df
+
+
+def encode_texts(texts, tokenizer, max_sequence_length):
+    # Padded token sequences for the model, like BlueSky3.ipynb
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
+    sequences = tokenizer.texts_to_sequences(clean_texts(texts))
+    return pad_sequences(sequences, maxlen=max_sequence_length, padding='post', truncating='post')
+
+
+if __name__ == '__main__':
+    import os
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Check clean_text against the notebook version and time both')
+    parser.add_argument('--csv', default=None, help='CSV with the texts (default: synthetic tweets)')
+    parser.add_argument('--column', default='text')
+    parser.add_argument('--texts', type=int, default=200000, help='Number of synthetic texts')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.csv:
+        texts = pd.read_csv(args.csv)[args.column].tolist()
+    else:
+        import numpy as np
+        rng = np.random.default_rng(0)
+        words = ("i feel so happy and grateful for all the support today this is the worst day everything keeps "
+                 "going wrong am furious little scared about results tomorrow miss you much house feels empty "
+                 "without wow did not expect that at love spending evening with my family feeling loved hated "
+                 "annoyed Amazing!!! #blessed 2day @friend http://t.co/x1 can't won't").split()
+        texts = [' '.join(rng.choice(words, rng.integers(3, 40))) for _ in range(args.texts)]
+
+    df = pd.DataFrame({'text': texts})
+    start = time.perf_counter()
+    expected = df['text'].apply(notebook_clean_text)
+    notebook_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cleaned = clean_texts(texts)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    clean_column(df, 'text', 'clean_text', workers=args.workers)
+    parallel_seconds = time.perf_counter() - start
+
+    print(f"{len(texts)} texts")
+    print(f"notebook clean_text apply: {notebook_seconds:.2f} s")
+    print(f"clean_texts:               {seconds:.2f} s ({notebook_seconds / seconds:.1f}x)")
+    print(f"clean_column, {args.workers} workers: {parallel_seconds:.2f} s ({notebook_seconds / parallel_seconds:.1f}x)")
+    print(f"stem cache: {stem.cache_info()}")
+    identical = cleaned == expected.tolist() and df['clean_text'].tolist() == expected.tolist()
+    print(f"Identical to the notebook: {identical}")
+    if not identical:
+        raise SystemExit(1)
@@ -0,0 +1,40 @@
+import contextlib
+import tensorflow as tf
+
+# Precision settings for create_model() in the model files.
+# precision='mixed_bfloat16' runs the layers in bfloat16 with float32 weights. It is faster on CPUs with
+# bfloat16 instructions (AVX512-BF16 or AMX), and slower on CPUs without them (check with cpu_supports_bfloat16).
+# 'mixed_float16' is meant for GPUs. The softmax output is always computed in float32.
+PRECISIONS = ['float32', 'mixed_bfloat16', 'mixed_float16']
+
+
+@contextlib.contextmanager
+def precision_policy(precision):
+    # Set the Keras dtype policy for the layers that are created in the with block. The previous policy is restored
+    # afterwards, also when building the model fails, so it does not leak into the next model of the process
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, use one of {', '.join(PRECISIONS)}")
+    previous = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(precision)
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous)
+
+
+def scaled_optimizer(optimizer, precision):
+    # float16 gradients can underflow to zero, so the loss is scaled up before the gradients are computed.
+    # bfloat16 has the same exponent range as float32 and does not need it
+    if precision == 'mixed_float16':
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def cpu_supports_bfloat16():
+    # True if the CPU has native bfloat16 instructions (Linux only)
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
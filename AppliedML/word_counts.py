@@ -0,0 +1,152 @@
+import argparse
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+
+# Word frequencies of a whole corpus as one sparse document-term matrix (scipy CSR: one row per text, one column per
+# word, the number of times the word is in the text).
+# The notebooks made a Counter for every row (word_freq), kept it in a DataFrame column and added them together in a
+# loop, again for samlet/train/val/test. TermCounts tokenizes the texts once, in chunks that can run in several
+# processes, and answers the frequency queries from the matrix: the most common words of all the texts, of some of
+# the rows, or of every split or class.
+# Usage (run the notebook from the AppliedML folder, or add it to sys.path):
+# from word_counts import TermCounts
+# counts = TermCounts.from_texts(df_samlet['text'])
+# counts.most_common(10)                          # The same as all_word_counts.most_common(10)
+# counts.most_common_by(df_samlet['label_name'])  # {label: most_common(10) of the texts with the label}
+WORD_PATTERN = r'\b\w+\b'  # The same words as re.findall in word_freq
+
+
+def count_chunk(texts, pattern=WORD_PATTERN):
+    # (words, CSR matrix) of a list of texts. The columns are the words in the order they are first seen
+    findall = re.compile(pattern).findall
+    vocabulary = {}
+    columns = []
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    for row, text in enumerate(texts):
+        words = findall(text)
+        lengths[row] = len(words)
+        columns.extend([vocabulary.setdefault(word, len(vocabulary)) for word in words])
+    rows = np.repeat(np.arange(len(texts), dtype=np.int32), lengths)
+    # coo -> csr adds up the repeated (text, word) pairs
+    matrix = sp.coo_matrix((np.ones(len(columns), dtype=np.int32), (rows, np.array(columns, dtype=np.int32))),
+                           shape=(len(texts), len(vocabulary))).tocsr()
+    return list(vocabulary), matrix
+
+
+class TermCounts:
+    def __init__(self, words, matrix):
+        self.words = np.array(words, dtype=object)
+        self.vocabulary = {word: column for column, word in enumerate(words)}
+        self.matrix = matrix
+
+    @classmethod
+    def from_texts(cls, texts, pattern=WORD_PATTERN, workers=1, chunk_size=100000):
+        # Count the words of every text. With workers > 1 the chunks are tokenized in that many processes
+        texts = [str(text) for text in texts]
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(count_chunk, chunks, [pattern] * len(chunks)))
+        else:
+            results = [count_chunk(chunk, pattern) for chunk in chunks]
+        return cls.merge(results)
+
+    @classmethod
+    def merge(cls, results):
+        # One matrix of the (words, matrix) of the chunks, in order. The columns of every chunk are mapped to the
+        # columns of the whole corpus, so a word keeps the column of the first text it is in
+        vocabulary = {}
+        indptr, indices, data = [np.zeros(1, dtype=np.int64)], [], []
+        for words, matrix in results:
+            mapping = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in words], dtype=np.int32)
+            indptr.append(matrix.indptr[1:].astype(np.int64) + indptr[-1][-1])
+            indices.append(mapping[matrix.indices])
+            data.append(matrix.data)
+        rows = sum(len(matrix.indptr) - 1 for _, matrix in results)
+        matrix = sp.csr_matrix((np.concatenate(data) if data else np.zeros(0, dtype=np.int32),
+                                np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                                np.concatenate(indptr)), shape=(rows, len(vocabulary)))
+        return cls(list(vocabulary), matrix)
+
+    def totals(self, rows=None):
+        # How many times every word is in the texts (or in the rows: a boolean mask or positions)
+        matrix = self.matrix if rows is None else self.matrix[np.asarray(rows)]
+        return np.bincount(matrix.indices, weights=matrix.data, minlength=len(self.words)).astype(np.int64)
+
+    def top(self, totals, k):
+        # [(word, count)] like Counter.most_common. Equal counts are in the order the words are first seen in the
+        # corpus, so for all the texts the order is the same as the Counter
+        order = np.argsort(-totals, kind='stable')[:k]
+        order = order[totals[order] > 0]
+        return [(word, int(count)) for word, count in zip(self.words[order], totals[order])]
+
+    def most_common(self, k=10, rows=None):
+        return self.top(self.totals(rows), k)
+
+    def most_common_by(self, groups, k=10):
+        # {group: most_common(k) of its texts} for a group (split, class, ...) of every text
+        names, codes = np.unique(np.asarray(groups), return_inverse=True)
+        indicator = sp.csr_matrix((np.ones(len(codes), dtype=np.int64), (codes, np.arange(len(codes)))),
+                                  shape=(len(names), self.matrix.shape[0]))
+        per_group = (indicator @ self.matrix).toarray() if len(self.words) else np.zeros((len(names), 0))
+        return {name: self.top(per_group[i], k) for i, name in enumerate(names.tolist())}
+
+    def count(self, word, rows=None):
+        # How many times word is in the texts
+        column = self.vocabulary.get(word)
+        if column is None:
+            return 0
+        matrix = self.matrix if rows is None else self.matrix[np.asarray(rows)]
+        return int(matrix[:, column].sum())
+
+
+def counter_loop(texts, pattern=WORD_PATTERN):
+    # word_freq from the notebooks: a Counter for every text, added together
+    from collections import Counter
+    per_text = [Counter(re.findall(pattern, text)) for text in texts]
+    all_word_counts = Counter()
+    for freq in per_text:
+        all_word_counts.update(freq)
+    return all_word_counts
+
+
+if __name__ == '__main__':
+    import resource
+    parser = argparse.ArgumentParser(description='Time of the per-row Counters against TermCounts')
+    parser.add_argument('--texts', type=int, default=1000000, help='Number of synthetic texts')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--skip-counter', action='store_true', help='Only time TermCounts')
+    args = parser.parse_args()
+
+    # Texts like the emotion tweets: about 19 words from a vocabulary with a long tail
+    rng = np.random.default_rng(0)
+    vocabulary = np.array([f'w{i}' for i in range(50000)])
+    lengths = rng.integers(2, 36, args.texts)
+    starts = np.concatenate([[0], np.cumsum(lengths)])
+    words = vocabulary[np.minimum(rng.zipf(1.2, starts[-1]), len(vocabulary)) - 1]
+    texts = [' '.join(words[starts[i]:starts[i + 1]]) for i in range(args.texts)]
+    groups = rng.choice(['train', 'validation', 'test'], args.texts, p=[0.8, 0.1, 0.1])
+
+    if not args.skip_counter:
+        start = time.perf_counter()
+        expected = counter_loop(texts).most_common(10)
+        print(f"Counter per text: {time.perf_counter() - start:.1f} s")
+    start = time.perf_counter()
+    counts = TermCounts.from_texts(texts, workers=args.workers, chunk_size=args.chunk_size)
+    built = time.perf_counter() - start
+    top = counts.most_common(10)
+    by_split = counts.most_common_by(groups)
+    print(f"TermCounts ({args.workers} workers): {built:.1f} s to build, "
+          f"{time.perf_counter() - start - built:.2f} s for most_common and most_common_by")
+    matrix = counts.matrix
+    print(f"{matrix.shape[0]} texts, {matrix.shape[1]} words, {matrix.nnz} non-zeros, "
+          f"{(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes) / 1e6:.0f} MB matrix, "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    if not args.skip_counter:
+        print(f"Same top 10 as the Counter: {top == expected}")
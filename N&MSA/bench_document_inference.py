@@ -0,0 +1,97 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from transformers import pipeline
+from sentiment_engine import MODEL as SENTIMENT_MODEL, POOLINGS, SentimentEngine
+from zero_shot_engine import MODEL as ZERO_SHOT_MODEL, ZeroShotEngine
+
+# Documents/sec of the sentiment and zero-shot scoring: the per-post apply from the notebook (GetSentiment and
+# GetEmotions) against SentimentEngine and ZeroShotEngine (whole posts in overlapping windows, batched together).
+# The per-post apply is slow, so it is only timed on the first --sample posts.
+# python bench_document_inference.py --csv data_frame_sentiment.csv --documents 2000 --sample 50
+CANDIDATE_LABELS = ["Optimistic", "Excited", "Frustrated", "Pessimistic"]
+WORDS = ("gme stock moon hold buy sell short squeeze hedge fund not going up down today tomorrow price market "
+         "diamond hands rocket apes robinhood shares calls puts loss gain money big wallstreetbets").split()
+
+
+def synthetic_posts(count, seed=0):
+    # Posts of random words with a long tail of lengths, like the WallStreetBets bodies
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.lognormal(3.5, 1.2, count).astype(int), 1, 3000)
+    return [' '.join(rng.choice(WORDS, length)) for length in lengths]
+
+
+def get_positive_score(x):
+    # The same as in the notebook
+    if x["label"] == "POSITIVE":
+        res_x = x['score']
+    elif x["label"] == "NEGATIVE":
+        res_x = 1 - x['score']
+    else:
+        raise Exception(x["label"] + "This should not be possible")
+    return res_x * 2 - 1
+
+
+def per_post_sentiment(texts, model, reload):
+    # GetSentiment applied to every post. With reload, the pipeline is created for every post like in the notebook
+    classifier = None
+    for text in texts:
+        if classifier is None or reload:
+            classifier = pipeline("sentiment-analysis", model=model, padding=True, truncation=True, max_length=512,
+                                  device='cpu')
+        get_positive_score(classifier(text)[0])
+
+
+def per_post_zero_shot(texts, model):
+    # GetEmotions applied to every post, with the classifier loaded once like in the notebook
+    classifier = pipeline(task="zero-shot-classification", model=model, padding=True, truncation=True, max_length=512,
+                          device='cpu')
+    for text in texts:
+        classifier(text, CANDIDATE_LABELS)
+
+
+def documents_per_sec(function, texts):
+    start = time.perf_counter()
+    function(texts)
+    return len(texts) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Documents/sec of the per-post apply against the batched engines')
+    parser.add_argument('--csv', default=None, help='CSV with the posts (default: synthetic posts)')
+    parser.add_argument('--column', default='clean_body')
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--sample', type=int, default=50, help='Posts for the per-post apply')
+    parser.add_argument('--pooling', default='mean', choices=POOLINGS)
+    parser.add_argument('--sentiment-model', default=SENTIMENT_MODEL)
+    parser.add_argument('--zero-shot-model', default=ZERO_SHOT_MODEL)
+    parser.add_argument('--skip-zero-shot', action='store_true', help='bart-large-mnli is slow on a CPU')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.csv:
+        texts = pd.read_csv(args.csv)[args.column].dropna().astype(str).tolist()[:args.documents]
+    else:
+        texts = synthetic_posts(args.documents)
+    sample = texts[:args.sample]
+
+    results = []
+    results.append(('sentiment: GetSentiment (pipeline per post)', len(sample),
+                    documents_per_sec(lambda posts: per_post_sentiment(posts, args.sentiment_model, True), sample)))
+    results.append(('sentiment: pipeline loaded once, per post', len(sample),
+                    documents_per_sec(lambda posts: per_post_sentiment(posts, args.sentiment_model, False), sample)))
+    engine = SentimentEngine(args.sentiment_model, threads=args.threads)
+    results.append(('sentiment: engine, truncated at 512', len(texts), documents_per_sec(engine.score, texts)))
+    results.append((f'sentiment: engine, windows + {args.pooling}', len(texts),
+                    documents_per_sec(lambda posts: engine.score(posts, args.pooling), texts)))
+    if not args.skip_zero_shot:
+        results.append(('zero-shot: GetEmotions per post', len(sample),
+                        documents_per_sec(lambda posts: per_post_zero_shot(posts, args.zero_shot_model), sample)))
+        zero_shot = ZeroShotEngine(CANDIDATE_LABELS, args.zero_shot_model, threads=args.threads)
+        results.append((f'zero-shot: engine, windows + {args.pooling}', len(texts),
+                        documents_per_sec(lambda posts: zero_shot.classify(posts, args.pooling), texts)))
+
+    print(f"\n{'':<46}{'posts':>7}{'docs/s':>10}")
+    for name, count, speed in results:
+        print(f"{name:<46}{count:>7}{speed:>10.1f}")
@@ -0,0 +1,165 @@
+import itertools
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+# Sentiment scores for many posts with one loaded model.
+# GetSentiment in the notebook made a new pipeline (and loaded the model) for every post. SentimentEngine loads it
+# once, sorts the posts by length and runs them in batches that are only padded to the longest post in the batch,
+# so short posts are not padded to 512 tokens. The scores are the same as get_positive_score: from -1 (negative) to 1.
+# Posts longer than max_length tokens are truncated like in the pipeline, unless a pooling is given: then every post
+# is split into overlapping windows of max_length tokens, the windows of all the posts are batched together, and
+# the probabilities of the windows are pooled per post (see POOLINGS).
+# Usage:
+# from sentiment_engine import SentimentEngine
+# engine = SentimentEngine()
+# engine.score_dataframe(df, 'clean_body', 'sentiment_scores')                    # Truncated at 512 tokens
+# engine.score_dataframe(df, 'clean_body', 'sentiment_scores', pooling='mean')    # The whole post
+MODEL = "distilbert-base-uncased-finetuned-sst-2-english"
+# How the probabilities of the windows of a post are combined:
+# mean: average of the windows, weighted: average weighted by the number of tokens in the windows,
+# max: the highest probability of every class over the windows (normalized to sum to 1), first: only the first window
+POOLINGS = ['mean', 'weighted', 'max', 'first']
+
+
+def softmax(logits):
+    # The same softmax as the sentiment-analysis pipeline
+    maxes = np.max(logits, axis=-1, keepdims=True)
+    shifted_exp = np.exp(logits - maxes)
+    return shifted_exp / shifted_exp.sum(axis=-1, keepdims=True)
+
+
+def positive_scores(labels, scores):
+    # get_positive_score for arrays of labels and scores
+    labels = np.asarray(labels)
+    scores = np.asarray(scores, dtype=np.float64)
+    unknown = ~np.isin(labels, ["POSITIVE", "NEGATIVE"])
+    if unknown.any():
+        raise Exception(labels[unknown][0] + "This should not be possible")
+    positive = np.where(labels == "POSITIVE", scores, 1 - scores)
+    # The result is scaled as [0, 1], but we change the scale to [-1, 1]
+    return positive * 2 - 1
+
+
+def length_sorted_batches(lengths, batch_size, max_tokens):
+    # Lists of positions in lengths, shortest first, with at most batch_size items and max_tokens padded tokens
+    batch = []
+    for position in np.argsort(lengths, kind='stable'):
+        if batch and (len(batch) == batch_size or (len(batch) + 1) * lengths[position] > max_tokens):
+            yield batch
+            batch = []
+        batch.append(position)
+    if batch:
+        yield batch
+
+
+def split_windows(input_ids, size, stride):
+    # Windows of at most size tokens, where neighbouring windows share stride tokens. Always at least one window
+    step = max(1, size - stride)
+    starts = range(0, max(1, len(input_ids) - stride), step) if len(input_ids) > size else [0]
+    return [input_ids[start:start + size] for start in starts]
+
+
+def pool(probabilities, documents, weights, count, pooling='mean'):
+    # Combine the rows of probabilities (one per window) into count rows, one per document.
+    # documents is the document of every window, in order, and weights its number of tokens
+    if pooling not in POOLINGS:
+        raise ValueError(f"Unknown pooling {pooling}, use one of {', '.join(POOLINGS)}")
+    pooled = np.zeros((count, probabilities.shape[1]), dtype=np.float64)
+    if pooling == 'first':
+        first = np.unique(documents, return_index=True)[1]
+        pooled[documents[first]] = probabilities[first]
+        return pooled
+    if pooling == 'max':
+        np.maximum.at(pooled, documents, probabilities)
+        return pooled / pooled.sum(axis=1, keepdims=True)
+    weights = np.ones(len(documents)) if pooling == 'mean' else np.asarray(weights, dtype=np.float64)
+    np.add.at(pooled, documents, probabilities * weights[:, None])
+    return pooled / np.bincount(documents, weights, minlength=count)[:, None]
+
+
+def special_tokens(tokenizer, pair=False):
+    # The special token ids the tokenizer puts around one text ([prefix, suffix]) or a pair of texts
+    # ([prefix, middle, suffix]), e.g. [[CLS], [SEP]] for BERT or [<s>, </s></s>, </s>] for BART
+    encoded = tokenizer(*(['a', 'b'] if pair else ['a']), return_special_tokens_mask=True)
+    tokens = zip(encoded['input_ids'], encoded['special_tokens_mask'])
+    parts = [[]]
+    for special, run in itertools.groupby(tokens, key=lambda token: token[1]):
+        if special:
+            parts[-1] = [token for token, _ in run]
+        else:
+            parts.append([])
+    return parts
+
+
+def windows_of(tokenizer, texts, size, stride):
+    # The windows of all the texts (token ids without special tokens), the text of every window and its length.
+    # The texts are tokenized once, without truncation
+    windows, documents = [], []
+    for document, input_ids in enumerate(tokenizer(list(texts), add_special_tokens=False, verbose=False)['input_ids']):
+        for window in split_windows(input_ids, size, stride):
+            windows.append(window)
+            documents.append(document)
+    return windows, np.array(documents, dtype=np.int64), np.array([len(window) for window in windows])
+
+
+class SentimentEngine:
+    def __init__(self, model=MODEL, max_length=512, batch_size=64, max_tokens=16384, stride=64, threads=None):
+        # max_tokens limits batch size * padded length, so a batch of long posts is smaller than one of short posts.
+        # stride is the number of tokens shared by neighbouring windows of a long post
+        if threads:
+            torch.set_num_threads(threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model).eval()
+        self.labels = np.array([self.model.config.id2label[i] for i in range(self.model.config.num_labels)])
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.stride = stride
+
+    def probabilities(self, sequences):
+        # Class probabilities of token id sequences (with the special tokens), in length-sorted batches
+        result = np.zeros((len(sequences), len(self.labels)), dtype=np.float32)
+        lengths = np.array([len(sequence) for sequence in sequences])
+        with torch.inference_mode():
+            for batch in length_sorted_batches(lengths, self.batch_size, self.max_tokens):
+                inputs = self.tokenizer.pad({'input_ids': [sequences[i] for i in batch]}, return_tensors='pt')
+                result[batch] = softmax(self.model(**inputs).logits.float().numpy())
+        return result
+
+    def predict(self, texts, pooling=None):
+        # (labels, scores) like the pipeline: the most likely label of every text and its probability.
+        # With a pooling, the whole text is used instead of the first max_length tokens
+        if pooling is None:
+            encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+            probabilities = self.probabilities(encoded['input_ids'])
+        else:
+            size = self.max_length - self.tokenizer.num_special_tokens_to_add()
+            windows, documents, lengths = windows_of(self.tokenizer, texts, size, self.stride)
+            prefix, suffix = special_tokens(self.tokenizer)
+            sequences = [prefix + window + suffix for window in windows]
+            probabilities = pool(self.probabilities(sequences), documents, lengths, len(texts), pooling)
+        return self.labels[probabilities.argmax(axis=1)], probabilities.max(axis=1)
+
+    def score(self, texts, pooling=None):
+        # Sentiment scores from -1 to 1, in the order of texts
+        labels, scores = self.predict(texts, pooling)
+        return positive_scores(labels, scores)
+
+    def score_chunks(self, texts, chunk_size=10000, pooling=None):
+        # (start, scores) for every chunk_size texts, so a few million posts are not tokenized at once
+        for start in range(0, len(texts), chunk_size):
+            yield start, self.score(texts[start:start + chunk_size], pooling)
+
+    def score_dataframe(self, df, column='clean_body', output_column='sentiment_scores', chunk_size=10000, pooling=None,
+                        verbose=True):
+        # Write the scores of df[column] to df[output_column], one chunk at a time. The rows that are not scored yet
+        # are NaN, so the finished chunks are kept if it is stopped
+        texts = df[column].tolist()
+        df[output_column] = np.nan
+        position = df.columns.get_loc(output_column)
+        for start, scores in self.score_chunks(texts, chunk_size, pooling):
+            df.iloc[start:start + len(scores), position] = scores
+            if verbose:
+                print(f"{start + len(scores)}/{len(texts)} posts")
+        return df
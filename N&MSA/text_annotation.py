@@ -0,0 +1,113 @@
+import hashlib
+import os
+import re
+import spacy
+from spacy.tokens import DocBin
+
+# Cleaned text, ORG entities and lemmatized text of every post from one spaCy pass.
+# The notebook ran the whole pipeline over every post three times (clean_text, extract_org and word_freq), one
+# post at a time. TextAnnotator parses every post once with nlp.pipe (in batches, optionally in several processes),
+# only with the components the requested outputs need, and takes all the outputs from the same Doc.
+# With a store folder, the parsed Docs are saved as DocBin files (one per chunk of posts, named by a hash of the
+# posts and the pipeline), so a rerun loads them instead of parsing again.
+# Usage:
+# from text_annotation import TextAnnotator
+# annotator = TextAnnotator(nlp, store='spacy_docs', n_process=4)
+# df = annotator.annotate_dataframe(df, 'body')    # Adds clean_body, organizations_body and lemmas
+MODEL = "en_core_web_sm"
+# The components every output needs. Stopwords are lexical, so clean_body needs none
+OUTPUTS = {'clean_body': [], 'organizations_body': ['ner'],
+           'lemmas': ['tagger', 'attribute_ruler', 'lemmatizer']}
+# The token attributes saved in the store, enough for all the outputs
+ATTRS = ['ORTH', 'SPACY', 'LEMMA', 'ENT_IOB', 'ENT_TYPE']
+
+
+def pre_clean(text):
+    # The part of clean_text before spaCy
+    cleaned_text = re.sub(r'http\S+|www\.\S+', '', text)  # Remove URL's
+    cleaned_text = cleaned_text.strip()  # Strip leading and trailing whitespace
+    cleaned_text = " ".join(cleaned_text.split())  # Remove extra spaces between words
+    cleaned_text = re.sub(r'\d+', '', cleaned_text)  # Remove numbers
+    cleaned_text = re.sub(r'[^A-Za-z\s.?!]', ' ', cleaned_text)  # Remove special characters
+    return cleaned_text
+
+
+def clean_body(doc):
+    # Remove stopwords, like clean_text
+    return " ".join([token.text for token in doc if not token.is_stop or token.text.lower() == "not"])
+
+
+def organizations(doc):
+    # Like extract_org
+    return [ent.text for ent in doc.ents if ent.label_ == "ORG"]
+
+
+def lemmas(doc):
+    # The lemmatized text of word_freq, in lowercase because the notebook counted the words after making the text
+    # lowercase. The words are counted with word_counts.TermCounts
+    return ' '.join([token.lemma_.lower() for token in doc
+                     if not token.is_stop and token.is_alpha and len(token.lemma_) > 1])
+
+
+EXTRACTORS = {'clean_body': clean_body, 'organizations_body': organizations, 'lemmas': lemmas}
+
+
+class TextAnnotator:
+    def __init__(self, nlp=MODEL, outputs=tuple(OUTPUTS), store=None, batch_size=256, n_process=1,
+                 chunk_size=10000):
+        # nlp is a loaded pipeline or the name of one. chunk_size posts are parsed and saved at a time
+        self.nlp = spacy.load(nlp) if isinstance(nlp, str) else nlp
+        self.outputs = list(outputs)
+        needed = {component for output in self.outputs for component in OUTPUTS[output]}
+        # Shared tok2vec/transformer layers are needed by the components that listen to them
+        for name, component in self.nlp.pipeline:
+            if needed & set(getattr(component, 'listening_components', [])):
+                needed.add(name)
+        self.enabled = [name for name in self.nlp.pipe_names if name in needed]
+        self.disabled = [name for name in self.nlp.pipe_names if name not in needed]
+        self.store = store
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.chunk_size = chunk_size
+        if store:
+            os.makedirs(store, exist_ok=True)
+
+    def store_path(self, texts):
+        # The DocBin file of these texts, which changes with the texts, the pipeline and its enabled components
+        key = hashlib.sha1(f"{self.nlp.meta.get('name')}-{self.nlp.meta.get('version')}-{self.enabled}".encode())
+        for text in texts:
+            key.update(text.encode())
+            key.update(b'\0')
+        return os.path.join(self.store, f"{key.hexdigest()}.spacy")
+
+    def parse(self, texts):
+        # Docs of pre-cleaned texts, in order
+        return list(self.nlp.pipe(texts, batch_size=self.batch_size, n_process=self.n_process,
+                                  disable=self.disabled))
+
+    def docs(self, texts):
+        # Docs of the texts, chunk_size at a time, from the store when they were parsed before
+        for start in range(0, len(texts), self.chunk_size):
+            chunk = [pre_clean(text) for text in texts[start:start + self.chunk_size]]
+            path = self.store_path(chunk) if self.store else None
+            if path and os.path.exists(path):
+                yield from DocBin().from_disk(path).get_docs(self.nlp.vocab)
+                continue
+            docs = self.parse(chunk)
+            if path:
+                DocBin(attrs=ATTRS, docs=docs).to_disk(path)
+            yield from docs
+
+    def annotate(self, texts):
+        # {output: [value of every text]} for the outputs
+        result = {output: [] for output in self.outputs}
+        for doc in self.docs(list(texts)):
+            for output in self.outputs:
+                result[output].append(EXTRACTORS[output](doc))
+        return result
+
+    def annotate_dataframe(self, df, column='body'):
+        # Add a column for every output
+        for output, values in self.annotate(df[column]).items():
+            df[output] = values
+        return df
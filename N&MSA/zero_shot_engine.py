@@ -0,0 +1,82 @@
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from sentiment_engine import length_sorted_batches, pool, special_tokens, windows_of
+
+# Zero-shot emotion scores for many posts with one loaded NLI model (facebook/bart-large-mnli).
+# The zero-shot pipeline in GetEmotions runs one post at a time. ZeroShotEngine tokenizes all the posts once, splits
+# the long ones into overlapping windows, and pairs every window with the hypothesis of every candidate label.
+# All the pairs of a window are in the same batch, and the windows of many posts are batched together by length.
+# The label scores of a window are computed like the pipeline (softmax of the entailment logits over the labels),
+# and pooled per post with one of the poolings in sentiment_engine.POOLINGS.
+# Usage:
+# from zero_shot_engine import ZeroShotEngine
+# zero_shot = ZeroShotEngine(candidate_labels=["Optimistic", "Excited", "Frustrated", "Pessimistic"])
+# df = zero_shot.classify_dataframe(df, 'clean_body', 'zeroshot')
+MODEL = "facebook/bart-large-mnli"
+
+
+class ZeroShotEngine:
+    def __init__(self, candidate_labels, model=MODEL, hypothesis_template="This example is {}.", max_length=512,
+                 batch_size=64, max_tokens=16384, stride=64, threads=None):
+        # batch_size and max_tokens count (window, label) pairs, like in SentimentEngine
+        if threads:
+            torch.set_num_threads(threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model).eval()
+        label2id = {label.lower(): i for label, i in self.model.config.label2id.items()}
+        self.entailment_id = next((i for label, i in label2id.items() if label.startswith('entail')), -1)
+        self.candidate_labels = list(candidate_labels)
+        self.hypotheses = self.tokenizer([hypothesis_template.format(label) for label in self.candidate_labels],
+                                         add_special_tokens=False)['input_ids']
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.stride = stride
+
+    def window_scores(self, windows):
+        # Scores of the candidate labels for every window (token ids of the post, without special tokens)
+        labels = len(self.candidate_labels)
+        result = np.zeros((len(windows), labels), dtype=np.float32)
+        prefix, middle, suffix = special_tokens(self.tokenizer, pair=True)
+        longest_hypothesis = max(len(hypothesis) for hypothesis in self.hypotheses)
+        lengths = np.array([len(window) + longest_hypothesis for window in windows])
+        with torch.inference_mode():
+            for batch in length_sorted_batches(lengths, max(1, self.batch_size // labels), self.max_tokens // labels):
+                pairs = [prefix + windows[i] + middle + hypothesis + suffix
+                         for i in batch for hypothesis in self.hypotheses]
+                inputs = self.tokenizer.pad({'input_ids': pairs}, return_tensors='pt')
+                logits = self.model(**inputs).logits.float().numpy()
+                entailment = logits[:, self.entailment_id].reshape(len(batch), labels)
+                # Softmax over the labels, the same as the pipeline with multi_label=False
+                result[batch] = np.exp(entailment) / np.exp(entailment).sum(-1, keepdims=True)
+        return result
+
+    def classify(self, texts, pooling='mean'):
+        # Scores of the candidate labels for every text, in the order of candidate_labels
+        longest_hypothesis = max(len(hypothesis) for hypothesis in self.hypotheses)
+        size = self.max_length - self.tokenizer.num_special_tokens_to_add(pair=True) - longest_hypothesis
+        windows, documents, lengths = windows_of(self.tokenizer, texts, size, self.stride)
+        return pool(self.window_scores(windows), documents, lengths, len(texts), pooling)
+
+    def classify_dataframe(self, df, column='clean_body', output_column='zeroshot', chunk_size=10000, pooling='mean',
+                           verbose=True):
+        # Write {"labels": candidate_labels, "scores": [...]} for every row to df[output_column] like GetEmotions,
+        # one chunk at a time
+        texts = df[column].tolist()
+        df[output_column] = None
+        position = df.columns.get_loc(output_column)
+        for start in range(0, len(texts), chunk_size):
+            scores = self.classify(texts[start:start + chunk_size], pooling)
+            df.iloc[start:start + len(scores), position] = object_array(
+                [{"labels": self.candidate_labels, "scores": row} for row in scores.tolist()])
+            if verbose:
+                print(f"{start + len(scores)}/{len(texts)} posts")
+        return df
+
+
+def object_array(values):
+    # A 1-d object array, so pandas stores the dicts as they are
+    result = np.empty(len(values), dtype=object)
+    result[:] = values
+    return result
@@ -0,0 +1,118 @@
+import copy
+
+
+SELECTIONS = ['Afrejser', 'Ankomster']
+
+
+# Trip aggregates for map_dash.py, computed from the raw trip counts in MapData.csv.
+# Per-municipality and per-region totals, per-capita rates and top-k rankings are computed in one
+# vectorized pass when the data is loaded, and exposed as lookup tables for the callbacks.
+# Region summary rows in the input (rows where 'Kommune Kode' is a region code) are not needed.
+# If they are there, only their coordinates are used, as the centre of the region on the map.
+# The per-capita rate of a region is its trips over its inhabitants (e.g. about 74 for Hovedstaden). The summary rows
+# held the sum of the rates of the municipalities (about 1420 for Hovedstaden), which is not a rate, so numbers quoted
+# from the old region map and bar chart are not comparable with the new ones.
+class TripAggregates:
+    def __init__(self, map_data, region_code_to_name, top_k=5):
+        self.region_code_to_name = region_code_to_name
+        self.top_k = top_k
+
+        region_codes = [int(code) for code in region_code_to_name]
+        is_summary = map_data['Kommune Kode'].isin(region_codes)
+        summary_rows = map_data[is_summary].set_index('Region')
+
+        municipalities = map_data[~is_summary & map_data['Kommune'].notna()].copy()
+        for selection in SELECTIONS:
+            municipalities[f'{selection} pr. Indbygger'] = per_capita(municipalities[selection], municipalities['Indbyggertal'])
+        self.municipalities = municipalities.reset_index(drop=True)
+        self.regions = self._aggregate_regions(summary_rows)
+
+        # Lookup tables
+        self.municipalities_by_region = {region: frame for region, frame in self.municipalities.groupby('Region', sort=False)}
+        self.municipality_centre = dict(zip(self.municipalities['Kommune'], zip(self.municipalities['lat'], self.municipalities['lon'])))
+        self.region_centre = dict(zip(self.regions['Region'], zip(self.regions['lat'], self.regions['lon'])))
+        self.top_municipalities = self._rank_municipalities()
+
+    def _aggregate_regions(self, summary_rows):
+        # One groupby over the municipalities for all the region totals.
+        # The centre of a region is the population-weighted mean of its municipalities
+        weights = self.municipalities['Indbyggertal'].fillna(0)
+        columns = self.municipalities.assign(
+            lat_weighted=self.municipalities['lat'] * weights,
+            lon_weighted=self.municipalities['lon'] * weights,
+            weight=weights)
+        regions = columns.groupby('Region', sort=False).agg(
+            Afrejser=('Afrejser', 'sum'),
+            Ankomster=('Ankomster', 'sum'),
+            Indbyggertal=('Indbyggertal', 'sum'),
+            lat_weighted=('lat_weighted', 'sum'),
+            lon_weighted=('lon_weighted', 'sum'),
+            weight=('weight', 'sum'),
+            lat_mean=('lat', 'mean'),
+            lon_mean=('lon', 'mean'),
+        )
+        for selection in SELECTIONS:
+            regions[f'{selection} pr. Indbygger'] = per_capita(regions[selection], regions['Indbyggertal'])
+
+        has_weight = regions['weight'] > 0
+        regions['lat'] = (regions['lat_weighted'] / regions['weight']).where(has_weight, regions['lat_mean'])
+        regions['lon'] = (regions['lon_weighted'] / regions['weight']).where(has_weight, regions['lon_mean'])
+        if not summary_rows.empty:
+            regions['lat'] = summary_rows['lat'].reindex(regions.index).fillna(regions['lat'])
+            regions['lon'] = summary_rows['lon'].reindex(regions.index).fillna(regions['lon'])
+
+        name_to_code = {name: int(code) for code, name in self.region_code_to_name.items()}
+        regions = regions.reset_index()
+        regions['Kommune Kode'] = regions['Region'].map(name_to_code)
+        regions['Coordinates'] = regions['lat'].astype(str) + ',' + regions['lon'].astype(str)
+        return regions.drop(columns=['lat_weighted', 'lon_weighted', 'weight', 'lat_mean', 'lon_mean'])
+
+    def _rank_municipalities(self, regions=None):
+        # (region, selection) -> the top_k municipalities in the region, sorted by the per-capita rate.
+        # The stable sort keeps the order of the file for ties, the same as nlargest
+        municipalities = self.municipalities
+        if regions is not None:
+            municipalities = municipalities[municipalities['Region'].isin(regions)]
+        top = {}
+        for selection in SELECTIONS:
+            column = f'{selection} pr. Indbygger'
+            ranked = municipalities.sort_values(column, ascending=False, kind='stable')
+            for region, frame in ranked.groupby('Region', sort=False).head(self.top_k).groupby('Region', sort=False):
+                top[(region, selection)] = frame
+        return top
+
+    def add_trips(self, municipality_trips):
+        # New aggregates with more trips added. municipality_trips has the municipality names as index
+        # and the columns Afrejser and Ankomster. Only the affected municipalities, regions and rankings
+        # are recomputed, the rest is shared with this object. This object is not changed, so callbacks
+        # that still use it see the old numbers until they are done
+        updated = copy.copy(self)
+        municipalities = self.municipalities.copy()
+        rows = municipalities['Kommune'].isin(municipality_trips.index)
+        deltas = municipality_trips.reindex(municipalities.loc[rows, 'Kommune']).fillna(0)
+        deltas.index = municipalities.index[rows]
+        for selection in SELECTIONS:
+            municipalities.loc[rows, selection] = municipalities.loc[rows, selection].fillna(0) + deltas[selection]
+            municipalities.loc[rows, f'{selection} pr. Indbygger'] = per_capita(municipalities.loc[rows, selection], municipalities.loc[rows, 'Indbyggertal'])
+
+        # The region totals get the sum of the new trips in their municipalities
+        region_deltas = deltas.groupby(municipalities.loc[rows, 'Region']).sum()
+        regions = self.regions.copy()
+        region_rows = regions['Region'].isin(region_deltas.index)
+        for selection in SELECTIONS:
+            regions.loc[region_rows, selection] += region_deltas[selection].reindex(regions.loc[region_rows, 'Region']).to_numpy()
+            regions.loc[region_rows, f'{selection} pr. Indbygger'] = per_capita(regions.loc[region_rows, selection], regions.loc[region_rows, 'Indbyggertal'])
+
+        updated.municipalities = municipalities
+        updated.regions = regions
+        updated.municipalities_by_region = dict(self.municipalities_by_region)
+        for region in region_deltas.index:
+            updated.municipalities_by_region[region] = municipalities[municipalities['Region'] == region]
+        updated.top_municipalities = dict(self.top_municipalities)
+        updated.top_municipalities.update(updated._rank_municipalities(set(region_deltas.index)))
+        return updated
+
+
+def per_capita(trips, population):
+    # Trips per inhabitant, rounded like in MapData.csv. Municipalities without data get 0
+    return (trips / population).round(2).fillna(0)
@@ -0,0 +1,67 @@
+import time
+import map_dash as app
+from build_cache import dissolve_geometry
+from geo_prep import GEOMETRY_TIERS, full_geometry, tier_for_zoom
+
+
+# Benchmark of the choropleth payloads with the full geometry and with every simplified geometry tier from geo_prep.py.
+# The maps are built from the same aggregated data and geometry tiers as the app renders (without the figure cache).
+# The tier the app uses for a view is marked with *.
+# Run it from the Visuzalization folder: python bench_geometry.py
+REGION_ZOOM = 5.9
+MUNICIPALITY_ZOOM = 7.1
+
+
+def measure(build, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = build().to_json()
+        timings.append(time.perf_counter() - start)
+    return len(payload.encode('utf-8')), min(timings) * 1000
+
+
+def bench_region_view(tier, aggregates, selection='Afrejser'):
+    return measure(lambda: app.create_map(
+        type="choropleth_map_region",
+        dataset=aggregates.regions,
+        geojsonVal=full_regions if tier == 'full' else app.geojson_regions[tier],
+        zoom=REGION_ZOOM,
+        color_column=f'{selection} pr. Indbygger'))
+
+
+def bench_municipality_view(region_code, tier, aggregates, selection='Afrejser'):
+    region_name = app.region_code_to_name[region_code]
+    lat, lon = aggregates.region_centre[region_name]
+    return measure(lambda: app.create_map(
+        type="choropleth_map_municipality",
+        dataset=aggregates.municipalities_by_region[region_name],
+        geojsonVal=(full_municipalities_by_region[region_code] if tier == 'full'
+                    else app.geojson_municipalities_by_region[region_code][tier]),
+        center_lat=lat,
+        center_lon=lon,
+        zoom=MUNICIPALITY_ZOOM,
+        color_column=f'{selection} pr. Indbygger'))
+
+
+def print_row(view, tier, served, size, ms):
+    label = f"{tier}{'*' if tier == served else ''}"
+    print(f"{view:<30}{label:<8}{size:>12}{ms:>10.1f}")
+
+
+if __name__ == '__main__':
+    # The prepared data only has the simplified tiers, so the full geometry is built here
+    gdf_municipalities, gdf_regions = dissolve_geometry()
+    full_regions = full_geometry(gdf_regions)
+    full_municipalities_by_region = app.build_region_index(full_geometry(gdf_municipalities),
+                                                           app.trip_aggregates.municipalities)
+    aggregates = app.live_data.snapshot.aggregates
+    tiers = ['full', *GEOMETRY_TIERS]
+
+    print(f"{'view':<30}{'tier':<8}{'bytes':>12}{'ms':>10}")
+    for tier in tiers:
+        print_row('Hele landet', tier, tier_for_zoom(REGION_ZOOM), *bench_region_view(tier, aggregates))
+    for region_code, region_name in app.region_code_to_name.items():
+        for tier in tiers:
+            print_row(region_name, tier, tier_for_zoom(MUNICIPALITY_ZOOM),
+                      *bench_municipality_view(region_code, tier, aggregates))
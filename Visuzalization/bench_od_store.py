@@ -0,0 +1,53 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from od_store import ODStore
+
+
+# Benchmark of the bubble chart lookup on synthetic OD tables.
+# Compares the boolean scan used before (scatter_data['Fra Station:'] == station) with ODStore.
+# Run it from the Visuzalization folder: python bench_od_store.py [rows ...]
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+
+
+def synthetic_od_table(rows, seed=42):
+    # The OD matrix grows quadratically with the stations, so rows ~ stations^2
+    rng = np.random.default_rng(seed)
+    n_stations = max(2, int(np.sqrt(rows)))
+    names = np.array([f'Station {i}' for i in range(n_stations)], dtype=object)
+    return pd.DataFrame({
+        'Fra Station:': names[rng.integers(0, n_stations, rows)],
+        'Til Station:': names[rng.integers(0, n_stations, rows)],
+        'Gennemsnitlig Rejsetid': rng.random(rows) * 120,
+        'Antal Rejser': rng.integers(1, 5000, rows),
+    }), names
+
+
+def boolean_scan(od_data, station):
+    df_station_click = od_data[od_data['Fra Station:'] == station].copy()
+    df_station_click['Gennemsnitlig Rejsetid'] = df_station_click['Gennemsnitlig Rejsetid'].round(2)
+    return df_station_click
+
+
+def time_lookups(lookup, stations):
+    start = time.perf_counter()
+    for station in stations:
+        lookup(station)
+    return (time.perf_counter() - start) / len(stations) * 1000
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    print(f"{'rows':>12}{'build s':>10}{'scan ms':>12}{'store ms':>12}{'speedup':>10}")
+    for rows in sizes:
+        od_data, names = synthetic_od_table(rows)
+        stations = np.random.default_rng(0).choice(names, 20)
+
+        start = time.perf_counter()
+        store = ODStore(od_data)
+        build_time = time.perf_counter() - start
+
+        scan_ms = time_lookups(lambda station: boolean_scan(od_data, station), stations)
+        store_ms = time_lookups(store.from_station, stations)
+        print(f"{rows:>12}{build_time:>10.2f}{scan_ms:>12.3f}{store_ms:>12.3f}{scan_ms / store_ms:>9.0f}x")
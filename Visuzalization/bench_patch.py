@@ -0,0 +1,39 @@
+import json
+import plotly
+import map_dash as app
+
+
+# Response bytes for each transition, with full figures and with the Patch updates used in map_dash.py.
+# Run it from the Visuzalization folder: python bench_patch.py
+def size(*outputs):
+    return sum(len(json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder)) for output in outputs)
+
+
+def transitions(region_code, municipality_name, station):
+    region_map, region_bar = app.region_figures(region_code, 'Afrejser')
+    region_map_ank, region_bar_ank = app.region_figures(region_code, 'Ankomster')
+    municipality_map, municipality_bar = app.municipality_figures(municipality_name, 'Afrejser')
+    municipality_map_ank, municipality_bar_ank = app.municipality_figures(municipality_name, 'Ankomster')
+    highlight = app.station_highlight(municipality_name, station, 'Afrejser')
+
+    # (transition, full figures, patches)
+    return [
+        ('Region -> municipalities (bar)', [region_bar], [app.bar_patch(region_bar)]),
+        ('Municipality -> stations (bar)', [municipality_bar], [app.bar_patch(municipality_bar)]),
+        ('Station highlight (map + bar)', [municipality_map, municipality_bar], list(highlight)),
+        ('Recolour municipalities (map + bar)', [region_map_ank, region_bar_ank],
+         [app.recolour_patch(region_map_ank), app.bar_patch(region_bar_ank)]),
+        ('Recolour stations (map + bar)', [municipality_map_ank, municipality_bar_ank],
+         [app.recolour_patch(municipality_map_ank), app.bar_patch(municipality_bar_ank)]),
+    ]
+
+
+if __name__ == '__main__':
+    region_code = '1084'
+    municipality_name = next(iter(app.stations_by_municipality))
+    station = app.stations_by_municipality[municipality_name]['stop_name'].iloc[0]
+
+    print(f"Region {app.region_code_to_name[region_code]}, municipality {municipality_name}, station {station}")
+    print(f"{'transition':<40}{'full bytes':>12}{'patch bytes':>13}")
+    for name, full, patches in transitions(region_code, municipality_name, station):
+        print(f"{name:<40}{size(*full):>12}{size(*patches):>13}")
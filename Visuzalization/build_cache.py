@@ -0,0 +1,155 @@
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Build step for the prepared data used by map_dash.py.
+# Dissolving the GeoJSON files with geopandas and merging the stations is slow, so it is done
+# once and written to the prepared/ folder. The app loads the artifacts without importing geopandas.
+# The cache is rebuilt when one of the source files changes (checked with their SHA-256 hash).
+# Run it from the Visuzalization folder: python build_cache.py
+CACHE_DIR = 'prepared'
+MANIFEST = os.path.join(CACHE_DIR, 'manifest.json')
+ARTIFACTS = os.path.join(CACHE_DIR, 'artifacts.pkl')
+LOCK = os.path.join(CACHE_DIR, '.lock')
+
+# geo_prep.py holds the simplification settings, so a change to them also rebuilds the cache
+SOURCE_FILES = ['municipalities.geojson', 'regioner.geojson', 'filtered_gtfs_stops.csv', 'geo_prep.py']
+
+STATION_COLUMNS = ['stop_id','stop_code','stop_name','stop_desc','stop_lat','stop_lon','location_type','parent_station','wheelchair_boarding','platform_code','total_rejser']
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_hashes():
+    hashes = {path: file_hash(path) for path in SOURCE_FILES}
+    # The station merge also depends on vsl_data, so its source file is part of the key
+    spec = importlib.util.find_spec('vsl_data')
+    if spec is not None and spec.origin and os.path.isfile(spec.origin):
+        hashes['vsl_data'] = file_hash(spec.origin)
+    return hashes
+
+
+def dissolve_geometry():
+    # (municipalities, regions) as GeoDataFrames with one row per municipality and per region
+    import geopandas as gpd
+
+    with open('municipalities.geojson', encoding='utf-8') as f:
+        gdf_municipalities = gpd.read_file(f)
+    gdf_municipalities_grouped = gdf_municipalities.dissolve(
+        by='lau_1',
+        aggfunc='first'  # Aggregation logic to retain attributes
+    )
+    gdf_municipalities_grouped["lau_1"] = gdf_municipalities_grouped.index
+
+    with open('regioner.geojson', encoding='utf-8') as f:
+        gdf_regions = gpd.read_file(f)
+    gdf_regions_grouped = gdf_regions.dissolve(by='REGIONKODE')
+    return gdf_municipalities_grouped, gdf_regions_grouped
+
+
+def prepare_geometry():
+    from geo_prep import build_geometry_tiers
+
+    gdf_municipalities_grouped, gdf_regions_grouped = dissolve_geometry()
+    # Simplified geometry for each zoom level, see geo_prep.py
+    return build_geometry_tiers(gdf_municipalities_grouped), build_geometry_tiers(gdf_regions_grouped)
+
+
+def prepare_stations():
+    import pandas as pd
+    import vsl_data as data
+
+    df_stations = pd.read_csv(
+        'filtered_gtfs_stops.csv', delimiter=',', encoding='utf-8',
+        names=STATION_COLUMNS
+    )
+    df_stations['total_rejser'] = pd.to_numeric(df_stations['total_rejser'], errors='coerce')
+    df_stations = pd.merge(df_stations, data.total_rejser_stationer, how='left', left_on='stop_name', right_on='Station')
+    df_stations = df_stations.drop(columns='Station')
+    return df_stations
+
+
+def write_atomic(path, write, mode='wb'):
+    # Write to a temporary file in the same folder and move it into place, so a reader never sees half a file.
+    # The temporary name is per process, so two processes that write at the same time do not mix their files
+    temporary = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, mode) as f:
+            write(f)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+@contextlib.contextmanager
+def build_lock():
+    # Only one process (e.g. one of the gunicorn workers starting at the same time) rebuilds the cache.
+    # The others wait and then load what it wrote. Without fcntl (Windows) there is no lock
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(LOCK, 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build(hashes=None):
+    hashes = hashes or source_hashes()
+    geojson_municipalities, geojson_regions = prepare_geometry()
+    artifacts = {
+        'geojson_municipalities': geojson_municipalities,
+        'geojson_regions': geojson_regions,
+        'df_stations': prepare_stations(),
+    }
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # The manifest is written last, so the artifacts are only used once they are complete
+    write_atomic(ARTIFACTS, lambda f: pickle.dump(artifacts, f, protocol=pickle.HIGHEST_PROTOCOL))
+    write_atomic(MANIFEST, lambda f: json.dump({'sources': hashes}, f, indent=2), mode='w')
+    return artifacts
+
+
+def is_stale(hashes):
+    if not (os.path.exists(MANIFEST) and os.path.exists(ARTIFACTS)):
+        return True
+    with open(MANIFEST, encoding='utf-8') as f:
+        manifest = json.load(f)
+    return manifest.get('sources') != hashes
+
+
+def load():
+    # Load the prepared artifacts, and rebuild them first if a source file has changed
+    hashes = source_hashes()
+    if is_stale(hashes):
+        with build_lock():
+            # Another process may have rebuilt it while this one waited for the lock
+            if is_stale(hashes):
+                print('Prepared data is missing or out of date. Rebuilding it...')
+                return build(hashes)
+    with open(ARTIFACTS, 'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+    with build_lock():
+        artifacts = build()
+    print(f"Wrote {ARTIFACTS} ({os.path.getsize(ARTIFACTS)} bytes)")
@@ -0,0 +1,64 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+# Bounded cache for the figures used in map_dash.py.
+# The app only has a small, fixed set of states (national view, 5 regions, ~98 municipalities
+# and the stations, times Afrejser/Ankomster), so most callbacks can be served from here.
+# The figures are stored as plain JSON dicts, so Dash can send them without rebuilding anything.
+class FigureCache:
+    def __init__(self, maxsize=512, metrics=None):
+        self.maxsize = maxsize
+        self.metrics = metrics  # Records the time spent converting the figures to JSON, see metrics.py
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        # key is a tuple like (figure, level, entity, selection)
+        with self._lock:
+            if key in self._figures:
+                self._figures.move_to_end(key)
+                self.hits += 1
+                return self._figures[key]
+
+        # Build outside the lock, so one slow figure does not block the other users
+        figure = build()
+        start = time.perf_counter()
+        figure = json.loads(figure.to_json())
+        if self.metrics is not None:
+            self.metrics.observe('stage_seconds', time.perf_counter() - start, stage='to_json', figure=key[0])
+
+        with self._lock:
+            self.misses += 1
+            self._figures[key] = figure
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.maxsize:
+                self._figures.popitem(last=False)  # Evict the least recently used figure
+        return figure
+
+    def invalidate(self, match=None):
+        # Remove every figure, or only the ones where match(key) is True
+        with self._lock:
+            if match is None:
+                self._figures.clear()
+            else:
+                for key in [key for key in self._figures if match(key)]:
+                    del self._figures[key]
+
+    def migrate(self, update):
+        # Replace every key with update(key), or remove the figure if it returns None.
+        # Used when new data arrives: the figures that did not change are kept under the new key
+        with self._lock:
+            figures = OrderedDict()
+            for key, figure in self._figures.items():
+                new_key = update(key)
+                if new_key is not None:
+                    figures[new_key] = figure
+            self._figures = figures
+
+    def __len__(self):
+        return len(self._figures)
@@ -0,0 +1,51 @@
+import json
+
+
+# Geometry tiers for the choropleth maps.
+# The national region view is shown at zoom 5.9 and the municipality view at zoom 7.1,
+# so neither of them needs the full coastline resolution from the GeoJSON files.
+# tolerance: simplification tolerance in degrees. grid_size: coordinates are snapped to this grid.
+# The full resolution is not part of the prepared data (only bench_geometry.py uses it), see full_geometry.
+GEOMETRY_TIERS = {
+    'coarse': {'max_zoom': 6.5, 'tolerance': 0.005, 'grid_size': 0.001},  # Region view (zoom 5.9)
+    'fine': {'max_zoom': None, 'tolerance': 0.001, 'grid_size': 0.0002},  # Municipality view (zoom 7.1)
+}
+
+
+def simplify_geometry(gdf, tolerance, grid_size):
+    # Simplification of the polygons as a coverage: every border shared by two neighbours is simplified once,
+    # so both keep the same border and no slivers or gaps open between them (simplifying each polygon on its own
+    # did that). Then the coordinates are quantized to grid_size. Needs shapely 2.1 or newer with GEOS 3.12
+    import shapely
+
+    simplified = gdf.copy()
+    simplified['geometry'] = shapely.coverage_simplify(gdf.geometry.values, tolerance)
+    simplified['geometry'] = shapely.set_precision(simplified.geometry.values, grid_size)
+    return simplified
+
+
+def build_geometry_tiers(gdf):
+    # Returns a dictionary with a GeoJSON FeatureCollection for each tier
+    tiers = {}
+    for tier, settings in GEOMETRY_TIERS.items():
+        simplified = simplify_geometry(gdf, settings['tolerance'], settings['grid_size'])
+        tiers[tier] = json.loads(simplified.to_json())
+    return tiers
+
+
+def full_geometry(gdf):
+    # The GeoJSON FeatureCollection at full resolution, built when it is needed
+    return json.loads(gdf.to_json())
+
+
+def tier_for_zoom(zoom):
+    for tier, settings in GEOMETRY_TIERS.items():
+        if settings['max_zoom'] is None or zoom <= settings['max_zoom']:
+            return tier
+
+
+def select_tier(geojson, zoom):
+    # geojson is either a FeatureCollection or a dictionary of tiers from build_geometry_tiers
+    if geojson.get('type') == 'FeatureCollection':
+        return geojson
+    return geojson[tier_for_zoom(zoom)]
@@ -0,0 +1,231 @@
+import glob
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+
+# Live trip counts for map_dash.py.
+# New daily trip counts are dropped as CSV files in a folder (or put on a queue), appended to a columnar
+# store and added to the aggregates behind the figures, without reading MapData.csv again.
+# A batch file has one row per station and day:
+# Dato,Station,Afrejser,Ankomster
+# 2024-05-01,København H,51234,50876
+logger = logging.getLogger(__name__)
+BATCH_COLUMNS = ['Dato', 'Station', 'Afrejser', 'Ankomster']
+SELECTIONS = ['Afrejser', 'Ankomster']
+
+# The data the callbacks read. A new snapshot is made for every batch, and the old one is never changed,
+# so a callback that reads live_data.snapshot once sees the same numbers in all its figures
+Snapshot = namedtuple('Snapshot', ['version', 'aggregates', 'stations_by_municipality'])
+
+
+def read_batch(path):
+    batch = pd.read_csv(path, delimiter=',', encoding='utf-8')
+    missing = [column for column in BATCH_COLUMNS if column not in batch.columns]
+    if missing:
+        raise ValueError(f"Batch {path} is missing the columns {', '.join(missing)}")
+    batch = batch[BATCH_COLUMNS].copy()
+    batch['Dato'] = pd.to_datetime(batch['Dato']).values.astype('datetime64[D]')
+    batch['Station'] = batch['Station'].astype(str)
+    for selection in SELECTIONS:
+        batch[selection] = pd.to_numeric(batch[selection], errors='coerce').fillna(0)
+    return batch
+
+
+# Append-only columnar store. Every batch is one .npz file with an array per column.
+# The file is named after the batch, so a batch that is dropped twice is only stored once
+class TripStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_path(self, name):
+        return os.path.join(self.directory, f'{name}.npz')
+
+    def __contains__(self, name):
+        return os.path.exists(self.segment_path(name))
+
+    def append(self, name, batch):
+        path = self.segment_path(name)
+        columns = {column: batch[column].to_numpy() for column in BATCH_COLUMNS}
+        columns['Station'] = columns['Station'].astype(str)  # Fixed width unicode, so it loads without pickle
+        # Write to a temporary file first, so a crash does not leave half a segment
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(path + '.tmp', path)
+
+    def remove(self, name):
+        # Undo append, when the batch could not be added to the live data
+        if name in self:
+            os.remove(self.segment_path(name))
+
+    def read(self):
+        # All the stored trips as one DataFrame
+        segments = []
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.npz'))):
+            with np.load(path) as segment:
+                segments.append(pd.DataFrame({column: segment[column] for column in BATCH_COLUMNS}))
+        if not segments:
+            return pd.DataFrame(columns=BATCH_COLUMNS)
+        return pd.concat(segments, ignore_index=True)
+
+
+def add_station_trips(stations_by_municipality, station_trips, municipalities):
+    # New station index with the trips in station_trips (index stop_name) added to the given municipalities.
+    # The frames of the other municipalities are shared with the old index
+    updated = dict(stations_by_municipality)
+    for municipality in municipalities:
+        stations = stations_by_municipality.get(municipality, None)
+        if stations is None:
+            continue
+        stations = stations.copy()
+        deltas = station_trips.reindex(stations['stop_name'])
+        deltas.index = stations.index
+        for selection in SELECTIONS:
+            # Stations without data stay NaN, unless the batch has trips for them
+            stations[selection] = stations[selection].add(deltas[selection], fill_value=0)
+        updated[municipality] = stations
+    return updated
+
+
+# Holds the current snapshot and adds batches to it
+class LiveData:
+    def __init__(self, aggregates, stations_by_municipality, kommune_dict):
+        self.snapshot = Snapshot(0, aggregates, stations_by_municipality)
+        self.station_to_municipality = {station: municipality
+                                        for municipality, stations in kommune_dict.items() for station in stations}
+        self.listeners = []  # listener(old, new, municipalities, regions) is called before a new snapshot is used
+        self._lock = threading.Lock()
+
+    def apply(self, batch):
+        # Add a batch of trips and publish the new snapshot. Returns the affected municipalities
+        station_trips = batch.groupby('Station')[SELECTIONS].sum()
+        municipality = station_trips.index.map(self.station_to_municipality)
+        unknown = station_trips.index[municipality.isna()]
+        if len(unknown):
+            logger.warning("Skipped trips for %d unknown stations: %s", len(unknown), ', '.join(unknown[:10]))
+        municipality_trips = station_trips[municipality.notna()].groupby(municipality[municipality.notna()]).sum()
+        if municipality_trips.empty:
+            return set()
+
+        with self._lock:  # One writer at a time
+            old = self.snapshot
+            aggregates = old.aggregates.add_trips(municipality_trips)
+            stations = add_station_trips(old.stations_by_municipality, station_trips, municipality_trips.index)
+            new = Snapshot(old.version + 1, aggregates, stations)
+
+            municipalities = set(municipality_trips.index)
+            regions = set(aggregates.municipalities.loc[aggregates.municipalities['Kommune'].isin(municipalities), 'Region'])
+            for listener in self.listeners:
+                listener(old, new, municipalities, regions)
+            self.snapshot = new  # Assigning the attribute is atomic, so readers get the old or the new snapshot
+        return municipalities
+
+
+# Moves new batches from a drop folder (and from a queue) into the store and the live data.
+# The queue is a stand-in for a message queue: put (name, batch DataFrame) on ingestor.queue.
+# A batch is only ingested once by name, also when a message is delivered again.
+# counts has the number of ingested, duplicate and unreadable batches and of failed polls, for /metrics
+class DropDirectoryIngestor:
+    def __init__(self, live_data, store, drop_directory, interval=5.0):
+        self.live_data = live_data
+        self.store = store
+        self.drop_directory = drop_directory
+        self.interval = interval  # Seconds between the polls
+        self.queue = queue.Queue()
+        self.processed_directory = os.path.join(drop_directory, 'processed')
+        self.failed_directory = os.path.join(drop_directory, 'failed')
+        for directory in [drop_directory, self.processed_directory, self.failed_directory]:
+            os.makedirs(directory, exist_ok=True)
+        self.counts = {'ingested': 0, 'duplicates': 0, 'unreadable': 0, 'errors': 0}
+        self._thread = None
+
+    def replay(self):
+        # Add the batches that are already in the store, e.g. after a restart
+        stored = self.store.read()
+        if len(stored):
+            self.live_data.apply(stored)
+        return len(stored)
+
+    def poll(self):
+        # Ingest everything that is waiting. All new batches go into one new snapshot.
+        # The batches are stored first and the files are only moved to processed/ when the snapshot is published.
+        # If that fails, the batches are removed from the store again, the files stay in the drop folder and the
+        # queued batches are put back on the queue, so the next poll tries them again.
+        # After a crash in between, replay adds the stored batches and their files are skipped as duplicates.
+        # Returns the number of batches
+        pending = {}  # name -> (batch, path of the file or None for the queue)
+        for path in sorted(glob.glob(os.path.join(self.drop_directory, '*.csv'))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name in self.store:
+                logger.info("Batch %s is already ingested", name)
+                self.counts['duplicates'] += 1
+                shutil.move(path, os.path.join(self.processed_directory, os.path.basename(path)))
+                continue
+            try:
+                batch = read_batch(path)
+            except Exception:
+                logger.exception("Could not read %s", path)
+                self.counts['unreadable'] += 1
+                shutil.move(path, os.path.join(self.failed_directory, os.path.basename(path)))
+                continue
+            pending[name] = (batch, path)
+
+        while True:
+            try:
+                name, batch = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if name in self.store or name in pending:
+                logger.info("Batch %s is already ingested", name)
+                self.counts['duplicates'] += 1
+                continue
+            pending[name] = (batch, None)
+
+        if not pending:
+            return 0
+        stored = []
+        try:
+            for name, (batch, _) in pending.items():
+                self.store.append(name, batch)
+                stored.append(name)
+            self.live_data.apply(pd.concat([batch for batch, _ in pending.values()], ignore_index=True))
+        except Exception:
+            for name in stored:
+                self.store.remove(name)
+            for name, (batch, path) in pending.items():
+                if path is None:
+                    self.queue.put((name, batch))
+            raise
+
+        for batch, path in pending.values():
+            if path is not None:
+                shutil.move(path, os.path.join(self.processed_directory, os.path.basename(path)))
+        self.counts['ingested'] += len(pending)
+        return len(pending)
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Ingestion failed, retrying in %s s", self.interval)
+                self.counts['errors'] += 1
+            time.sleep(self.interval)
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        # Poll in a daemon thread, so it stops with the app
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='trip-ingestor', daemon=True)
+            self._thread.start()
+        return self._thread
@@ -0,0 +1,109 @@
+import argparse
+import json
+import statistics
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Load test for map_dash.py. Simulates N concurrent sessions that click region -> municipality -> station
+# by posting the same requests as the browser to /_dash-update-component.
+# Start the app first (python map_dash.py, or MAP_DASH_BACKGROUND=1 python map_dash.py), then run:
+# python load_test.py --sessions 20 --rounds 5
+OUTPUTS = [('map_dk', 'figure'), ('bar-chart', 'figure'), ('buble_chart', 'figure'),
+           ('click-context', 'data'), ('last-selected-station', 'data')]
+
+
+def post(url, body, params=None):
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        payload = response.read()
+    # 204 No Content means that the callback did not update anything
+    return json.loads(payload) if payload else {'response': {}}, len(payload)
+
+
+def click(base_url, session_id, context, map_click=None, bar_click=None, selection='Afrejser'):
+    # One click on the map or the bar chart. Returns the response size, or None if the request failed
+    url = f"{base_url}/_dash-update-component"
+    body = {
+        'output': '..' + '...'.join(f'{id}.{prop}' for id, prop in OUTPUTS) + '..',
+        'outputs': [{'id': id, 'property': prop} for id, prop in OUTPUTS],
+        'inputs': [{'id': 'map_dk', 'property': 'clickData', 'value': map_click},
+                   {'id': 'bar-chart', 'property': 'clickData', 'value': bar_click}],
+        'changedPropIds': ['map_dk.clickData' if map_click is not None else 'bar-chart.clickData'],
+        'state': [{'id': 'radio-button', 'property': 'value', 'value': selection},
+                  {'id': 'click-context', 'property': 'data', 'value': context},
+                  {'id': 'last-selected-station', 'property': 'data', 'value': None},
+                  {'id': 'session-id', 'property': 'data', 'value': session_id}],
+    }
+    try:
+        result, size = post(url, body)
+
+        # Background callbacks return a job, which is polled until the result is ready
+        if 'cacheKey' in result:
+            params = {'cacheKey': result['cacheKey'], 'job': result['job']}
+            while 'response' not in result:
+                time.sleep(0.05)
+                result, size = post(url, body, params)
+    except urllib.error.HTTPError as e:
+        print(f"Error: {e}")
+        return None
+    return size
+
+
+def run_session(base_url, region_code, municipality, station, rounds):
+    # region -> municipality -> station, repeated. Returns (step, seconds, bytes) for every click
+    session_id = str(uuid.uuid4())
+    timings = []
+    steps = [
+        ('region', {'level': 'Region'}, {'points': [{'location': region_code}]}, None),
+        ('municipality', {'level': 'Municipality', 'region': region_code}, None, {'points': [{'x': municipality}]}),
+        ('station', {'level': 'Station', 'region': region_code, 'municipality': municipality}, None,
+         {'points': [{'x': station}]}),
+    ]
+    for _ in range(rounds):
+        for step, context, map_click, bar_click in steps:
+            start = time.perf_counter()
+            size = click(base_url, session_id, context, map_click, bar_click)
+            timings.append((step, time.perf_counter() - start, size))
+    return timings
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test for map_dash.py')
+    parser.add_argument('--url', default='http://127.0.0.1:8050')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of concurrent sessions')
+    parser.add_argument('--rounds', type=int, default=3, help='Drill-downs per session')
+    parser.add_argument('--region', default='1084')
+    parser.add_argument('--municipality', default='København')
+    parser.add_argument('--station', default='København H')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        futures = [pool.submit(run_session, args.url, args.region, args.municipality, args.station, args.rounds)
+                   for _ in range(args.sessions)]
+        timings = [timing for future in futures for timing in future.result()]
+    elapsed = time.perf_counter() - start
+
+    errors = sum(1 for _, _, size in timings if size is None)
+    print(f"{args.sessions} sessions, {len(timings)} clicks in {elapsed:.1f} s ({len(timings) / elapsed:.1f} clicks/s), {errors} errors")
+    print(f"{'step':<15}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'bytes':>10}")
+    for step in ['region', 'municipality', 'station']:
+        seconds = [t for s, t, b in timings if s == step and b is not None]
+        sizes = [b for s, _, b in timings if s == step and b is not None]
+        if not seconds:
+            continue
+        print(f"{step:<15}{statistics.median(seconds) * 1000:>10.1f}{percentile(seconds, 0.95) * 1000:>10.1f}"
+              f"{max(seconds) * 1000:>10.1f}{statistics.median(sizes):>10.0f}")
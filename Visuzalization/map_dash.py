@@ -1,12 +1,23 @@
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from dash import Dash, dcc, html, Input, Output, callback, State, no_update
+from dash import Dash, dcc, html, Input, Output, callback, State, no_update, Patch
 import dash
 import vsl_data as data
 import dash_bootstrap_components as dbc
-import json
-import geopandas as gpd
+import importlib.util
+import logging
+import os
+import uuid
+import build_cache
+from figure_cache import FigureCache
+from geo_prep import select_tier
+from od_store import ODStore
+from aggregates import TripAggregates
+from live_data import LiveData, TripStore, DropDirectoryIngestor
+from metrics import Metrics, instrument_callback, register_endpoint
+from session_state import SessionState
 
 
 
@@ -15,52 +26,67 @@ kommune_dict = data.kommune_dict
 total_rejser_stationer= data.total_rejser_stationer
 # Vi skal benytte UTF-8 til at læse filerne, da vi ellers ikke kan benytte ÆØÅ!!
 
-# Load the data for the map
-with open('municipalities.geojson', encoding='utf-8') as f:
-    gdf_municipalities = gpd.read_file(f)
-gdf_municipalities_grouped = gdf_municipalities.dissolve(
-    by='lau_1',
-    aggfunc='first'  # Aggregation logic to retain attributes
-)
-gdf_municipalities_grouped["lau_1"] = gdf_municipalities_grouped.index
-geojson_municipalities = json.loads(gdf_municipalities_grouped.to_json())
-
-with open('regioner.geojson', encoding='utf-8') as f:
-    gdf_regions = gpd.read_file(f)
-gdf_regions_grouped = gdf_regions.dissolve(by='REGIONKODE')
-geojson_regions = json.loads(gdf_regions_grouped.to_json())
+# Load the prepared data for the map (dissolved geometry tiers and the stations).
+# It is built by build_cache.py and only rebuilt when the source files change
+prepared = build_cache.load()
+geojson_municipalities = prepared['geojson_municipalities']
+geojson_regions = prepared['geojson_regions']
 
 
 map_data = pd.read_csv(
     'MapData.csv', delimiter=',', encoding='utf-8',
     dtype={'Kommune Kode': int,'Region':str,'Ankomster':float,'Afrejser':float,'Indbyggertal':float,'Afrejser pr. Indbygger':float,'Ankomster pr. Indbygger':float, 'lat':float, 'lon':float,'Coordinates':str})
 
-map_data['Afrejser pr. Indbygger'] = map_data['Afrejser pr. Indbygger'].fillna(0)
-map_data['Ankomster pr. Indbygger'] = map_data['Ankomster pr. Indbygger'].fillna(0)
 
-
-df_stations = pd.read_csv(
-    'filtered_gtfs_stops.csv', delimiter=',', encoding='utf-8',
-    names=['stop_id','stop_code','stop_name','stop_desc','stop_lat','stop_lon','location_type','parent_station','wheelchair_boarding','platform_code','total_rejser']  # Added 'Coordinates'
-)
-df_stations['total_rejser'] = pd.to_numeric(df_stations['total_rejser'], errors='coerce')
-df_stations = pd.merge(df_stations, total_rejser_stationer, how='left', left_on='stop_name', right_on='Station')
-df_stations= df_stations.drop(columns='Station')
+df_stations = prepared['df_stations']
 
 scatter_data = pd.read_csv('scatter_stations_travel_time.csv', sep=',',
                    dtype={'Antal Rejser':int})
 
+# Trips grouped by origin and by destination station for the bubble chart, see od_store.py
+od_store = ODStore(scatter_data)
+
+
+# Build an index from municipality name to a pre-sliced frame of its stations.
+# A click on a municipality is then a dictionary lookup, independent of the number of stops in the feed.
+# Municipalities without stations are reported once here instead of failing in the callback.
+def build_station_index(stations, kommune_dict, municipalities):
+    positions = stations.groupby('stop_name', sort=False).indices  # stop_name -> row positions
+
+    station_index = {}
+    missing = []
+    for municipality in municipalities:
+        kommune_stationer = kommune_dict.get(municipality, None) or []
+        rows = [positions[name] for name in kommune_stationer if name in positions]
+        if not rows:
+            missing.append(municipality)
+            continue
+        # np.unique keeps the rows in the order of the stop table, the same as isin
+        station_index[municipality] = stations.iloc[np.unique(np.concatenate(rows))]
+
+    if missing:
+        print(f"No stations found for {len(missing)} municipalities: {', '.join(sorted(missing))}")
+    return station_index
+
+municipalities = set(map_data['Kommune'].dropna()) | set(kommune_dict)
+stations_by_municipality = build_station_index(df_stations, kommune_dict, municipalities)
+
 
 # Create dictionary of the colors for the app
 colors = {'background_title': 'black',
           'background_app':'whitesmoke',
           'graphs':'orange',
+          'highlight':'darkblue',
           'text': '#ffffff'}
 
 
 custom_color = [(0, 'grey'),(0.00001, 'grey'),
                 (0.00001,'aliceblue'),(0.1,'lightsteelblue'),(1,'darkblue')]
 
+# Fixed colour range of the trips per inhabitant, the same in the region and the municipality map,
+# so a colour means the same rate in every view
+RATE_RANGE = (0, 130)
+
 
 # Create a dictionary of the regions and region codes
 region_code_to_name = {
@@ -73,14 +99,107 @@ region_code_to_name = {
 
 regions = ["Region Sjælland", "Region Syddanmark", "Region Nordjylland", "Region Hovedstaden", "Region Midtjylland"]
 
+region_name_to_code = {name: code for code, name in region_code_to_name.items()}
+
+# Totals, per-capita rates and top 5 rankings computed from the raw trip counts, see aggregates.py
+trip_aggregates = TripAggregates(map_data, region_code_to_name)
+
+
+# Build an index from region code to the municipality features in that region.
+# It is built once at startup, so a drill-down is a dictionary lookup. Matching on the
+# exact lau_1 code avoids false positives like "10" matching "101".
+def build_region_index(geojson, dataset):
+    features_by_code = {}
+    for feature in geojson["features"]:
+        features_by_code.setdefault(feature["properties"]["lau_1"], []).append(feature)
+
+    region_index = {}
+    for region_code, region_name in region_code_to_name.items():
+        kommune_koder = dataset.loc[dataset['Region'] == region_name, 'Kommune Kode'].astype(str)
+        region_index[region_code] = {
+            "type": "FeatureCollection",
+            "features": [feature for kode in kommune_koder for feature in features_by_code.get(kode, [])]
+        }
+    return region_index
+
+# The index holds every geometry tier, so create_map can pick one by zoom level
+region_indexes = {tier: build_region_index(geojson, trip_aggregates.municipalities) for tier, geojson in geojson_municipalities.items()}
+geojson_municipalities_by_region = {
+    region_code: {tier: region_index[region_code] for tier, region_index in region_indexes.items()}
+    for region_code in region_code_to_name
+}
+
+
+
+# Run the drill-down callback as a background callback, so a slow render does not block the other users.
+# Enable it with MAP_DASH_BACKGROUND=1. The jobs run in separate processes through a diskcache manager.
+# This has a cost:
+# - the figures a job builds go into the figure cache of its own process, which ends with the job, so the
+#   drill-down gets no cache hits from figure_cache
+# - the timings and payload sizes recorded in a job do not reach /metrics, which only shows the server process
+# - the server handles one request at a time (threaded=False, see the end of the file)
+# So only enable it when the renders are slow enough that blocking the other users costs more than the cache
+USE_BACKGROUND_CALLBACKS = os.environ.get('MAP_DASH_BACKGROUND', '0') == '1'
+
+if USE_BACKGROUND_CALLBACKS:
+    import diskcache
+    from dash import DiskcacheManager
+    background_callback_manager = DiskcacheManager(diskcache.Cache('./cache/jobs'))
+else:
+    background_callback_manager = None
+
+# Live trip counts. The figures are built from live_data.snapshot, which is replaced when a new batch
+# of trips is ingested. Set MAP_DASH_DROP_DIRECTORY to a folder to poll it for new batch files, see live_data.py
+live_data = LiveData(trip_aggregates, stations_by_municipality, kommune_dict)
+
+DROP_DIRECTORY = os.environ.get('MAP_DASH_DROP_DIRECTORY', None)
+if DROP_DIRECTORY:
+    trip_ingestor = DropDirectoryIngestor(live_data, TripStore('./cache/trips'), DROP_DIRECTORY)
+else:
+    trip_ingestor = None
+
+
+# The selected region, municipality and station of each session are kept on the server, in a diskcache folder that
+# all the gunicorn workers share and that survives a restart. MAP_DASH_SESSION_DIRECTORY='' keeps them in this
+# process instead (one worker only). The browser keeps the same keys in click-context, and they are used when the
+# server has no state for the session (expired, or the folder was removed).
+# Without diskcache installed the state is kept in this process
+SESSION_DIRECTORY = os.environ.get('MAP_DASH_SESSION_DIRECTORY', './cache/sessions')
+if SESSION_DIRECTORY and importlib.util.find_spec('diskcache') is None:
+    print("diskcache is not installed, so the session state is kept in this process (one worker only)")
+    SESSION_DIRECTORY = None
+session_state = SessionState(directory=SESSION_DIRECTORY or None)
+
+
+def drill_down_state(session_id, context_level):
+    # {'region', 'municipality', 'station'} of the session, from the server or else from the browser's click-context.
+    # A key that neither has is None
+    state = session_state.get(session_id) if session_id else {}
+    for key in ('region', 'municipality', 'station'):
+        if state.get(key) is None:
+            state[key] = context_level.get(key)
+    return state
 
 
 # Create Dash app
-app = Dash(__name__,external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
+app = Dash(__name__,external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True,
+           background_callback_manager=background_callback_manager)
+
+
+# Latency and payload metrics for the callbacks, served on /metrics, see metrics.py.
+# Set MAP_DASH_PROFILE to a folder to also dump a cProfile file for every callback
+metrics = Metrics()
+register_endpoint(app.server, metrics)
+PROFILE_DIRECTORY = os.environ.get('MAP_DASH_PROFILE', None)
 
 
 # Create the choropleth map
-def create_map(type="choropleth_map_region", dataset=map_data, geojsonVal=geojson_regions, center_lat=56.21974050080942, center_lon=11.675033256009756, zoom=5.9, color_column='Afrejser pr. Indbygger',selection = 'Afrejser'):
+@metrics.timed('build', figure='map')
+def create_map(type="choropleth_map_region", dataset=trip_aggregates.regions, geojsonVal=geojson_regions, center_lat=56.21974050080942, center_lon=11.675033256009756, zoom=5.9, color_column='Afrejser pr. Indbygger',selection = 'Afrejser'):
+    if type != "scatter_map":
+        # Use the geometry tier that fits the zoom level
+        geojsonVal = select_tier(geojsonVal, zoom)
+
     if type == "choropleth_map_region":
         return px.choropleth_map(
             dataset, 
@@ -88,7 +207,7 @@ def create_map(type="choropleth_map_region", dataset=map_data, geojsonVal=geojso
             locations='Kommune Kode',
             color = color_column,
             color_continuous_scale = custom_color,
-            range_color = (0, 1500),
+            range_color = RATE_RANGE,
             map_style = "carto-positron",
             zoom = zoom, 
             center = {"lat": center_lat, "lon": center_lon},
@@ -108,7 +227,7 @@ def create_map(type="choropleth_map_region", dataset=map_data, geojsonVal=geojso
             locations='Kommune Kode', 
             color = color_column,
             color_continuous_scale = custom_color,
-            range_color=(0, 130),
+            range_color=RATE_RANGE,
             map_style="carto-positron",
             zoom=zoom, 
             center={"lat": center_lat, "lon": center_lon},
@@ -158,7 +277,8 @@ def create_map(type="choropleth_map_region", dataset=map_data, geojsonVal=geojso
 
 
 # Create bar chart
-def create_bar_fig(click_level = 'Hele landet', selection = "Afrejser", data_set = map_data, click_data_map = 'regioner'):
+@metrics.timed('build', figure='bar')
+def create_bar_fig(click_level = 'Hele landet', selection = "Afrejser", data_set = trip_aggregates.regions, click_data_map = 'regioner'):
     if selection == 'Afrejser':
         column = 'Afrejser pr. Indbygger'
     elif selection == 'Ankomster':
@@ -167,9 +287,7 @@ def create_bar_fig(click_level = 'Hele landet', selection = "Afrejser", data_set
         print('Something went wrong. Could not find the column')
 
     if click_level == 'Hele landet':
-        region_codes = list(region_code_to_name.keys())
-        region_codes = [int(element) for element in region_codes]
-        regioner = data_set.loc[data_set['Kommune Kode'].isin(region_codes)]
+        regioner = data_set # the regions table from TripAggregates
         bar_data = go.Bar(x=regioner['Region'], y=regioner[column],marker=dict(color=colors['graphs']),hoverinfo='x')
 
         bar_fig = go.Figure(data = bar_data)
@@ -179,7 +297,7 @@ def create_bar_fig(click_level = 'Hele landet', selection = "Afrejser", data_set
         return bar_fig
     
     elif click_level == 'Regioner':
-        five_largest = data_set.nlargest(5,column) # municipalities in the region
+        five_largest = data_set.head(5) # municipalities in the region, already ranked in TripAggregates.top_municipalities
 
         y_lim = five_largest[column].values
 
@@ -211,6 +329,7 @@ def create_bar_fig(click_level = 'Hele landet', selection = "Afrejser", data_set
 
 
 
+@metrics.timed('build', figure='buble')
 def create_buble_fig(station=None, level='Region', selection ='Afrejser'):
     if level == 'Region' or level == 'Municipality':
         
@@ -228,15 +347,13 @@ def create_buble_fig(station=None, level='Region', selection ='Afrejser'):
     elif level =='Station':
         station_click = str(station)
         if selection =='Afrejser':
-            df_station_click = scatter_data[scatter_data['Fra Station:'] == station_click]
+            df_station_click = od_store.from_station(station_click)
             rejse_station = 'Til Station:'
             titel_tekst = "fra"
         else:
-            df_station_click = scatter_data[scatter_data['Til Station:'] == station_click]
+            df_station_click = od_store.to_station(station_click)
             rejse_station= 'Fra Station:'
             titel_tekst = "til"
-        
-        df_station_click['Gennemsnitlig Rejsetid'] = df_station_click['Gennemsnitlig Rejsetid'].round(2)
 
         buble_fig = px.scatter(
             df_station_click, 
@@ -264,16 +381,212 @@ def create_buble_fig(station=None, level='Region', selection ='Afrejser'):
 
 
 
-def reset_app():
-    reset_map = create_map(type="choropleth_map_region", dataset=map_data, geojsonVal=geojson_regions, center_lat=56.21974050080942, center_lon=11.675033256009756, zoom=5.9, color_column='Afrejser pr. Indbygger')
-    reset_bar = create_bar_fig(click_level = 'Hele landet', selection = "Afrejser", data_set = map_data, click_data_map = 'regioner')
-    reset_buble = create_buble_fig(station=None, level='Region')
+# Cache of the serialized figures. The keys are (figure, level, entity, selection, version), where version
+# is the version of the live data snapshot. The bubble charts do not depend on the trip counts, so they have no version
+figure_cache = FigureCache(maxsize=512, metrics=metrics)
+metrics.collect('figure_cache_hits_total', 'counter', 'Figures served from the figure cache', lambda: figure_cache.hits)
+metrics.collect('figure_cache_misses_total', 'counter', 'Figures built because they were not in the figure cache', lambda: figure_cache.misses)
+metrics.collect('figure_cache_size', 'gauge', 'Figures in the figure cache', lambda: len(figure_cache))
+metrics.collect('snapshot_version', 'gauge', 'Version of the live trip data', lambda: live_data.snapshot.version)
+if trip_ingestor is not None:
+    for count, help in [('ingested', 'Trip batches added to the live data'),
+                        ('duplicates', 'Trip batches skipped because they were already ingested'),
+                        ('unreadable', 'Trip batch files moved to failed/'),
+                        ('errors', 'Polls of the drop folder that failed and are retried')]:
+        metrics.collect(f'trip_batches_{count}_total', 'counter', help, lambda count=count: trip_ingestor.counts[count])
+
+
+def carry_over_figures(old, new, municipalities, regions):
+    # Called when a batch of trips is ingested. The figures that the batch did not change are moved to the
+    # new version. The national view, the affected regions and the affected municipalities are rebuilt when they are used
+    region_codes = {region_name_to_code[region] for region in regions}
+
+    def update(key):
+        if len(key) < 5:
+            return key
+        figure, level, entity, selection, version = key
+        if version != old.version:
+            return None  # Built from an older snapshot by a slow callback
+        if level == 'Region' or (level == 'Municipality' and entity in region_codes) or (level == 'Station' and entity in municipalities):
+            return None
+        return (figure, level, entity, selection, new.version)
+
+    figure_cache.migrate(update)
+
+live_data.listeners.append(carry_over_figures)
+
+
+def placeholder_buble():
+    return figure_cache.get_or_build(('buble', 'Placeholder', None, None), lambda: create_buble_fig(level='Region'))
+
+
+def reset_app(selection='Afrejser', snapshot=None):
+    snapshot = snapshot or live_data.snapshot
+    aggregates = snapshot.aggregates
+    reset_map = figure_cache.get_or_build(('map', 'Region', None, selection, snapshot.version), lambda: create_map(type="choropleth_map_region", dataset=aggregates.regions, geojsonVal=geojson_regions, center_lat=56.21974050080942, center_lon=11.675033256009756, zoom=5.9, color_column=f'{selection} pr. Indbygger'))
+    reset_bar = figure_cache.get_or_build(('bar', 'Region', None, selection, snapshot.version), lambda: create_bar_fig(click_level = 'Hele landet', selection = selection, data_set = aggregates.regions, click_data_map = 'regioner'))
+    reset_buble = placeholder_buble()
     reset_context = {'level': 'Region'}
     reset_last_station = None
 
     return reset_map, reset_bar, reset_buble, reset_context, reset_last_station
 
 
+def region_figures(region_code, selection='Afrejser', snapshot=None):
+    # Map and bar chart for the municipalities in a region
+    snapshot = snapshot or live_data.snapshot
+    aggregates = snapshot.aggregates
+    region_name = region_code_to_name.get(region_code, None)
+    if not region_name:
+        raise ValueError(f"Region code {region_code} not found in mapping.")
+
+    with metrics.timer('filter'):
+        region_data = aggregates.municipalities_by_region.get(region_name, None)
+
+        if region_data is None:
+            raise ValueError(f"No municipalities found for region {region_name}.")
+        lat, lon = aggregates.region_centre[region_name]
+        bar_data = aggregates.top_municipalities[(region_name, selection)]
+
+    region_map = figure_cache.get_or_build(('map', 'Municipality', region_code, selection, snapshot.version), lambda: create_map(
+        type="choropleth_map_municipality",
+        dataset=region_data,
+        geojsonVal=geojson_municipalities_by_region[region_code],
+        center_lat=lat,
+        center_lon=lon,
+        zoom=7.1,
+        color_column=f'{selection} pr. Indbygger'
+    ))
+
+    region_bar = figure_cache.get_or_build(('bar', 'Municipality', region_code, selection, snapshot.version), lambda: create_bar_fig(
+        data_set=bar_data, click_level = 'Regioner', selection = selection, click_data_map = region_name))
+
+    return region_map, region_bar
+
+
+def municipality_figures(municipality_name, selection='Afrejser', snapshot=None):
+    # Map and bar chart for the stations in a municipality
+    snapshot = snapshot or live_data.snapshot
+    with metrics.timer('filter'):
+        centre = snapshot.aggregates.municipality_centre.get(municipality_name, None)
+
+        if centre is None:
+            raise ValueError(f"Municipality {municipality_name} not found.")
+        lat, lon = centre
+
+        df_stations_filtered = snapshot.stations_by_municipality.get(municipality_name, None)
+        if df_stations_filtered is None:
+            raise ValueError(f"No stations found for municipality {municipality_name}.")
+
+    municipality_map = figure_cache.get_or_build(('map', 'Station', municipality_name, selection, snapshot.version), lambda: create_map(
+        type="scatter_map",
+        dataset=df_stations_filtered,
+        center_lat=lat,
+        center_lon=lon,
+        zoom=9.9,
+        selection = selection
+    ))
+
+    municipality_bar = figure_cache.get_or_build(('bar', 'Station', municipality_name, selection, snapshot.version), lambda: create_bar_fig(
+        data_set = df_stations_filtered, click_level = 'Kommuner', selection = selection, click_data_map = municipality_name))
+
+    return municipality_map, municipality_bar
+
+
+def station_buble(station, selection='Afrejser'):
+    return figure_cache.get_or_build(('buble', 'Station', station, selection), lambda: create_buble_fig(
+        station=station, level='Station', selection=selection))
+
+
+def prewarm_figure_cache():
+    # Build the national view and the region drill-downs at startup
+    for selection in ['Afrejser', 'Ankomster']:
+        reset_app(selection)
+        for region_code in region_code_to_name:
+            region_figures(region_code, selection)
+
+prewarm_figure_cache()
+
+
+def national_figures():
+    # The national view, shipped to the browser once through a dcc.Store, so the reset button and the radio button
+    # are handled by clientside callbacks. It holds the Afrejser map and bar chart, which the graphs are filled with
+    # on page load, and for each selection only the values that differ (see figure_values), so the region geometry
+    # is sent once per page load.
+    # It is sent with every page load, so a new page gets the latest trip counts
+    snapshot = live_data.snapshot
+    figures = {selection: reset_app(selection, snapshot)[:2] for selection in ['Afrejser', 'Ankomster']}
+    national_map, national_bar = figures['Afrejser']
+    return {
+        'map': national_map,
+        'bar': national_bar,
+        'placeholder': placeholder_buble(),
+        'selections': {selection: {'map': figure_values(selection_map, MAP_RECOLOUR_PATHS['choroplethmap']),
+                                   'bar': figure_values(selection_bar, BAR_PATCH_PATHS)}
+                       for selection, (selection_map, selection_bar) in figures.items()},
+    }
+
+
+# Partial figure updates. Instead of sending a full figure, only the properties that change are sent
+# as a Patch, so the geometry and the layout template stay in the browser.
+BAR_PATCH_PATHS = [('data', 0, 'x'), ('data', 0, 'y'), ('data', 0, 'marker'),
+                   ('layout', 'title'), ('layout', 'yaxis', 'range')]
+
+MAP_RECOLOUR_PATHS = {
+    'choroplethmap': [('data', 0, 'z'), ('data', 0, 'customdata'), ('data', 0, 'hovertemplate'), ('layout', 'coloraxis')],
+    'scattermap': [('data', 0, 'marker'), ('data', 0, 'customdata'), ('data', 0, 'hovertemplate')],
+}
+
+
+def figure_patch(figure, paths):
+    # Copy the properties in paths from a (cached) figure into a Patch
+    patch = Patch()
+    for path in paths:
+        target, value = patch, figure
+        for key in path[:-1]:
+            target = target[key]
+            value = value.get(key, {}) if isinstance(value, dict) else value[key]
+        target[path[-1]] = value.get(path[-1], None) if isinstance(value, dict) else value[path[-1]]
+    return patch
+
+
+def figure_values(figure, paths):
+    # [path, value] pairs of the properties in paths, for the clientside callbacks (see APPLY_VALUES_JS)
+    values = []
+    for path in paths:
+        value = figure
+        for key in path[:-1]:
+            value = value.get(key, {}) if isinstance(value, dict) else value[key]
+        values.append([list(path), value.get(path[-1], None) if isinstance(value, dict) else value[path[-1]]])
+    return values
+
+
+def bar_patch(bar_figure):
+    return figure_patch(bar_figure, BAR_PATCH_PATHS)
+
+
+def recolour_patch(map_figure):
+    return figure_patch(map_figure, MAP_RECOLOUR_PATHS[map_figure['data'][0]['type']])
+
+
+def highlight_patch(patch, names, station):
+    # Colour the selected station, and the other stations in the normal colour
+    patch['data'][0]['marker']['color'] = [colors['highlight'] if name == station else colors['graphs'] for name in names]
+    return patch
+
+
+@metrics.timed('filter', figure='highlight')
+def station_highlight(municipality_name, station, selection='Afrejser', map_patch=None, bar_chart_patch=None, snapshot=None):
+    # Map and bar chart patches that highlight the selected station.
+    # The highlight is added to map_patch and bar_chart_patch if they are given
+    snapshot = snapshot or live_data.snapshot
+    df_stations_filtered = snapshot.stations_by_municipality[municipality_name]
+    map_patch = highlight_patch(Patch() if map_patch is None else map_patch, df_stations_filtered['stop_name'], station)
+    bar_names = df_stations_filtered.nlargest(5, selection)['stop_name']  # The stations in the bar chart
+    bar_chart_patch = highlight_patch(Patch() if bar_chart_patch is None else bar_chart_patch, bar_names, station)
+    return map_patch, bar_chart_patch
+
+
 
 
 # Define components of the dash app
@@ -297,51 +610,56 @@ reset_button = dbc.Button("Reset Filter",
                                  'marginTop': 15,
                           })
 
-dk_map = dcc.Graph(
-            id = 'map_dk',
-            figure = create_map(),
-            style = {'height':'800px'})
-
-bar_chart = dcc.Graph(id ='bar-chart',
-                      figure = create_bar_fig(),
-                      style = {'height': '400px'})
-
 buble_chart = dcc.Graph(id ='buble_chart', 
-                       figure = create_buble_fig(),
+                       figure = placeholder_buble(),
                        style = {'height': '400px'})
 
 
 
 
-# Adjust the layout of the app
-app.layout = html.Div([
-    dcc.Store(id='click-context', data={'level': 'Region'}),
-    dcc.Store(id='last-selected-station', data=None),
-    dcc.Store(id='reset-clicks', data=0),
+# Adjust the layout of the app.
+# The layout is a function, so every page load gets its own session id.
+# The map and the bar chart are filled from the national-figures store in the browser, by a clientside callback,
+# so the region geometry is only sent once
+def serve_layout():
+    dk_map = dcc.Graph(
+                id = 'map_dk',
+                style = {'height':'800px'})
 
-    dbc.Row([dbc.Col(title, width=14)],
-            align = "center",
-            style={'backgroundColor':colors['background_app']}),
+    bar_chart = dcc.Graph(id ='bar-chart',
+                          style = {'height': '400px'})
+
+    return html.Div([
+        dcc.Store(id='session-id', data=str(uuid.uuid4())),
+        dcc.Store(id='click-context', data={'level': 'Region'}),
+        dcc.Store(id='last-selected-station', data=None),
+        dcc.Store(id='national-figures', data=national_figures()),
+
+        dbc.Row([dbc.Col(title, width=14)],
+                align = "center",
+                style={'backgroundColor':colors['background_app']}),
     
-    dbc.Row([
-        dbc.Col(radio_button, width=2, align = "left"),
-        dbc.Col(width = 8, align = 'center'),
-        dbc.Col(reset_button, width=2, align = "right")],
-        style={'backgroundColor':colors['background_app']}),
+        dbc.Row([
+            dbc.Col(radio_button, width=2, align = "left"),
+            dbc.Col(width = 8, align = 'center'),
+            dbc.Col(reset_button, width=2, align = "right")],
+            style={'backgroundColor':colors['background_app']}),
     
-    dbc.Row([
-        dbc.Col(width = 12, align = 'center')],
-        style={'backgroundColor':colors['background_app']}),
+        dbc.Row([
+            dbc.Col(width = 12, align = 'center')],
+            style={'backgroundColor':colors['background_app']}),
 
-    dbc.Row([
-        dbc.Col(dk_map, width=6, align = 'left'),
-        dbc.Col(dbc.Container([
-            dbc.Row(bar_chart, align = 'center'),
-            dbc.Row(buble_chart, align = 'center'),
+        dbc.Row([
+            dbc.Col(dk_map, width=6, align = 'left'),
+            dbc.Col(dbc.Container([
+                dbc.Row(bar_chart, align = 'center'),
+                dbc.Row(buble_chart, align = 'center'),
 
-        ]), width = 6, align = 'center')
-    ], style={'backgroundColor':colors['background_app']})
-])
+            ]), width = 6, align = 'center')
+        ], style={'backgroundColor':colors['background_app']})
+    ])
+
+app.layout = serve_layout
 
 
 
@@ -356,14 +674,15 @@ app.layout = html.Div([
      Output('buble_chart','figure'),
      Output('click-context', 'data'),
      Output('last-selected-station', 'data')],
-    [Input('reset-clicks', 'data'),
-     Input('map_dk', 'clickData'),
-     Input('radio-button', 'value'),
+    [Input('map_dk', 'clickData'),
      Input('bar-chart','clickData'),],
-    [State('click-context', 'data'),
-     State('last-selected-station', 'data')])
-
-def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_level, last_station): 
+    [State('radio-button', 'value'),
+     State('click-context', 'data'),
+     State('last-selected-station', 'data'),
+     State('session-id', 'data')],
+    background=USE_BACKGROUND_CALLBACKS)
+@instrument_callback(metrics, 'update_map_region', PROFILE_DIRECTORY)
+def update_map_region(clickData_map, clickData_bar, value, context_level, last_station, session_id): 
     
     ctx = dash.callback_context
 
@@ -374,10 +693,6 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
         raise dash.exceptions.PreventUpdate
 
 
-    elif ctx.triggered[0]['prop_id'].startswith("reset-clicks.data"):
-            return reset_app()
-
-
     elif ctx.triggered[0]["prop_id"].startswith("map_dk.clickData"):
         if clickData_map is None:
             # Reset the app
@@ -388,95 +703,39 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
                     # Municipality level. After the user clicks on a region in the map
                     region_code = str(clickData_map['points'][0]['location'])
 
-
-                    region_name = region_code_to_name.get(region_code, None)
-                    if not region_name:
-                        raise ValueError(f"Region code {region_code} not found in mapping.")
-
-                    region_data = map_data[map_data['Region'] == region_name]
-
-                    if region_data.empty:
-                        raise ValueError(f"No municipalities found for region {region_name}.")
-                    last_row = region_data.iloc[-1] if not region_data.empty else None
-
-
-                    # DEFINES THE MAP
-                    filtered_geojson = {
-                        "type": "FeatureCollection",
-                        "features": [
-                            feature for feature in geojson_municipalities["features"]
-                            if feature["properties"]["lau_1"] in str(region_data["Kommune Kode"].values)
-                        ]
-                    }
-
-                    lat = last_row['lat']
-                    lon = last_row['lon']
-
-                    updated_map = create_map(
-                        type="choropleth_map_municipality",
-                        dataset=region_data,
-                        geojsonVal=filtered_geojson,
-                        center_lat=lat,
-                        center_lon=lon,
-                        zoom=7.1
-                    )
-                    
-
-                    # DEFINES THE BAR CHART
-                    bar_data = region_data.iloc[:-1,:]
-                    updated_bar = create_bar_fig(data_set=bar_data, click_level = 'Regioner', selection= value, click_data_map = region_name)
+                    # DEFINES THE MAP AND THE BAR CHART
+                    updated_map, updated_bar = region_figures(region_code, value)
 
 
                     # DEFINES THE BUBLE CHART
-                    updated_buble = create_buble_fig(level="Region")
+                    updated_buble = placeholder_buble()
 
 
                     # DEFINES THE NEW CONTEXT
-                    new_context = {'level': 'Municipality'}
+                    new_context = {'level': 'Municipality', 'region': region_code}
+                    session_state.set(session_id, region=region_code)
 
-                    return updated_map, updated_bar, updated_buble, new_context, last_station
+                    return updated_map, bar_patch(updated_bar), updated_buble, new_context, last_station
                 
                 elif current_level == "Municipality":
                     # Station level. After the user clicks on a municipality in the map
                         
                     municipality_name =str(clickData_map['points'][0]['hovertext'])
-                    
-                    region_data = map_data[map_data['Kommune'] == municipality_name]
-                    
-
-                    last_row = region_data.iloc[-1] if not region_data.empty else None
-
-                    lat = last_row['lat']
-                    lon = last_row['lon']
 
-                    kommune_stationer = data.kommune_dict.get(municipality_name, None)
-
-
-                    # DEFINES THE MAP
-                    df_stations_filtered = df_stations[df_stations['stop_name'].isin(kommune_stationer)]
-
-                    updated_map = create_map(
-                        type="scatter_map",
-                        dataset=df_stations_filtered,
-                        center_lat=lat,
-                        center_lon=lon,
-                        zoom=9.9
-                    )
-
-
-                    # DEFINES THE BAR CHART
-                   
-                    updated_bar = create_bar_fig(data_set = df_stations_filtered, click_level = 'Kommuner', selection= value, click_data_map = municipality_name)
+                    # DEFINES THE MAP AND THE BAR CHART
+                    updated_map, updated_bar = municipality_figures(municipality_name, value)
 
 
                     # DEFINES THE BUBLE CHART
-                    updated_buble = create_buble_fig(level="Municipality")
+                    updated_buble = placeholder_buble()
 
 
                     # DEFINES THE NEW CONTEXT
-                    new_context = {'level': 'Station'}
+                    new_context = {'level': 'Station', 'region': context_level.get('region'),
+                                   'municipality': municipality_name}
+                    session_state.set(session_id, municipality=municipality_name, station=None)
 
-                    return updated_map, updated_bar, updated_buble, new_context, last_station
+                    return updated_map, bar_patch(updated_bar), updated_buble, new_context, last_station
 
                 elif current_level == "Station": # If the user clicks on a station
                     current_station = str(clickData_map['points'][0]['hovertext'])
@@ -486,9 +745,18 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
                         return reset_app()
                     else:
                         # DEFINES THE BUBLE CHART
-                        updated_buble = create_buble_fig(station=current_station, level='Station')
-                        
-                        return no_update, no_update, updated_buble, context_level, last_station
+                        updated_buble = station_buble(current_station, value)
+
+                        # HIGHLIGHTS THE STATION IN THE MAP AND THE BAR CHART
+                        municipality_name = drill_down_state(session_id, context_level)['municipality']
+                        if municipality_name is None:
+                            # Neither the server nor the browser knows the municipality anymore
+                            return reset_app(value)
+                        session_state.set(session_id, municipality=municipality_name, station=current_station)
+                        map_patch, highlighted_bar = station_highlight(municipality_name, current_station, value)
+                        new_context = dict(context_level, municipality=municipality_name, station=current_station)
+
+                        return map_patch, highlighted_bar, updated_buble, new_context, last_station
 
                 else:
                     print("Something went wrong in the map")
@@ -509,48 +777,23 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
                     # Municipality level. After the user clicks on a region in the bar chart
                     region_name = str(clickData_bar['points'][0]['x'])
 
-                    region_data = map_data[map_data['Region'] == region_name]
-
-                    if region_data.empty:
-                        raise ValueError(f"No municipalities found for region {region_name}.")
-                    
-                    last_row = region_data.iloc[-1] if not region_data.empty else None
-
-                    # DEFINES THE MAP
-                    filtered_geojson = {
-                        "type": "FeatureCollection",
-                        "features": [
-                            feature for feature in geojson_municipalities["features"]
-                            if feature["properties"]["lau_1"] in str(region_data["Kommune Kode"].values)
-                        ]
-                    }
+                    region_code = region_name_to_code.get(region_name, None)
+                    if not region_code:
+                        raise ValueError(f"Region name {region_name} not found in mapping.")
 
-                    lat = last_row['lat']
-                    lon = last_row['lon']
-
-                    updated_map = create_map(
-                        type="choropleth_map_municipality",
-                        dataset=region_data,
-                        geojsonVal=filtered_geojson,
-                        center_lat=lat,
-                        center_lon=lon,
-                        zoom=7.1
-                    )
-             
-
-                    # DEFINES THE BAR CHART
-                    bar_data = region_data.iloc[:-1,:]
-                    updated_bar = create_bar_fig(click_level = 'Regioner', selection = value, data_set = bar_data, click_data_map = region_name)
+                    # DEFINES THE MAP AND THE BAR CHART
+                    updated_map, updated_bar = region_figures(region_code, value)
 
 
                     # DEFINES THE BUBLE CHART
-                    updated_buble = create_buble_fig(level="Region")
+                    updated_buble = placeholder_buble()
 
 
                     # DEFINES THE NEW CONTEXT
-                    new_context = {'level': 'Municipality'}
+                    new_context = {'level': 'Municipality', 'region': region_code}
+                    session_state.set(session_id, region=region_code)
 
-                    return updated_map, updated_bar, updated_buble, new_context, last_station
+                    return updated_map, bar_patch(updated_bar), updated_buble, new_context, last_station
                 
 
                 elif current_level == "Municipality": 
@@ -558,44 +801,20 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
 
                     municipality_name = str(clickData_bar['points'][0]['x'])
 
-                    municipality_data = map_data[map_data['Kommune'] == municipality_name]
-
-                    if municipality_data.empty:
-                        raise ValueError(f"No stations found for municipality {municipality_name}.")
-
-                    last_row = municipality_data.iloc[-1] if not municipality_data.empty else None
-
-                    lat = last_row['lat']
-                    lon = last_row['lon']
-
-                    kommune_stationer = data.kommune_dict.get(municipality_name, None)
-
-
-                    # DEFINES THE MAP
-                    df_stations_filtered = df_stations[df_stations['stop_name'].isin(kommune_stationer)]
-                    
-
-                    updated_map = create_map(
-                        type="scatter_map",
-                        dataset=df_stations_filtered,
-                        center_lat=lat,
-                        center_lon=lon,
-                        zoom=9.9,
-                        selection = value
-                     )
-
-                    # DEFINES THE BAR CHART
-                    updated_bar = create_bar_fig(click_level = 'Kommuner', selection = value, data_set = df_stations_filtered, click_data_map = municipality_name)
+                    # DEFINES THE MAP AND THE BAR CHART
+                    updated_map, updated_bar = municipality_figures(municipality_name, value)
 
 
                     # DEFINES THE BUBLE CHART
-                    updated_buble = create_buble_fig(level="Municipality")
+                    updated_buble = placeholder_buble()
 
 
                     # DEFINES THE NEW CONTEXT
-                    new_context = {'level': 'Station'}
+                    new_context = {'level': 'Station', 'region': context_level.get('region'),
+                                   'municipality': municipality_name}
+                    session_state.set(session_id, municipality=municipality_name, station=None)
 
-                    return updated_map, updated_bar, updated_buble, new_context, last_station
+                    return updated_map, bar_patch(updated_bar), updated_buble, new_context, last_station
 
                 elif current_level == "Station": # If the user clicks on a station
                     current_station= str(clickData_bar['points'][0]['x'])
@@ -605,9 +824,18 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
                         return reset_app()
                     else:
                         # DEFINES THE BUBLE CHART
-                        updated_buble = create_buble_fig(station=current_station, level='Station', selection= value)
+                        updated_buble = station_buble(current_station, value)
 
-                        return no_update, no_update, updated_buble, context_level, last_station
+                        # HIGHLIGHTS THE STATION IN THE MAP AND THE BAR CHART
+                        municipality_name = drill_down_state(session_id, context_level)['municipality']
+                        if municipality_name is None:
+                            # Neither the server nor the browser knows the municipality anymore
+                            return reset_app(value)
+                        session_state.set(session_id, municipality=municipality_name, station=current_station)
+                        map_patch, highlighted_bar = station_highlight(municipality_name, current_station, value)
+                        new_context = dict(context_level, municipality=municipality_name, station=current_station)
+
+                        return map_patch, highlighted_bar, updated_buble, new_context, last_station
 
                 else:
                     print("Something went wrong in the bar chart")
@@ -623,23 +851,156 @@ def update_map_region(reset_clicks,clickData_map, value, clickData_bar, context_
 
 
 
-# Callback for clicking the reset-button
+# Callback for switching between Afrejser and Ankomster below the national view.
+# Only the colours and the bar data change, so they are sent as patches
 @app.callback(
-    [Output('reset-clicks', 'data'),
+    [Output('map_dk', 'figure', allow_duplicate=True),
+     Output('bar-chart', 'figure', allow_duplicate=True),
+     Output('buble_chart', 'figure', allow_duplicate=True)],
+    Input('radio-button', 'value'),
+    [State('click-context', 'data'),
+     State('session-id', 'data')],
+    prevent_initial_call=True
+)
+@instrument_callback(metrics, 'recolour_selection', PROFILE_DIRECTORY)
+def recolour_selection(value, context_level, session_id):
+    current_level = context_level['level']
+    state = drill_down_state(session_id, context_level)
+    snapshot = live_data.snapshot  # The map, the bar chart and the highlight are built from the same trip counts
+
+    if current_level == "Municipality":
+        if state['region'] is None:
+            raise dash.exceptions.PreventUpdate
+        updated_map, updated_bar = region_figures(state['region'], value)
+        return recolour_patch(updated_map), bar_patch(updated_bar), no_update
+
+    elif current_level == "Station":
+        if state['municipality'] is None:
+            raise dash.exceptions.PreventUpdate
+        updated_map, updated_bar = municipality_figures(state['municipality'], value, snapshot)
+        map_patch, updated_bar = recolour_patch(updated_map), bar_patch(updated_bar)
+
+        station = state['station']
+        if station is None:
+            return map_patch, updated_bar, no_update
+
+        # Keep the selected station highlighted and show its trips in the other direction
+        map_patch, updated_bar = station_highlight(state['municipality'], station, value, map_patch, updated_bar, snapshot)
+        return map_patch, updated_bar, station_buble(station, value)
+
+    # The national view is handled by the clientside callback
+    raise dash.exceptions.PreventUpdate
+
+
+
+# applyValues(figure, values) in the clientside callbacks: a copy of figure with the [path, value] pairs from
+# figure_values set, e.g. the colours of a selection from national-figures
+APPLY_VALUES_JS = """
+    function applyValues(figure, values) {
+        const copy = JSON.parse(JSON.stringify(figure));
+        values.forEach(function(pair) {
+            const path = pair[0];
+            let target = copy;
+            path.slice(0, -1).forEach(function(key) {
+                if (target[key] === undefined || target[key] === null) {
+                    target[key] = {};
+                }
+                target = target[key];
+            });
+            target[path[path.length - 1]] = pair[1];
+        });
+        return copy;
+    }
+"""
+
+
+# Clientside callback that fills the map and the bar chart with the national view when the page is loaded
+app.clientside_callback(
+    """
+    function(national) {
+        return [national.map, national.bar];
+    }
+    """,
+    [Output('map_dk', 'figure', allow_duplicate=True),
+     Output('bar-chart', 'figure', allow_duplicate=True)],
+    Input('national-figures', 'data'),
+    prevent_initial_call='initial_duplicate'
+)
+
+
+# Clientside callback for clicking the reset-button.
+# The national view is already in the browser (national-figures), so no request is sent to the server
+app.clientside_callback(
+    """
+    function(n_clicks, national) {
+        if (!n_clicks) {
+            throw window.dash_clientside.PreventUpdate;
+        }
+        return [national.map, national.bar, national.placeholder,
+                {'level': 'Region'}, null, 'Afrejser'];
+    }
+    """,
+    [Output('map_dk', 'figure', allow_duplicate=True),
+     Output('bar-chart', 'figure', allow_duplicate=True),
+     Output('buble_chart', 'figure', allow_duplicate=True),
+     Output('click-context', 'data', allow_duplicate=True),
+     Output('last-selected-station', 'data', allow_duplicate=True),
      Output('radio-button', 'value')],
     Input('reset-button', 'n_clicks'),
+    State('national-figures', 'data'),
     prevent_initial_call=True
 )
-def update_reset_clicks(n_clicks):
-    # If the user clicks on the reset button, the n_clicks updates
-    if n_clicks:
-        print(f"Reset button clicked {n_clicks} times")
-        return 0, 'Afrejser'
-    raise dash.exceptions.PreventUpdate
 
 
+# Clientside callback for switching between Afrejser and Ankomster in the national view.
+# It recolours the national view that is shown with the values of the selected column from national-figures.
+# The other levels are handled by recolour_selection
+app.clientside_callback(
+    """
+    function(value, national, context, map_figure, bar_figure) {
+    """ + APPLY_VALUES_JS + """
+        if (context.level !== 'Region') {
+            throw window.dash_clientside.PreventUpdate;
+        }
+        const selection = national.selections[value];
+        return [applyValues(map_figure, selection.map), applyValues(bar_figure, selection.bar), national.placeholder,
+                {'level': 'Region'}, null];
+    }
+    """,
+    [Output('map_dk', 'figure', allow_duplicate=True),
+     Output('bar-chart', 'figure', allow_duplicate=True),
+     Output('buble_chart', 'figure', allow_duplicate=True),
+     Output('click-context', 'data', allow_duplicate=True),
+     Output('last-selected-station', 'data', allow_duplicate=True)],
+    Input('radio-button', 'value'),
+    [State('national-figures', 'data'),
+     State('click-context', 'data'),
+     State('map_dk', 'figure'),
+     State('bar-chart', 'figure')],
+    prevent_initial_call=True
+)
+
+
+
+
+def start_ingestion():
+    # Replay the stored trips and start polling MAP_DASH_DROP_DIRECTORY, in the process that serves the app.
+    # Under a WSGI server, call it from the worker hook, e.g. for gunicorn in gunicorn.conf.py:
+    # def post_worker_init(worker): import map_dash; map_dash.start_ingestion()
+    if trip_ingestor is None or trip_ingestor.started:
+        return
+    print(f"Replayed {trip_ingestor.replay()} stored trip rows")
+    trip_ingestor.start()
 
 
 # Kør serveren
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    debug = os.environ.get('MAP_DASH_DEBUG', '1') == '1'
+    # With the reloader (debug) this file runs in two processes. Only the one that serves the app,
+    # WERKZEUG_RUN_MAIN=true, ingests
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_ingestion()
+    # The background jobs are forked from the server, which is only safe for diskcache (SQLite)
+    # when the server does not handle requests in several threads at the same time
+    app.run_server(debug=debug, threaded=not USE_BACKGROUND_CALLBACKS)
@@ -0,0 +1,184 @@
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import functools
+import os
+import threading
+import time
+
+
+# Latency and payload metrics for the callbacks in map_dash.py, served in the Prometheus text format on /metrics.
+# Every timing is tagged with the labels of the callback it belongs to (callback, level and trigger),
+# so the slow drill-down level can be found under load.
+# The stages are:
+# - callback: the whole callback
+# - filter: the lookup of the data for a figure
+# - build: create_map, create_bar_fig and create_buble_fig
+# - to_json: converting a new figure to JSON for the figure cache
+# - response: Dash serializing the callback outputs, until the response is sent
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+BYTES_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+HELP = {
+    'stage_seconds': 'Time spent in each stage of a callback',
+    'response_bytes': 'Size of the callback responses',
+}
+
+# The labels of the callback that is running in this thread (or background job)
+_labels = contextvars.ContextVar('metric_labels', default={})
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix='map_dash'):
+        self.prefix = prefix
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._collectors = []  # (name, type, help, function) for values read when /metrics is requested
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        labels = tuple(sorted({**_labels.get(), **labels}.items()))
+        with self._lock:
+            histogram = self._histograms.get((name, labels), None)
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        # Add labels to everything observed inside the with block
+        token = _labels.set({**_labels.get(), **labels})
+        try:
+            yield
+        finally:
+            _labels.reset(token)
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def timed(self, stage, **labels):
+        # Decorator version of timer
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def collect(self, name, type, help, function):
+        # A value that is read from function() when the metrics are rendered, e.g. the figure cache hits
+        self._collectors.append((name, type, help, function))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted((key, histogram.counts[:], histogram.sum, histogram.count)
+                                for key, histogram in self._histograms.items())
+            buckets = {name: histogram.buckets for (name, _), histogram in self._histograms.items()}
+
+        previous = None
+        for (name, labels), counts, total, count in histograms:
+            metric = f'{self.prefix}_{name}'
+            if name != previous:
+                lines.append(f'# HELP {metric} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {metric} histogram')
+                previous = name
+            cumulative = 0
+            for le, bucket_count in zip([*buckets[name], '+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{metric}_sum{format_labels(labels)} {total}')
+            lines.append(f'{metric}_count{format_labels(labels)} {count}')
+
+        for name, type, help, function in self._collectors:
+            metric = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} {type}')
+            lines.append(f'{metric} {function()}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+# cProfile can only run one profiler at a time, so concurrent requests are not profiled
+_profile_lock = threading.Lock()
+
+
+def instrument_callback(metrics, name, profile_directory=None):
+    # Decorator for a Dash callback (put it below @app.callback). Times the callback and tags it with the level
+    # from the click-context store and the input that triggered it.
+    # If profile_directory is set, every call is profiled with cProfile and dumped to a .prof file there
+    # (open it with python -m pstats or snakeviz)
+    import dash
+    import flask
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            ctx = dash.callback_context
+            trigger = ctx.triggered[0]['prop_id'] if ctx.triggered else 'none'
+            level = (ctx.states.get('click-context.data', None) or {}).get('level', 'none')
+
+            with metrics.labels(callback=name, level=level, trigger=trigger):
+                profiler = None
+                if profile_directory and _profile_lock.acquire(blocking=False):
+                    profiler = cProfile.Profile()
+                try:
+                    with metrics.timer('callback'):
+                        if profiler is None:
+                            return function(*args)
+                        return profiler.runcall(function, *args)
+                finally:
+                    if profiler is not None:
+                        _profile_lock.release()
+                        os.makedirs(profile_directory, exist_ok=True)
+                        profiler.dump_stats(os.path.join(profile_directory, f'{name}-{level}-{time.time_ns()}.prof'))
+                    if flask.has_request_context():
+                        # The response size and serialization time are recorded in record_response
+                        flask.g.metric_labels = {'callback': name, 'level': level, 'trigger': trigger}
+                        flask.g.callback_end = time.perf_counter()
+        return wrapper
+    return decorator
+
+
+def register_endpoint(server, metrics, path='/metrics'):
+    # Serve the metrics on path and record the size of the callback responses.
+    # With background callbacks the callbacks run in other processes, so only the callbacks
+    # that run in the server process are measured
+    import flask
+
+    @server.route(path)
+    def serve_metrics():
+        return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @server.after_request
+    def record_response(response):
+        labels = flask.g.get('metric_labels', None)
+        if labels is not None and not response.direct_passthrough:
+            metrics.observe('stage_seconds', time.perf_counter() - flask.g.callback_end, stage='response', **labels)
+            metrics.observe('response_bytes', len(response.get_data()), buckets=BYTES_BUCKETS, **labels)
+        return response
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+# Origin/destination store for the bubble chart.
+# The OD table is sorted once by origin and once by destination, so the trips from or to a station
+# are one contiguous block of rows. A lookup is a dictionary lookup plus an iloc slice, which does not
+# copy the data, instead of a boolean scan over the whole table.
+class ODStore:
+    def __init__(self, od_data, origin='Fra Station:', destination='Til Station:', time_column='Gennemsnitlig Rejsetid'):
+        self.origin = origin
+        self.destination = destination
+
+        od_data = od_data.copy()
+        od_data[time_column] = od_data[time_column].round(2)  # Rounded once, instead of on every click
+
+        self._sorted = {}
+        self._blocks = {}
+        for column in (origin, destination):
+            # Stable sort, so the trips keep the order from the original table
+            sorted_data = od_data.sort_values(column, kind='stable').reset_index(drop=True)
+            keys = sorted_data[column].to_numpy()
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=int)
+            stops = np.r_[starts[1:], len(keys)]
+            self._sorted[column] = sorted_data
+            self._blocks[column] = {keys[start]: (start, stop) for start, stop in zip(starts, stops)}
+
+    def _lookup(self, column, station):
+        start, stop = self._blocks[column].get(station, (0, 0))
+        return self._sorted[column].iloc[start:stop]
+
+    def from_station(self, station):
+        # All trips starting at the station
+        return self._lookup(self.origin, station)
+
+    def to_station(self, station):
+        # All trips ending at the station
+        return self._lookup(self.destination, station)
+
+    def __len__(self):
+        return len(self._sorted[self.origin])
@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+
+
+# Server-side state for each browser session in map_dash.py (selected region, municipality and station).
+# The callbacks can run in other processes (gunicorn workers, background callbacks), so the state is kept in a
+# diskcache folder that all the processes can read and that survives a restart. directory=None keeps it in this
+# process, which only works with a single worker.
+class SessionState:
+    def __init__(self, directory=None, ttl=3600):
+        self.directory = directory  # diskcache folder, or None to keep the state in this process
+        self.ttl = ttl  # Seconds before an unused session is removed
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_pid = None
+
+    @property
+    def cache(self):
+        # The SQLite connections of a diskcache must not be shared with forked processes,
+        # so each process opens its own
+        if self.directory is None:
+            return None
+        if self._disk_pid != os.getpid():
+            import diskcache
+            self._disk = diskcache.Cache(self.directory)
+            self._disk_pid = os.getpid()
+        return self._disk
+
+    def get(self, session_id):
+        if self.cache is not None:
+            return dict(self.cache.get(('session', session_id), {}))
+
+        with self._lock:
+            expires, state = self._sessions.get(session_id, (0, {}))
+            if expires < time.monotonic():
+                self._sessions.pop(session_id, None)
+                return {}
+            return dict(state)
+
+    def set(self, session_id, **values):
+        # Update some of the values in the state of a session
+        state = self.get(session_id)
+        state.update(values)
+
+        if self.cache is not None:
+            self.cache.set(('session', session_id), state, expire=self.ttl)
+            return state
+
+        with self._lock:
+            now = time.monotonic()
+            self._sessions[session_id] = (now + self.ttl, state)
+            if len(self._sessions) > 1000:
+                # Remove the expired sessions
+                for key in [key for key, (expires, _) in self._sessions.items() if expires < now]:
+                    del self._sessions[key]
+        return state
+
+    def clear(self, session_id):
+        if self.cache is not None:
+            self.cache.delete(('session', session_id))
+        else:
+            with self._lock:
+                self._sessions.pop(session_id, None)